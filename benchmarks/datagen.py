@@ -0,0 +1,107 @@
+import datetime
+import random
+
+from peewee import chunked
+
+from processor.db_helper import BATCH_SIZE, batch_size
+from processor.model import Meeting, MeetingInstance, Participant, Attendance, AttendanceInterval
+
+ZOOM_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class SyntheticDataset:
+    """
+    A seeded, reproducible set of recurring meetings with weekly instances and their participants.
+    It can be served by a FakeZoomServer, or written straight into the DB through processor.model.
+    """
+    def __init__(self, meetings=20, instances=52, participants=500, attendees=25, seed=0,
+                 first_session=datetime.datetime(2020, 1, 4, 18)):
+        self.meetings = meetings
+        self.instances = instances
+        self.participants = participants
+        self.attendees = min(attendees, participants)
+        self.seed = seed
+        self.first_session = first_session
+        self.people = self.make_people()
+
+    def make_people(self):
+        rnd = random.Random(self.seed)
+        people = []
+        for i in range(self.participants):
+            # Roughly a third of the people sign in with an email
+            email = f"person{i}@example.com" if rnd.random() < 0.33 else ""
+            people.append({"id": f"user{i}", "name": f"Person {i}", "user_email": email})
+        return people
+
+    def meeting_ids(self):
+        return [str(80000000000 + m) for m in range(self.meetings)]
+
+    def topic(self, meeting_id):
+        return f"Synthetic meeting {meeting_id}"
+
+    def meeting_instances(self, meeting_id):
+        """
+        Yields (uuid, start_time, participants_json) for every instance of the meeting.
+        """
+        rnd = random.Random(f"{self.seed}-{meeting_id}")
+        for week in range(self.instances):
+            start_time = self.first_session + datetime.timedelta(weeks=week, minutes=rnd.randint(0, 30))
+            uuid = f"{meeting_id}-{week}=="
+            yield uuid, start_time, self.make_participants(rnd, start_time)
+
+    def make_participants(self, rnd, start_time):
+        records = []
+        for person in rnd.sample(self.people, self.attendees):
+            join_time = start_time + datetime.timedelta(minutes=rnd.randint(0, 10))
+            # Some people drop off and rejoin, which shows up as another record
+            for _ in range(1 + (rnd.random() < 0.1)):
+                duration = rnd.randint(5, 60)
+                leave_time = join_time + datetime.timedelta(minutes=duration)
+                records.append(dict(person,
+                                    join_time=join_time.strftime(ZOOM_TIME_FORMAT),
+                                    leave_time=leave_time.strftime(ZOOM_TIME_FORMAT),
+                                    duration=duration * 60))
+                join_time = leave_time + datetime.timedelta(minutes=rnd.randint(1, 5))
+        return records
+
+    def serve(self, fake_zoom):
+        for meeting_id in self.meeting_ids():
+            fake_zoom.add_meeting(meeting_id, self.topic(meeting_id),
+                                  [(uuid, start_time.strftime(ZOOM_TIME_FORMAT), participants)
+                                   for uuid, start_time, participants in self.meeting_instances(meeting_id)])
+        return fake_zoom
+
+    def populate_db(self):
+        """
+        Writes the whole dataset as already cached meetings, skipping the Zoom API and the deduplication.
+        """
+        Meeting.insert_many([{"meeting_id": m, "topic": self.topic(m)} for m in self.meeting_ids()]).execute()
+        for batch in chunked(self.people, batch_size(3)):
+            Participant.insert_many([{"user_id": p["id"], "name": p["name"], "email": p["user_email"]}
+                                     for p in batch]).execute()
+        participant_ids = {user_id: pk for pk, user_id in Participant.select(Participant.id, Participant.user_id)
+                                                                     .tuples()}
+
+        ingested_at = datetime.datetime.now()
+        for meeting_id in self.meeting_ids():
+            instances = []
+            attendances = []
+            intervals = []
+            for uuid, start_time, participants in self.meeting_instances(meeting_id):
+                instances.append({"uuid": uuid, "meeting": meeting_id, "start_time": start_time, "cached": True,
+                                  "ingested_at": ingested_at})
+                attending = dict.fromkeys(participant_ids[p["id"]] for p in participants)
+                attendances.extend({"meeting_instance": uuid, "participant": pk} for pk in attending)
+                intervals.extend({"meeting_instance": uuid, "participant": participant_ids[p["id"]],
+                                  "join_offset": self.offset(p["join_time"], start_time),
+                                  "leave_offset": self.offset(p["leave_time"], start_time)} for p in participants)
+            for batch in chunked(instances, batch_size(5)):
+                MeetingInstance.insert_many(batch).execute()
+            for batch in chunked(attendances, BATCH_SIZE):
+                Attendance.insert_many(batch).execute()
+            for batch in chunked(intervals, batch_size(4)):
+                AttendanceInterval.insert_many(batch).execute()
+
+    @staticmethod
+    def offset(timestamp, start_time):
+        return int((datetime.datetime.strptime(timestamp, ZOOM_TIME_FORMAT) - start_time).total_seconds())
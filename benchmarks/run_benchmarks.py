@@ -0,0 +1,203 @@
+"""
+Times each stage of the reporting pipeline on a synthetic dataset served by a local fake Zoom server.
+
+    export PYTHONPATH=.
+    python benchmarks/run_benchmarks.py --meetings 50 --instances 104 --output bench.json
+    python benchmarks/run_benchmarks.py --meetings 50 --instances 104 --compare bench.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import platform
+import sys
+import time
+
+from benchmarks.datagen import SyntheticDataset
+from processor.attendance_index import AttendanceIndex
+from processor.data_fetcher import DataFetcher
+from processor.db_helper import DbHelper
+from processor.engagement import fetch_engagement
+from processor.instrumentation import tracer
+from processor.model import AttendanceInterval, Meeting
+from processor.report_generator import ReportGenerator
+from processor.sheets_writer import SheetsWriter, changed_blocks
+from processor.zoom_helper import ZoomHelper, TokenBucket, make_rate_limits, HEAVY, MEDIUM
+from tests.fake_zoom import FakeZoomServer
+
+STAGES = ["fetch", "ingest", "generate_report", "generate_report_from_db",
+          "generate_report_from_cache", "generate_report_from_cache_warm",
+          "engagement_metrics", "attendance_index", "dataframe_to_array", "upload_serialization"]
+
+
+class StageTimer:
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        output = contextlib.nullcontext() if self.verbose else contextlib.redirect_stdout(io.StringIO())
+        start = time.perf_counter()
+        with output:
+            yield
+        self.timings[name] = round(time.perf_counter() - start, 4)
+        print(f"{name:<28}{self.timings[name]:>10.3f}s")
+
+
+def fetch(zoom, meeting_ids):
+    """
+    Downloads everything the report needs, keeping the raw JSON so that ingestion can be timed on its own.
+    """
+    downloaded = []
+    for meeting_id in meeting_ids:
+        topic = zoom.get_meeting_details(meeting_id).json().get("topic")
+        instances = []
+        for m in zoom.get_past_meeting_instances(meeting_id).json().get("meetings"):
+            instances.append((m, list(zoom.iter_meeting_participants(m["uuid"]))))
+        downloaded.append((meeting_id, topic, instances))
+    return downloaded
+
+
+def ingest(data_fetcher, downloaded):
+    for meeting_id, topic, instances in downloaded:
+        meeting = data_fetcher.store_meeting_details(meeting_id, topic)
+        meeting_instances = data_fetcher.store_past_meeting_instances(meeting, [m for m, _ in instances])
+        for meeting_instance, (_, participants) in zip(meeting_instances, instances):
+            data_fetcher.store_meeting_participants(meeting_instance, participants)
+
+
+def run(args):
+    dataset = SyntheticDataset(meetings=args.meetings, instances=args.instances,
+                               participants=args.participants, attendees=args.attendees, seed=args.seed)
+    fake_zoom = dataset.serve(FakeZoomServer(page_size=args.page_size)).start()
+    try:
+        zoom = ZoomHelper(fake_zoom.base_url, "benchmark_key", "benchmark_secret")
+        if args.rate_limit:
+            zoom.rate_limits = make_rate_limits()
+        else:
+            unlimited = float("inf")
+            zoom.rate_limits = {HEAVY: TokenBucket(unlimited, unlimited, limit=unlimited),
+                                MEDIUM: TokenBucket(unlimited, unlimited, limit=unlimited)}
+        db = DbHelper(args.db)
+        data_fetcher = DataFetcher(db, zoom)
+        meeting_ids = dataset.meeting_ids()
+        timer = StageTimer(args.verbose)
+
+        if args.source == "zoom":
+            with timer.stage("fetch"):
+                downloaded = fetch(zoom, meeting_ids)
+            with timer.stage("ingest"):
+                ingest(data_fetcher, downloaded)
+            del downloaded
+        else:
+            with timer.stage("populate_db"):
+                dataset.populate_db()
+
+        report_generator = ReportGenerator(data_fetcher, None)
+        with timer.stage("generate_report"):
+            report = report_generator.generate_report(meeting_ids)
+        report_generator.from_db = True
+        with timer.stage("generate_report_from_db"):
+            report_from_db = report_generator.generate_report(meeting_ids)
+        report_generator.from_cache = True
+        # The first run fills the cache, the second only checks that nothing changed
+        with timer.stage("generate_report_from_cache"):
+            report_generator.generate_report(meeting_ids)
+        with timer.stage("generate_report_from_cache_warm"):
+            report_generator.generate_report(meeting_ids)
+        with timer.stage("engagement_metrics"):
+            fetch_engagement(meeting_ids)
+        with timer.stage("attendance_index"):
+            attendance_index = AttendanceIndex(db)
+            attendance_index.refresh(meeting_ids)
+            for meeting_attendance in attendance_index.fetch(meeting_ids).values():
+                meeting_attendance.attended_at_least(3, 4)
+                meeting_attendance.churned(4)
+        with timer.stage("dataframe_to_array"):
+            values = ReportGenerator.dataframe_to_array(report)
+        with timer.stage("upload_serialization"):
+            # The batchUpdate requests SheetsWriter.write sends for a first upload, without calling the API
+            writer = SheetsWriter(None)
+            values = json.loads(json.dumps(values))
+            chunks = list(writer.chunks(writer.value_ranges(values, changed_blocks([], values))))
+
+        return {"timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "params": vars(args),
+                "rows": {"meetings": Meeting.select().count(),
+                         "intervals": AttendanceInterval.select().count(),
+                         "report_shape": list(report_from_db.shape),
+                         "upload_requests": len(chunks),
+                         "payload_bytes": sum(len(json.dumps({"valueInputOption": "RAW", "data": data}))
+                                              for data in chunks)},
+                "stages": timer.timings}
+    finally:
+        fake_zoom.stop()
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the stages that got slower than threshold times their baseline.
+    """
+    regressions = []
+    for stage, seconds in results["stages"].items():
+        before = baseline["stages"].get(stage)
+        if before is None:
+            continue
+        ratio = seconds / before if before > 0 else float("inf")
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"{stage:<28}{before:>10.3f}s -> {seconds:>8.3f}s  x{ratio:.2f}{flag}")
+        if ratio > threshold:
+            regressions.append(stage)
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--meetings", type=int, default=20)
+    parser.add_argument("--instances", type=int, default=52, help="instances per meeting")
+    parser.add_argument("--participants", type=int, default=500, help="size of the participant directory")
+    parser.add_argument("--attendees", type=int, default=25, help="attendees per instance")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--page-size", type=int, default=300, help="participants per page from the fake server")
+    parser.add_argument("--source", choices=["zoom", "db"], default="zoom",
+                        help="ingest through the fake Zoom API, or populate the DB directly")
+    parser.add_argument("--db", default=":memory:")
+    parser.add_argument("--rate-limit", action="store_true", help="keep Zoom's rate limits in place")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare the results against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio over the baseline that counts as a regression")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+    parser.add_argument("--trace", help="record a trace of the run to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.trace:
+        tracer.enable()
+    try:
+        results = run(args)
+    finally:
+        if args.trace:
+            tracer.write_trace(args.trace)
+            print(tracer.summary())
+            tracer.disable()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Times how long each CLI entry point takes to import in a fresh interpreter, and checks that it doesn't
+load dependencies that only some code paths need.
+
+    export PYTHONPATH=.
+    python benchmarks/startup.py --output startup.json
+    python benchmarks/startup.py --compare startup.json
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+from benchmarks.run_benchmarks import compare
+
+# Imports the module given as the argument, then prints the import time and which heavy modules got loaded
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "loaded": [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+HEAVY_MODULES = ["pandas", "numpy", "googleapiclient", "google.oauth2", "authlib", "pyarrow"]
+# What each entry point must not load at startup
+DEFERRED = {
+    "processor.report_generator": ["googleapiclient", "google.oauth2", "authlib", "pyarrow"],
+    "processor.participant_report_generator": ["googleapiclient", "google.oauth2", "authlib", "pyarrow"],
+    "processor.backfill": ["pandas", "googleapiclient", "google.oauth2", "authlib", "pyarrow"],
+    "processor.daemon": ["googleapiclient", "google.oauth2", "authlib", "pyarrow"],
+}
+
+
+def probe(module):
+    output = subprocess.run([sys.executable, "-W", "ignore", "-c", PROBE, module] + HEAVY_MODULES,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def run(args):
+    results = {"python": sys.version.split()[0], "stages": {}, "loaded": {}}
+    for module in DEFERRED:
+        probes = [probe(module) for _ in range(args.repeat)]
+        results["stages"][module] = round(min(p["seconds"] for p in probes), 4)
+        results["loaded"][module] = probes[0]["loaded"]
+        print(f"{module:<42}{results['stages'][module]:>8.3f}s  loads {', '.join(probes[0]['loaded']) or 'nothing heavy'}")
+    return results
+
+
+def eager_imports(results):
+    """
+    Returns (entry point, module) for every deferred module an entry point loaded anyway.
+    """
+    return [(entry_point, module) for entry_point, loaded in results["loaded"].items()
+            for module in loaded if module in DEFERRED[entry_point]]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="imports per entry point, the fastest one counts")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare the results against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio over the baseline that counts as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    results = run(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = False
+    for entry_point, module in eager_imports(results):
+        print(f"{entry_point} imports {module} at startup")
+        failed = True
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        failed = bool(compare(results, baseline, args.threshold)) or failed
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import asyncio
+
+from peewee import chunked
+
+from processor.data_fetcher import DataFetcher, ParticipantIngest
+from processor.db_helper import BATCH_SIZE
+from processor.model import Meeting
+from processor.zoom_helper import AsyncZoomHelper
+
+
+class AsyncDataFetcher(DataFetcher):
+    """
+    DataFetcher that downloads everything for a batch of meetings concurrently.
+
+    Call prefetch() with the meeting ids before generating a report. Zoom requests for all meetings
+    and instances are fanned out over an AsyncZoomHelper, while all DB writes stay on the calling
+    thread. Afterwards the usual synchronous report path reads the instances from memory
+    and the participants from the DB cache.
+    """
+    def __init__(self, db, zoom, incremental=False, max_workers=None):
+        super().__init__(db, zoom, incremental)
+        self.max_workers = max_workers
+        self.past_meeting_instances = {}
+
+    def prefetch(self, meeting_ids):
+        asyncio.run(self.fetch_all(meeting_ids))
+
+    async def fetch_all(self, meeting_ids):
+        # The helper owns asyncio primitives, so it must be created inside the running loop
+        if self.max_workers is None:
+            async_zoom = AsyncZoomHelper(self.zoom)
+        else:
+            async_zoom = AsyncZoomHelper(self.zoom, self.max_workers)
+        try:
+            await asyncio.gather(*[self.fetch_meeting(async_zoom, meeting_id)
+                                   for meeting_id in dict.fromkeys(meeting_ids)])
+        finally:
+            async_zoom.close()
+
+    async def fetch_meeting(self, async_zoom, meeting_id):
+        meeting = Meeting.get_or_none(Meeting.meeting_id == meeting_id)
+        if meeting is None:
+            meeting = await self.fetch_meeting_details_async(async_zoom, meeting_id)
+
+        meeting_instances = await self.fetch_past_meeting_instances_async(async_zoom, meeting)
+        self.past_meeting_instances[str(meeting.meeting_id)] = meeting_instances
+
+        await asyncio.gather(*[self.fetch_meeting_participants_async(async_zoom, mi)
+                               for mi in meeting_instances if not mi.cached])
+
+    async def fetch_meeting_details_async(self, async_zoom, meeting_id):
+        response = await async_zoom.get_meeting_details(meeting_id)
+        if not response.ok:
+            print(f"Response failed with code {response.status_code} for meeting {meeting_id}")
+            raise RuntimeError
+
+        return self.store_meeting_details(meeting_id, response.json().get("topic"))
+
+    async def fetch_past_meeting_instances_async(self, async_zoom, meeting):
+        response = await async_zoom.get_past_meeting_instances(meeting.meeting_id)
+        if not response.ok:
+            print(f"Response failed with code {response.status_code} for meeting {meeting.meeting_id}")
+            raise RuntimeError
+
+        return self.store_past_meeting_instances(meeting, response.json().get("meetings"))
+
+    async def fetch_meeting_participants_async(self, async_zoom, meeting_instance):
+        ingest = ParticipantIngest(self.db, meeting_instance)
+        async for page in async_zoom.iter_meeting_participant_pages(meeting_instance.uuid):
+            for batch in chunked(page, BATCH_SIZE):
+                ingest.add(batch)
+        participants = ingest.finish()
+        self.mark_cached(meeting_instance)
+        return participants
+
+    def fetch_past_meeting_instances(self, meeting):
+        meeting_instances = self.past_meeting_instances.get(str(meeting.meeting_id))
+        if meeting_instances is None:
+            return super().fetch_past_meeting_instances(meeting)
+        return meeting_instances
@@ -0,0 +1,213 @@
+import bisect
+import datetime
+from typing import Dict, List, Optional
+
+from peewee import chunked
+
+from processor.db_helper import BATCH_SIZE, batch_size
+from processor.instrumentation import tracer, traced
+from processor.model import Attendance, AttendanceBitmap, AttendanceBitmapState, MeetingInstance
+
+BITMAP_BATCH_SIZE = batch_size(3)
+
+
+def to_blob(bits: int) -> bytes:
+    return bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+
+
+def from_blob(blob) -> int:
+    return int.from_bytes(bytes(blob), "little")
+
+
+def popcount(bits: int) -> int:
+    # int.bit_count needs Python 3.10
+    return bin(bits).count("1")
+
+
+class MeetingAttendance:
+    """
+    Who attended each session of a meeting, as one bitset per participant id: bit i is set when
+    they attended the meeting's i-th instance by start time. Windows count back from the latest session.
+    """
+    def __init__(self, meeting_id: str, start_times: List[datetime.datetime], bitmaps: Dict[int, int]):
+        self.meeting_id = meeting_id
+        self.start_times = start_times
+        self.bitmaps = bitmaps
+
+    @property
+    def sessions(self) -> int:
+        return len(self.start_times)
+
+    def last(self, n: int) -> int:
+        """
+        The mask of the last n sessions.
+        """
+        n = max(0, min(n, self.sessions))
+        return ((1 << n) - 1) << (self.sessions - n)
+
+    def sessions_since(self, start_time: datetime.datetime) -> int:
+        """
+        How many sessions started at or after start_time, to use as a window: churned(sessions_since(month_start)).
+        """
+        return self.sessions - bisect.bisect_left(self.start_times, start_time)
+
+    def attended(self, participant_id: int) -> List[int]:
+        bits = self.bitmaps.get(participant_id, 0)
+        return [i for i in range(self.sessions) if bits >> i & 1]
+
+    def attended_at_least(self, k: int, n: int) -> List[int]:
+        """
+        Participants who attended at least k of the last n sessions.
+        """
+        window = self.last(n)
+        return [p for p, bits in self.bitmaps.items() if popcount(bits & window) >= k]
+
+    def new(self, n: int) -> List[int]:
+        """
+        Participants whose first session is one of the last n.
+        """
+        before = ~self.last(n)
+        return [p for p, bits in self.bitmaps.items() if not bits & before]
+
+    def churned(self, n: int) -> List[int]:
+        """
+        Participants who attended before the last n sessions but none of them.
+        """
+        window = self.last(n)
+        return [p for p, bits in self.bitmaps.items() if not bits & window]
+
+    def retention(self, n: int) -> Optional[float]:
+        """
+        Of the participants in the n sessions before the last n, the fraction that attended any of the last n.
+        None when nobody attended those earlier sessions.
+        """
+        window = self.last(n)
+        previous = self.last(2 * n) & ~window
+        cohort = [bits for bits in self.bitmaps.values() if bits & previous]
+        if not cohort:
+            return None
+        return sum(1 for bits in cohort if bits & window) / len(cohort)
+
+    def first_seen(self) -> Dict[int, int]:
+        """
+        The first session each participant attended.
+        """
+        return {p: (bits & -bits).bit_length() - 1 for p, bits in self.bitmaps.items()}
+
+    def streaks(self) -> Dict[int, int]:
+        """
+        How many consecutive sessions, up to and including the latest, each participant attended.
+        Participants who missed the latest session are left out.
+        """
+        everything = self.last(self.sessions)
+        streaks = {}
+        for p, bits in self.bitmaps.items():
+            # Sessions after the latest one missed
+            streak = self.sessions - (everything & ~bits).bit_length()
+            if streak:
+                streaks[p] = streak
+        return streaks
+
+
+class AttendanceIndex:
+    """
+    Attendance bitmaps per (meeting, participant), so retention questions are answered with bitwise operations
+    instead of loading every Attendance row. A refresh only reads the attendance of the instances ingested
+    since the meeting was last indexed, unless an instance appeared before ones already indexed, which shifts
+    every bit after it and rebuilds the meeting.
+    """
+    def __init__(self, db):
+        self.db = db
+
+    @traced("refresh attendance index")
+    def refresh(self, meeting_ids) -> int:
+        """
+        Brings the bitmaps up to date for the meetings, returning how many of them had changed.
+        """
+        meeting_ids = [str(meeting_id) for meeting_id in dict.fromkeys(meeting_ids)]
+        states = {}
+        for batch in chunked(meeting_ids, BATCH_SIZE):
+            states.update((s.meeting_id, s) for s in AttendanceBitmapState.select()
+                                                                          .where(AttendanceBitmapState.meeting.in_(batch)))
+
+        refreshed = sum(1 for meeting_id in meeting_ids if self.refresh_meeting(meeting_id, states.get(meeting_id)))
+        tracer.count("attendance_index.refreshed", refreshed)
+        print(f"Attendance index: refreshed {refreshed} of {len(meeting_ids)} meetings")
+        return refreshed
+
+    def refresh_meeting(self, meeting_id: str, state) -> bool:
+        instances = list(MeetingInstance.select(MeetingInstance.uuid, MeetingInstance.ingested_at)
+                                        .where(MeetingInstance.meeting == meeting_id)
+                                        .order_by(MeetingInstance.start_time, MeetingInstance.uuid)
+                                        .tuples())
+        appended = state is not None and state.instances <= len(instances) and \
+            (state.instances == 0 or instances[state.instances - 1][0] == state.last_uuid)
+        if appended:
+            changed = [i for i, (_, ingested_at) in enumerate(instances)
+                       if i >= state.instances or (ingested_at is not None and (state.last_ingested_at is None
+                                                                                or ingested_at > state.last_ingested_at))]
+            if not changed:
+                return False
+            old = self.fetch_bitmaps([meeting_id])[meeting_id]
+        else:
+            changed = list(range(len(instances)))
+            old = {}
+
+        # Clear the changed sessions, then set them again from their attendance
+        positions = {instances[i][0]: i for i in changed}
+        keep = ~sum(1 << i for i in changed)
+        bitmaps = {p: bits & keep for p, bits in old.items()}
+        for batch in chunked(list(positions), BATCH_SIZE):
+            for uuid, participant in (Attendance.select(Attendance.meeting_instance, Attendance.participant)
+                                                .where(Attendance.meeting_instance.in_(batch))
+                                                .tuples()):
+                bitmaps[participant] = bitmaps.get(participant, 0) | 1 << positions[uuid]
+
+        rows = [{'meeting': meeting_id, 'participant': p, 'bits': to_blob(bits)}
+                for p, bits in bitmaps.items() if bits and bits != old.get(p)]
+        emptied = [p for p, bits in bitmaps.items() if not bits and p in old]
+        last_ingested_at = max((ingested_at for _, ingested_at in instances if ingested_at is not None), default=None)
+        with self.db.db.atomic():
+            if not appended:
+                AttendanceBitmap.delete().where(AttendanceBitmap.meeting == meeting_id).execute()
+            for batch in chunked(rows, BITMAP_BATCH_SIZE):
+                AttendanceBitmap.replace_many(batch).execute()
+            for batch in chunked(emptied, BATCH_SIZE):
+                AttendanceBitmap.delete().where((AttendanceBitmap.meeting == meeting_id)
+                                                & AttendanceBitmap.participant.in_(batch)).execute()
+            AttendanceBitmapState.replace(meeting=meeting_id, instances=len(instances),
+                                          last_uuid=instances[-1][0] if instances else None,
+                                          last_ingested_at=last_ingested_at).execute()
+        tracer.count("attendance_index.sessions", len(changed))
+        return True
+
+    @staticmethod
+    def fetch_bitmaps(meeting_ids) -> Dict[str, Dict[int, int]]:
+        """
+        Returns {meeting_id: {participant_id: bits}} for the meetings.
+        """
+        bitmaps = {str(meeting_id): {} for meeting_id in meeting_ids}
+        for batch in chunked(list(bitmaps), BATCH_SIZE):
+            for meeting_id, participant, bits in (AttendanceBitmap.select(AttendanceBitmap.meeting,
+                                                                          AttendanceBitmap.participant,
+                                                                          AttendanceBitmap.bits)
+                                                                  .where(AttendanceBitmap.meeting.in_(batch))
+                                                                  .tuples()):
+                bitmaps[meeting_id][participant] = from_blob(bits)
+        return bitmaps
+
+    def fetch(self, meeting_ids) -> Dict[str, MeetingAttendance]:
+        """
+        The indexed attendance of the meetings, keyed by meeting id as a string. Call refresh first.
+        """
+        bitmaps = self.fetch_bitmaps(meeting_ids)
+        start_times = {meeting_id: [] for meeting_id in bitmaps}
+        for batch in chunked(list(bitmaps), BATCH_SIZE):
+            for meeting_id, start_time in (MeetingInstance.select(MeetingInstance.meeting, MeetingInstance.start_time)
+                                                          .where(MeetingInstance.meeting.in_(batch))
+                                                          .order_by(MeetingInstance.meeting, MeetingInstance.start_time,
+                                                                    MeetingInstance.uuid)
+                                                          .tuples()):
+                start_times[meeting_id].append(start_time)
+        return {meeting_id: MeetingAttendance(meeting_id, start_times[meeting_id], bitmaps[meeting_id])
+                for meeting_id in bitmaps}
@@ -0,0 +1,210 @@
+"""
+Backfills the attendance of many meetings at once, sharding the meeting IDs across worker processes.
+
+    export PYTHONPATH=.
+    python processor/backfill.py prod.db raw_data/meetings.txt --workers 4
+
+Each worker downloads its meetings into its own staging DB, and the parent process merges every meeting a worker
+finishes into the main DB, so only one process ever writes to it. Merged meetings are checkpointed in
+BackfillCheckpoint, and running the same command again after an interruption skips them.
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import tempfile
+from typing import Dict, List
+
+from peewee import SqliteDatabase
+
+from processor.data_fetcher import DataFetcher
+from processor.db_helper import DbHelper
+from processor.model import Attendance, AttendanceInterval, BackfillCheckpoint, ExecutionLog, Meeting, MeetingInstance, Participant
+from processor.zoom_helper import ZoomHelper, make_rate_limits, ZOOM_URL
+
+DONE = "done"
+FAILED = "failed"
+ZOOM_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+STAGED_MODELS = [Meeting, MeetingInstance, Participant, Attendance, AttendanceInterval]
+
+
+def shard(meeting_ids: List[str], workers: int) -> List[List[str]]:
+    return [meeting_ids[i::workers] for i in range(min(workers, len(meeting_ids)))]
+
+
+def backfill_worker(base_url, api_key, api_secret, meeting_ids, staging_path, processes, progress):
+    """
+    Runs in a worker process. Downloads each meeting into the staging DB and reports it on the progress queue,
+    followed by a None meeting ID once the shard is done.
+    """
+    db = DbHelper(staging_path)
+    zoom = ZoomHelper(base_url, api_key, api_secret)
+    zoom.rate_limits = make_rate_limits(processes)
+    data_fetcher = DataFetcher(db, zoom)
+    try:
+        for meeting_id in meeting_ids:
+            try:
+                data_fetcher.sync_meeting(meeting_id)
+                progress.put((staging_path, meeting_id, None))
+            except Exception as e:
+                progress.put((staging_path, meeting_id, repr(e)))
+    finally:
+        zoom.close()
+        db.db.close()
+        progress.put((staging_path, None, None))
+
+
+class Backfill:
+    def __init__(self, db, base_url: str, api_key: str, api_secret: str, workers: int = 4, staging_dir=None):
+        self.db = db
+        self.base_url = base_url
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.workers = workers
+        self.staging_dir = staging_dir
+        # Only stores what the workers downloaded, never calls Zoom itself
+        self.data_fetcher = DataFetcher(db, None)
+
+    @staticmethod
+    def pending(meeting_ids: List[str]) -> List[str]:
+        done = set(c.meeting_id for c in BackfillCheckpoint.select().where(BackfillCheckpoint.status == DONE))
+        return [meeting_id for meeting_id in dict.fromkeys(meeting_ids) if meeting_id not in done]
+
+    def run(self, meeting_ids: List[str]) -> Dict[str, int]:
+        pending = self.pending(meeting_ids)
+        summary = {"skipped": len(set(meeting_ids)) - len(pending), "merged": 0, "failed": 0}
+        print(f"Backfilling {len(pending)} meetings, {summary['skipped']} already done")
+        if not pending:
+            return summary
+
+        staging_dir = self.staging_dir or tempfile.mkdtemp(prefix="backfill_")
+        shards = shard(pending, self.workers)
+        context = multiprocessing.get_context("spawn")
+        progress = context.Queue()
+        processes = []
+        staging = {}
+        try:
+            for i, meeting_ids_shard in enumerate(shards):
+                staging_path = os.path.join(staging_dir, f"shard_{i}.db")
+                if os.path.exists(staging_path):
+                    os.remove(staging_path)
+                process = context.Process(target=backfill_worker,
+                                          args=(self.base_url, self.api_key, self.api_secret, meeting_ids_shard,
+                                                staging_path, len(shards), progress))
+                process.start()
+                processes.append(process)
+
+            running = len(processes)
+            while running:
+                try:
+                    staging_path, meeting_id, error = progress.get(timeout=1)
+                except queue.Empty:
+                    if not any(p.is_alive() for p in processes):
+                        print("Backfill: a worker exited without finishing its shard")
+                        break
+                    continue
+                if meeting_id is None:
+                    running -= 1
+                elif error is not None:
+                    print(f"Backfill: meeting {meeting_id} failed with {error}")
+                    self.checkpoint(meeting_id, FAILED, error=error)
+                    summary["failed"] += 1
+                else:
+                    if staging_path not in staging:
+                        staging[staging_path] = SqliteDatabase(staging_path)
+                    self.merge_meeting(staging[staging_path], meeting_id)
+                    summary["merged"] += 1
+        finally:
+            for process in processes:
+                process.join()
+            for staging_db in staging.values():
+                staging_db.close()
+            if self.staging_dir is None:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+        print(f"Backfill: merged {summary['merged']} meetings, {summary['failed']} failed")
+        return summary
+
+    def merge_meeting(self, staging_db, meeting_id: str):
+        """
+        Copies a meeting the worker finished from its staging DB into the main DB, resolving its participants
+        the same way as a regular fetch would, and checkpoints it in the same transaction.
+        """
+        with staging_db.bind_ctx(STAGED_MODELS):
+            topic = Meeting.get(Meeting.meeting_id == meeting_id).topic
+            instances = [{"uuid": mi.uuid, "start_time": mi.start_time.strftime(ZOOM_TIME_FORMAT)}
+                         for mi in MeetingInstance.select()
+                                                  .where(MeetingInstance.meeting == meeting_id)
+                                                  .order_by(MeetingInstance.start_time)]
+
+        with self.db.db.atomic():
+            meeting = self.data_fetcher.store_meeting_details(meeting_id, topic)
+            meeting_instances = self.data_fetcher.store_past_meeting_instances(meeting, instances)
+            for meeting_instance in meeting_instances:
+                if meeting_instance.cached:
+                    continue
+                with staging_db.bind_ctx(STAGED_MODELS):
+                    participants_json = [{"id": p.user_id, "name": p.name, "user_email": p.email}
+                                         for p in Participant.select()
+                                                             .join(Attendance)
+                                                             .where(Attendance.meeting_instance == meeting_instance.uuid)
+                                                             .order_by(Attendance.id)]
+                    # The attendances above keep their order, and these records add the join/leave intervals
+                    participants_json.extend(self.interval_records(meeting_instance))
+                self.data_fetcher.store_meeting_participants(meeting_instance, participants_json)
+            self.checkpoint(meeting_id, DONE, instances=len(meeting_instances))
+
+    @staticmethod
+    def interval_records(meeting_instance):
+        """
+        Participant records rebuilt from the staged intervals of an instance, one per join.
+        """
+        def timestamp(offset):
+            return (meeting_instance.start_time + datetime.timedelta(seconds=offset)).strftime(ZOOM_TIME_FORMAT)
+
+        return [{"id": p.user_id, "name": p.name, "user_email": p.email,
+                 "join_time": timestamp(interval.join_offset), "leave_time": timestamp(interval.leave_offset)}
+                for interval, p in ((interval, interval.participant)
+                                    for interval in AttendanceInterval.select(AttendanceInterval, Participant)
+                                                                      .join(Participant)
+                                                                      .where(AttendanceInterval.meeting_instance
+                                                                             == meeting_instance.uuid)
+                                                                      .order_by(AttendanceInterval.id))]
+
+    @staticmethod
+    def checkpoint(meeting_id: str, status: str, instances: int = 0, error=None):
+        BackfillCheckpoint.replace(meeting_id=meeting_id, status=status, instances=instances,
+                                   finished=datetime.datetime.now(), error=error).execute()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db")
+    parser.add_argument("meeting_ids_file", help="one meeting ID per line")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--staging-dir", help="keep the workers' staging DBs here instead of a temporary directory")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    run_time = datetime.datetime.now()
+
+    with open(args.meeting_ids_file) as f:
+        meeting_ids = [line.strip() for line in f.read().splitlines() if line.strip()]
+
+    db = DbHelper(args.db)
+    backfill = Backfill(db, ZOOM_URL, os.environ["ZOOM_API_KEY"], os.environ["ZOOM_API_SECRET"],
+                        workers=args.workers, staging_dir=args.staging_dir)
+    summary = backfill.run(meeting_ids)
+
+    exit_code = 1 if summary["failed"] else 0
+    ExecutionLog.create(run_time=run_time, exit_code=exit_code)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,298 @@
+"""
+Runs the report as a resident service: the DB, Zoom and Google clients stay warm between runs, each meeting is synced
+when it comes due, and the report is uploaded again when a sync ingested something new.
+Serves /health and /metrics as JSON on localhost.
+
+    python processor/daemon.py prod.db raw_data/meetings.txt --interval 3600 --port 8081
+"""
+import argparse
+import collections
+import datetime
+import heapq
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+from peewee import chunked
+
+from processor.data_fetcher import DataFetcher
+from processor.db_helper import DbHelper, BATCH_SIZE
+from processor.google_helper import GoogleHelper
+from processor.instrumentation import tracer, traced, start_tracing_from_env, finish_tracing
+from processor.local_server import LOCALHOST, close_server, json_handler, start_server, stop_on_signals
+from processor.model import ExecutionLog, MeetingInstance, MeetingSyncState
+from processor.report_generator import ReportGenerator, make_response_cache
+from processor.zoom_helper import ZoomHelper, ZOOM_URL
+
+DEFAULT_INTERVAL = 3600
+DEFAULT_PORT = 8081
+# Run durations kept for the latency percentiles in /metrics
+LATENCY_WINDOW = 100
+
+
+class Scheduler:
+    """
+    When each meeting is next due for a sync. A meeting is due interval seconds after it was last synced,
+    as recorded in MeetingSyncState, so a restarted daemon only syncs what came due while it was down.
+    """
+    def __init__(self, interval: float, clock=time.time):
+        self.interval = interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.queue = []
+
+    def load(self, meeting_ids: List[str]):
+        last_synced = {}
+        for batch in chunked(list(meeting_ids), BATCH_SIZE):
+            last_synced.update(MeetingSyncState.select(MeetingSyncState.meeting, MeetingSyncState.last_synced)
+                                               .where(MeetingSyncState.meeting.in_(batch))
+                                               .tuples())
+        now = self.clock()
+        with self.lock:
+            self.queue = [(now if last_synced.get(meeting_id) is None
+                           else last_synced[meeting_id].timestamp() + self.interval, meeting_id)
+                          for meeting_id in dict.fromkeys(meeting_ids)]
+            heapq.heapify(self.queue)
+
+    def pop_due(self) -> List[str]:
+        now = self.clock()
+        due = []
+        with self.lock:
+            while self.queue and self.queue[0][0] <= now:
+                due.append(heapq.heappop(self.queue)[1])
+        return due
+
+    def reschedule(self, meeting_ids: List[str]):
+        due = self.clock() + self.interval
+        with self.lock:
+            for meeting_id in meeting_ids:
+                heapq.heappush(self.queue, (due, meeting_id))
+
+    def depth(self) -> int:
+        """
+        How many meetings are due now.
+        """
+        now = self.clock()
+        with self.lock:
+            return sum(1 for due, _ in self.queue if due <= now)
+
+    def seconds_until_due(self) -> Optional[float]:
+        with self.lock:
+            if not self.queue:
+                return None
+            return max(0.0, self.queue[0][0] - self.clock())
+
+
+class DaemonMetrics:
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started = clock()
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.failures = 0
+        self.synced_meetings = 0
+        self.new_instances = 0
+        self.uploads = 0
+        self.last_run = None
+        self.last_exit_code = None
+        self.durations = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def record_run(self, run_time: datetime.datetime, duration: float, exit_code: int, meetings: int,
+                   new_instances: int, uploaded: bool):
+        with self.lock:
+            self.runs += 1
+            self.failures += exit_code != 0
+            self.synced_meetings += meetings
+            self.new_instances += new_instances
+            self.uploads += uploaded
+            self.last_run = run_time
+            self.last_exit_code = exit_code
+            self.durations.append(duration)
+
+    @staticmethod
+    def percentile(durations: List[float], fraction: float) -> float:
+        if not durations:
+            return 0.0
+        return round(durations[min(len(durations) - 1, int(fraction * len(durations)))], 3)
+
+    def summary(self) -> Dict:
+        with self.lock:
+            durations = sorted(self.durations)
+            return {"uptime": round(self.clock() - self.started, 3),
+                    "runs": self.runs,
+                    "failures": self.failures,
+                    "synced_meetings": self.synced_meetings,
+                    "new_instances": self.new_instances,
+                    "uploads": self.uploads,
+                    "last_run": self.last_run.isoformat(timespec="seconds") if self.last_run else None,
+                    "last_exit_code": self.last_exit_code,
+                    "run_seconds": {"last": round(self.durations[-1], 3) if self.durations else 0.0,
+                                    "p50": self.percentile(durations, 0.5),
+                                    "p95": self.percentile(durations, 0.95),
+                                    "max": round(durations[-1], 3) if durations else 0.0}}
+
+
+class Daemon:
+    """
+    Syncs due meetings incrementally, then recomputes the report from the report cache and uploads it to one sheet,
+    only sending the cells that changed. Each run is recorded in ExecutionLog.
+    """
+    def __init__(self, db, zoom, google_helper, meeting_ids: List[str], interval: float = DEFAULT_INTERVAL,
+                 sheet_id: Optional[str] = None, clock=time.time):
+        self.db = db
+        self.zoom = zoom
+        self.google = google_helper
+        self.meeting_ids = [str(meeting_id) for meeting_id in meeting_ids]
+        self.sheet_id = sheet_id
+        self.data_fetcher = DataFetcher(db, zoom, incremental=True)
+        # The report only reads what the runs synced, so meetings that aren't due don't get synced with it
+        self.report_generator = ReportGenerator(self.data_fetcher, google_helper, from_cache=True, sync=False)
+        self.scheduler = Scheduler(interval, clock)
+        self.scheduler.load(self.meeting_ids)
+        self.metrics = DaemonMetrics(clock)
+        self.uploaded = False
+        self.stopping = threading.Event()
+        self.server = None
+
+    @traced("daemon run")
+    def run_once(self) -> Optional[int]:
+        """
+        Syncs the meetings that are due, returning the run's exit code, or None when nothing was due.
+        """
+        due = self.scheduler.pop_due()
+        if not due:
+            return None
+
+        run_time = datetime.datetime.now()
+        start = time.perf_counter()
+        exit_code = 0
+        new_instances = 0
+        uploaded = False
+        try:
+            for meeting_id in due:
+                try:
+                    self.data_fetcher.sync_meeting(meeting_id)
+                except Exception as e:
+                    print(f"Daemon: syncing meeting {meeting_id} failed: {e!r}")
+                    exit_code = 1
+            new_instances = MeetingInstance.select().where(MeetingInstance.ingested_at >= run_time).count()
+            tracer.count("daemon.new_instances", new_instances)
+            if new_instances or not self.uploaded:
+                self.upload()
+                uploaded = True
+        except Exception as e:
+            print(f"Daemon: run failed: {e!r}")
+            exit_code = 1
+        finally:
+            self.scheduler.reschedule(due)
+            duration = time.perf_counter() - start
+            ExecutionLog.create(run_time=run_time, exit_code=exit_code)
+            self.metrics.record_run(run_time, duration, exit_code, len(due), new_instances, uploaded)
+            print(f"Daemon: synced {len(due)} meetings in {duration:.3f}s, {new_instances} new instances, "
+                  f"exit code {exit_code}")
+        return exit_code
+
+    def upload(self):
+        report = self.report_generator.generate_report(self.meeting_ids)
+        values = self.report_generator.dataframe_to_array(report)
+        run_date = datetime.datetime.now().date().strftime('%Y-%m-%d')
+        if self.sheet_id is None:
+            # Keep updating the sheet created by the first upload
+            self.sheet_id = self.google.create_new_sheet(f"zoom_report_{run_date}",
+                                                         self.google.get_folder_id("CA Reports"))
+        self.report_generator.upload_report(values, run_date, self.sheet_id)
+        self.uploaded = True
+
+    def serve_forever(self, poll: float = 60):
+        """
+        Runs whatever is due until stop() is called, sleeping until the next meeting is due but at most poll seconds.
+        """
+        while not self.stopping.is_set():
+            self.run_once()
+            wait = self.scheduler.seconds_until_due()
+            self.stopping.wait(poll if wait is None else min(wait, poll))
+
+    def stop(self):
+        self.stopping.set()
+
+    def health(self):
+        """
+        Returns (HTTP status, body): 503 when the last run failed.
+        """
+        summary = self.metrics.summary()
+        if summary["last_exit_code"] is None:
+            status = "starting"
+        elif summary["last_exit_code"] == 0:
+            status = "ok"
+        else:
+            status = "failing"
+        return (503 if status == "failing" else 200), {"status": status, "last_run": summary["last_run"],
+                                                       "uptime": summary["uptime"]}
+
+    def metrics_summary(self) -> Dict:
+        return {**self.metrics.summary(),
+                "queue_depth": self.scheduler.depth(),
+                "next_due_in": self.scheduler.seconds_until_due(),
+                "meetings": len(self.meeting_ids),
+                "zoom": self.zoom.rate_limit_metrics(),
+                "connections": self.zoom.connection_metrics.summary(),
+                # Only counted while the daemon runs with ZOOM_TRACE set
+                "counters": tracer.counter_values() if tracer.enabled else None}
+
+    def route(self, path: str):
+        if path == "/health":
+            return self.health()
+        if path == "/metrics":
+            return 200, self.metrics_summary()
+        return 404, {"error": "not found"}
+
+    def start_server(self, port: int = DEFAULT_PORT, host: str = LOCALHOST):
+        self.server = start_server(json_handler(get=self.route), port, host)
+        return self.server
+
+    def close(self):
+        close_server(self.server)
+        self.zoom.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db")
+    parser.add_argument("meeting_ids_file", help="one meeting ID per line")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL,
+                        help="seconds between syncs of each meeting")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port of the /health and /metrics endpoint")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    trace_file = start_tracing_from_env()
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    with open(args.meeting_ids_file) as f:
+        meeting_ids = [line.strip() for line in f.read().splitlines() if line.strip()]
+
+    db = DbHelper(args.db)
+    zoom = ZoomHelper(ZOOM_URL, os.environ["ZOOM_API_KEY"], os.environ["ZOOM_API_SECRET"],
+                      response_cache=make_response_cache())
+    service_account_file = f".secrets/{os.listdir('.secrets')[0]}"
+    google_helper = GoogleHelper(service_account_file, ReportGenerator.SCOPES)
+    # Set ZOOM_SHEET_ID to update an existing sheet, otherwise the first upload creates one
+    daemon = Daemon(db, zoom, google_helper, meeting_ids, args.interval, os.environ.get("ZOOM_SHEET_ID"))
+
+    stop_on_signals(daemon.stop)
+    daemon.start_server(args.port)
+    print(f"Daemon: syncing {len(meeting_ids)} meetings every {args.interval}s, "
+          f"metrics on http://127.0.0.1:{args.port}/metrics")
+    try:
+        daemon.serve_forever()
+    finally:
+        daemon.close()
+        finish_tracing(trace_file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
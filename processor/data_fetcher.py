@@ -1,55 +1,209 @@
 import datetime
+import itertools
 
-from processor.model import Participant, MeetingInstance, Meeting, Attendance
+from peewee import chunked, fn, JOIN
+
+from processor.db_helper import BATCH_SIZE, batch_size
+from processor.instrumentation import tracer, traced
+from processor.engagement import interval_rows, INTERVAL_BATCH_SIZE
+from processor.model import Participant, MeetingInstance, Meeting, Attendance, AttendanceInterval, MeetingSyncState
+
+PARTICIPANT_BATCH_SIZE = batch_size(3)
+# uuid, meeting and start_time, plus the cached default peewee fills in
+INSTANCE_BATCH_SIZE = batch_size(4)
+
+
+def select_first_by(field, values, condition=None):
+    """
+    Maps each of the values to the first Participant (lowest id) whose field has that value.
+    """
+    result = {}
+    for batch in chunked(list(values), BATCH_SIZE):
+        query = Participant.select().where(field.in_(batch))
+        if condition is not None:
+            query = query.where(condition)
+        for participant in query.order_by(Participant.id):
+            result.setdefault(getattr(participant, field.name), participant)
+    return result
+
+
+class ParticipantIngest:
+    """
+    Stores the participants of a meeting instance one batch of records at a time.
+    The names and attendances already stored are carried across batches, so a participant
+    is only recorded once and only the current batch of records is held in memory.
+    """
+    def __init__(self, db, meeting_instance):
+        self.db = db
+        self.meeting_instance = meeting_instance
+        self.participants = []
+        self.participant_names = set()
+        self.attending = set(a.participant_id for a in
+                             Attendance.select(Attendance.participant)
+                                       .where(Attendance.meeting_instance == meeting_instance))
+        # Join/leave intervals are stored for every record, so ingesting an instance again replaces them
+        AttendanceInterval.delete().where(AttendanceInterval.meeting_instance == meeting_instance).execute()
+
+    def add(self, participants_json, intervals=True):
+        """
+        Stores a batch of participant records. Pass intervals=False for records that don't have a leave time yet,
+        and add their intervals once they do.
+        """
+        with tracer.span("ingest participants", records=len(participants_json)), self.db.db.atomic():
+            new_attendances = []
+            participants = DataFetcher.resolve_participants(participants_json, self.db.participant_index)
+            if intervals:
+                self.add_intervals(participants_json, participants)
+            for participant in participants:
+                if participant.name in self.participant_names:
+                    continue
+                self.participant_names.add(participant.name)
+                self.participants.append(participant)
+                if participant.id not in self.attending:
+                    self.attending.add(participant.id)
+                    new_attendances.append({'meeting_instance': self.meeting_instance.uuid,
+                                            'participant': participant.id})
+            for batch in chunked(new_attendances, BATCH_SIZE):
+                Attendance.insert_many(batch).execute()
+            tracer.count("rows.attendance_inserted", len(new_attendances))
+
+    def add_intervals(self, participants_json, participants):
+        for batch in chunked(interval_rows(self.meeting_instance, participants_json, participants),
+                             INTERVAL_BATCH_SIZE):
+            AttendanceInterval.insert_many(batch).execute()
+
+    def finish(self):
+        print(f"{len(self.participants)} unique participants.")
+        return self.participants
 
 
 class DataFetcher:
-    def __init__(self, db, zoom):
+    def __init__(self, db, zoom, incremental=False):
         self.db = db
         self.zoom = zoom
-        self.jwt_token = zoom.generate_jwt_token()
+        self.incremental = incremental
 
     def fetch_meeting_participants(self, meeting_instance):
         if not meeting_instance.cached:
+            tracer.count("cache.participants.miss")
             return self.fetch_meeting_participants_from_zoom(meeting_instance)
-        return Participant.select().join(Attendance).where(Attendance.meeting_instance == meeting_instance)
+        tracer.count("cache.participants.hit")
+        return (Participant.select()
+                           .join(Attendance)
+                           .where(Attendance.meeting_instance == meeting_instance)
+                           .order_by(Attendance.id))
 
     def fetch_meeting_participants_from_zoom(self, meeting_instance):
-        response = self.zoom.get_meeting_participants(meeting_instance.uuid, self.jwt_token)
-        if not response.ok:
-            print(f"Response failed with code {response.status_code} for meeting {meeting_instance.uuid}")
-            raise RuntimeError
-
-        participants_json = response.json().get("participants")
-
-        while token := response.json().get("next_page_token"):
-            response = self.zoom.get_meeting_participants(meeting_instance.uuid, self.jwt_token, token)
-            participants_json += response.json().get("participants")
+        # Pages are ingested as they arrive instead of being collected first
+        participants_json = self.zoom.iter_meeting_participants(meeting_instance.uuid)
+        return self.store_meeting_participants(meeting_instance, participants_json)
 
+    def store_meeting_participants(self, meeting_instance, participants_json):
         # Create Participants and store their Attendance
         participants = self.get_unique_participants(meeting_instance, participants_json)
+        self.mark_cached(meeting_instance)
+        return participants
 
-        # Cache the results
+    @staticmethod
+    def mark_cached(meeting_instance):
         meeting_instance.cached = True
+        meeting_instance.ingested_at = datetime.datetime.now()
         meeting_instance.save()
 
-        return participants
-
     def get_unique_participants(self, meeting_instance, participants_json):
-        participants = []
-        participant_names = set()
+        """
+        Resolves the participant records of a meeting instance, from a list or any iterable, in batches
+        of BATCH_SIZE: each batch takes a few set-based queries to create the missing Participants and
+        store their Attendance in one transaction.
+        Participants are resolved the same way as get_or_create_participant, and deduplicated by name.
+        """
+        ingest = ParticipantIngest(self.db, meeting_instance)
+        for batch in chunked(participants_json, BATCH_SIZE):
+            ingest.add(batch)
+        return ingest.finish()
+
+    @staticmethod
+    def resolve_participants(participants_json, index=None):
+        """
+        Returns the Participant for each record, in order, creating the ones that don't exist yet.
+        With a ParticipantIndex, known participants are resolved from memory and only the rest are queried.
+        """
+        emails = set(p["user_email"] for p in participants_json if p["user_email"] != "")
+        names = set(p["name"] for p in participants_json if p["user_email"] == "" and p["name"] != "")
+        user_ids = set(p["id"] for p in participants_json if p["user_email"] == "" and p["name"] == "")
+
+        by_email = DataFetcher.first_by(index, Participant.email, emails)
+        by_name = DataFetcher.first_by(index, Participant.name, names)
+        by_user_id = DataFetcher.first_by(index, Participant.user_id, user_ids,
+                                          (Participant.name == "") & (Participant.email == ""))
+
+        # Resolve every record in memory, creating placeholders for the missing participants
+        resolved = []
+        created = []
         for p in participants_json:
-            participant, created = self.get_or_create_participant(p)
-            if created:
-                print(f"Found a new participant: {participant.name}: {participant.email}")
-            if participant.name not in participant_names:
-                participant_names.add(participant.name)
-                participants.append(participant)
-                Attendance.get_or_create(meeting_instance=meeting_instance,
-                                         participant=participant)
-
-        print(f"{len(participants)} unique participants.")
-        return participants
+            if p["user_email"] != "":
+                # Detect name changes by same email
+                participant = by_email.get(p["user_email"])
+                if participant is None:
+                    participant = Participant(user_id=p["id"], name=p["name"], email=p["user_email"])
+                    by_email[participant.email] = participant
+                    by_name.setdefault(participant.name, participant)
+                    created.append(participant)
+            elif p["name"] != "":
+                # If no email, fallback to just the name
+                participant = by_name.get(p["name"])
+                if participant is None:
+                    participant = Participant(user_id=p["id"], name=p["name"], email=p["user_email"])
+                    by_name[participant.name] = participant
+                    created.append(participant)
+            else:
+                participant = by_user_id.get(p["id"])
+                if participant is None:
+                    participant = Participant(user_id=p["id"], name=p["name"], email=p["user_email"])
+                    by_user_id[participant.user_id] = participant
+                    created.append(participant)
+            resolved.append(participant)
+
+        if created:
+            DataFetcher.insert_participants(created, index)
+        return resolved
+
+    @staticmethod
+    def first_by(index, field, values, condition=None):
+        """
+        Same as select_first_by, answered from the index where it can be.
+        """
+        if index is None:
+            return select_first_by(field, values, condition)
+        result, missing = index.first_by(field.name, values)
+        if missing:
+            found = select_first_by(field, missing, condition)
+            index.add(found.values())
+            result.update(found)
+        return result
+
+    @staticmethod
+    def insert_participants(participants, index=None):
+        rows = [{'user_id': p.user_id, 'name': p.name, 'email': p.email} for p in participants]
+        for batch in chunked(rows, PARTICIPANT_BATCH_SIZE):
+            Participant.insert_many(batch).execute()
+        tracer.count("rows.participant_inserted", len(rows))
+
+        # Read back the ids of the new rows, using the same keys they were resolved by
+        with_email = {p.email: p for p in participants if p.email != ""}
+        with_name = {p.name: p for p in participants if p.email == "" and p.name != ""}
+        blank = {p.user_id: p for p in participants if p.email == "" and p.name == ""}
+        for key, placeholders, condition in [
+                (Participant.email, with_email, None),
+                (Participant.name, with_name, Participant.email == ""),
+                (Participant.user_id, blank, (Participant.name == "") & (Participant.email == ""))]:
+            for value, participant in select_first_by(key, placeholders.keys(), condition).items():
+                placeholders[value].id = participant.id
+        if index is not None:
+            index.add(participants)
+
+        for p in participants:
+            print(f"Found a new participant: {p.name}: {p.email}")
 
     @staticmethod
     def get_or_create_participant(participant):
@@ -70,16 +224,21 @@ class DataFetcher:
     def fetch_meeting_details(self, meeting_id):
         meeting = Meeting.get_or_none(Meeting.meeting_id == meeting_id)
         if meeting is None:
+            tracer.count("cache.meeting_details.miss")
             return self.fetch_meeting_details_from_zoom(meeting_id)
+        tracer.count("cache.meeting_details.hit")
         return meeting
 
     def fetch_meeting_details_from_zoom(self, meeting_id):
-        response = self.zoom.get_meeting_details(meeting_id, self.jwt_token)
+        response = self.zoom.get_meeting_details(meeting_id)
         if not response.ok:
             print(f"Response failed with code {response.status_code} for meeting {meeting_id}")
             raise RuntimeError
 
-        topic = response.json().get("topic")
+        return self.store_meeting_details(meeting_id, response.json().get("topic"))
+
+    @staticmethod
+    def store_meeting_details(meeting_id, topic):
         meeting, created = Meeting.get_or_create(meeting_id=meeting_id, topic=topic)
 
         print(f"Topic: {topic} participants.")
@@ -94,19 +253,113 @@ class DataFetcher:
         return MeetingInstance.select().where(MeetingInstance.meeting == meeting)
 
     def fetch_past_meeting_instances(self, meeting):
-        response = self.zoom.get_past_meeting_instances(meeting.meeting_id, self.jwt_token)
+        response = self.zoom.get_past_meeting_instances(meeting.meeting_id)
         if not response.ok:
             print(f"Response failed with code {response.status_code} for meeting {meeting.meeting_id}")
             raise RuntimeError
 
-        meetings = response.json().get("meetings")
+        return self.store_past_meeting_instances(meeting, response.json().get("meetings"))
+
+    def store_past_meeting_instances(self, meeting, meetings):
+        if self.incremental:
+            return self.store_new_past_meeting_instances(meeting, meetings)
+
         meeting_instances = []
         for m in meetings:
             start_time_str = m["start_time"]
             start_time = datetime.datetime.strptime(start_time_str, '%Y-%m-%dT%H:%M:%SZ')
             mi, created = MeetingInstance.get_or_create(uuid=m["uuid"], meeting=meeting,
                                                         defaults={'start_time': start_time})
+            tracer.count("rows.meeting_instance_inserted", created)
             meeting_instances.append(mi)
 
         print(f"Found {len(meetings)} meeting instances for {meeting.meeting_id}")
         return meeting_instances
+
+    def store_new_past_meeting_instances(self, meeting, meetings):
+        """
+        Only stores the instances that started at or after the Meeting's sync watermark,
+        then returns every known instance of the Meeting from the DB.
+        """
+        state, _ = MeetingSyncState.get_or_create(meeting=meeting)
+        watermark = state.last_start_time
+
+        start_times = {m["uuid"]: datetime.datetime.strptime(m["start_time"], '%Y-%m-%dT%H:%M:%SZ')
+                       for m in meetings}
+        # Instances sharing the watermark's start time may still be new, known UUIDs are filtered below
+        candidates = {uuid: start_time for uuid, start_time in start_times.items()
+                      if watermark is None or start_time >= watermark}
+
+        with self.db.db.atomic():
+            known = set()
+            for batch in chunked(list(candidates), BATCH_SIZE):
+                known.update(uuid for uuid, in MeetingInstance.select(MeetingInstance.uuid)
+                                                              .where(MeetingInstance.uuid.in_(batch))
+                                                              .tuples())
+            new_instances = [{'uuid': uuid, 'meeting': meeting.meeting_id, 'start_time': start_time}
+                             for uuid, start_time in candidates.items() if uuid not in known]
+            for batch in chunked(new_instances, INSTANCE_BATCH_SIZE):
+                MeetingInstance.insert_many(batch).execute()
+            tracer.count("rows.meeting_instance_inserted", len(new_instances))
+
+            latest = max(start_times.values(), default=None)
+            if latest is not None and (watermark is None or latest > watermark):
+                state.last_start_time = latest
+            state.last_synced = datetime.datetime.now()
+            state.save()
+
+        print(f"Found {len(new_instances)} new of {len(meetings)} meeting instances for {meeting.meeting_id}")
+        return list(self.fetch_past_meeting_instances_cached(meeting).order_by(MeetingInstance.start_time))
+
+    @traced("sync meeting")
+    def sync_meeting(self, meeting_id):
+        """
+        Makes sure the DB has every instance of the meeting and their participants, without keeping them around.
+        """
+        meeting = self.fetch_meeting_details(meeting_id)
+        for meeting_instance in self.fetch_past_meeting_instances(meeting):
+            if not meeting_instance.cached:
+                self.fetch_meeting_participants_from_zoom(meeting_instance)
+        return meeting
+
+    @staticmethod
+    @traced("fetch attendance counts")
+    def fetch_attendance_counts(meeting_ids):
+        """
+        Returns (meeting_id, start_time, attendance count) for every stored instance of the meetings,
+        ordered by meeting and start time, computed with a single GROUP BY that walks
+        the (meeting, start_time) index.
+        """
+        counts = []
+        for batch in chunked([str(m) for m in meeting_ids], BATCH_SIZE):
+            query = (MeetingInstance
+                     .select(MeetingInstance.meeting, MeetingInstance.start_time, fn.COUNT(Attendance.id))
+                     .join(Attendance, JOIN.LEFT_OUTER)
+                     .where(MeetingInstance.meeting.in_(batch))
+                     .group_by(MeetingInstance.meeting, MeetingInstance.start_time, MeetingInstance.uuid)
+                     .order_by(MeetingInstance.meeting, MeetingInstance.start_time, MeetingInstance.uuid))
+            counts.extend(query.tuples())
+        return counts
+
+    @staticmethod
+    @traced("fetch attendance names")
+    def fetch_attendance_names(meeting_ids, separator=", "):
+        """
+        Returns (meeting_id, start_time, participant names) for every stored instance of the meetings,
+        ordered by meeting and start time, with the names joined in the order they were recorded.
+        """
+        names = []
+        for batch in chunked([str(m) for m in meeting_ids], BATCH_SIZE):
+            query = (MeetingInstance
+                     .select(MeetingInstance.meeting, MeetingInstance.start_time, MeetingInstance.uuid,
+                             Participant.name)
+                     .join(Attendance, JOIN.LEFT_OUTER)
+                     .join(Participant, JOIN.LEFT_OUTER)
+                     .where(MeetingInstance.meeting.in_(batch))
+                     .order_by(MeetingInstance.meeting, MeetingInstance.start_time, MeetingInstance.uuid,
+                               Attendance.id))
+            # Rows arrive grouped by instance, so only one instance's names are held at a time
+            for (meeting_id, start_time, _), rows in itertools.groupby(query.tuples().iterator(),
+                                                                       key=lambda row: row[:3]):
+                names.append((meeting_id, start_time, separator.join(row[3] for row in rows if row[3] is not None)))
+        return names
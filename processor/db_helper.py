@@ -1,17 +1,120 @@
+import datetime
+
 from peewee import *
 import processor.model as m
+from processor.instrumentation import tracer
+from processor.participant_index import ParticipantIndex
 
 TABLES = [m.Meeting,
           m.MeetingInstance,
+          m.MeetingSyncState,
+          m.ReportCell,
+          m.ReportSummary,
           m.Attendance,
+          m.AttendanceInterval,
+          m.AttendanceBitmap,
+          m.AttendanceBitmapState,
           m.Participant,
           m.ExecutionLog,
+          m.BackfillCheckpoint,
+          m.SheetSnapshot,
           ]
 
+PRAGMAS = {
+    'journal_mode': 'wal',
+    # Safe with WAL, only the last transactions can be lost on power failure
+    'synchronous': 'normal',
+    # Negative values are in KiB, so 64MB
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+}
+
+# Bound variables per statement, well under the 999 SQLite allowed before 3.32
+MAX_VARIABLES = 600
+
+
+def batch_size(columns: int) -> int:
+    """
+    How many rows of an insert, or values of an IN list, fit in one statement when each takes `columns` variables.
+    """
+    return MAX_VARIABLES // columns
+
+
+# Most statements bind two values per row, e.g. an attendance's instance and participant
+BATCH_SIZE = batch_size(2)
+
+
+def dedupe_attendances(db):
+    """
+    Attendance gets a unique index on (meeting_instance, participant), so drop any duplicates first.
+    """
+    if db.table_exists(m.Attendance._meta.table_name):
+        db.execute_sql("DELETE FROM attendance WHERE id NOT IN "
+                       "(SELECT MIN(id) FROM attendance GROUP BY meeting_instance_id, participant_id)")
+
+
+def add_ingested_at(db):
+    """
+    MeetingInstance.ingested_at tells the report cache which instances changed since it was last refreshed.
+    Instances cached before it existed count as ingested now.
+    """
+    if db.table_exists(m.MeetingInstance._meta.table_name):
+        db.execute_sql("ALTER TABLE meetinginstance ADD COLUMN ingested_at DATETIME")
+        db.execute_sql("UPDATE meetinginstance SET ingested_at = ? WHERE cached = 1", (datetime.datetime.now(),))
+
+
+# Each migration upgrades an existing database by one schema version, tracked in PRAGMA user_version
+MIGRATIONS = [dedupe_attendances,
+              add_ingested_at,
+              ]
+
+
+class InstrumentedSqliteDatabase(SqliteDatabase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Called after a transaction or savepoint is rolled back, to drop state derived from its writes
+        self.rollback_hooks = []
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        if not tracer.enabled:
+            cursor = super().execute_sql(sql, params, *args, **kwargs)
+        else:
+            tracer.count("db.queries")
+            with tracer.span(f"sql {sql.split(None, 1)[0].upper()}", "db"):
+                cursor = super().execute_sql(sql, params, *args, **kwargs)
+        if sql.startswith("ROLLBACK"):
+            self.rolled_back()
+        return cursor
+
+    def rollback(self):
+        super().rollback()
+        self.rolled_back()
+
+    def rolled_back(self):
+        for hook in self.rollback_hooks:
+            hook()
+
 
 class DbHelper:
     def __init__(self, db_name):
-        self.db = SqliteDatabase(db_name)
+        self.db = InstrumentedSqliteDatabase(db_name, pragmas=PRAGMAS)
         self.db.connect()
         self.db.bind(TABLES)
+        self.participant_index = ParticipantIndex(self.db)
+        self.migrate()
         self.db.create_tables(TABLES)
+
+    def migrate(self):
+        version = self.db.pragma('user_version')
+        if version >= len(MIGRATIONS):
+            return
+        if not self.db.get_tables():
+            # A new database gets the current schema from create_tables
+            self.db.pragma('user_version', len(MIGRATIONS))
+            return
+        with self.db.atomic():
+            for migration in MIGRATIONS[version:]:
+                print(f"Migrating database: {migration.__name__}")
+                migration(self.db)
+            self.db.pragma('user_version', len(MIGRATIONS))
@@ -0,0 +1,189 @@
+import itertools
+from typing import Dict, List
+
+import numpy as np
+from peewee import chunked
+
+from processor.db_helper import BATCH_SIZE, batch_size
+from processor.instrumentation import traced
+from processor.model import AttendanceInterval, MeetingInstance
+
+INTERVAL_BATCH_SIZE = batch_size(4)
+
+
+def to_epoch_seconds(times: List[str]) -> np.ndarray:
+    """
+    Zoom's UTC timestamps, like 2020-08-01T18:06:45Z, as epoch seconds.
+    """
+    return np.array([t.rstrip("Z") for t in times], dtype="datetime64[s]").astype(np.int64)
+
+
+def interval_rows(meeting_instance, participants_json, participants) -> List[Dict]:
+    """
+    AttendanceInterval rows for participant records and the Participants they resolved to.
+    Records without a join_time are skipped, and a missing leave_time is taken from the duration.
+    """
+    timed = [(record, participant) for record, participant in zip(participants_json, participants)
+             if record.get("join_time")]
+    if not timed:
+        return []
+    start = np.datetime64(meeting_instance.start_time, "s").astype(np.int64)
+    joins = to_epoch_seconds([record["join_time"] for record, _ in timed])
+    leaves = to_epoch_seconds([record.get("leave_time") or record["join_time"] for record, _ in timed])
+    durations = np.array([0 if record.get("leave_time") else record.get("duration") or 0 for record, _ in timed])
+    joins -= start
+    leaves = np.maximum(leaves + durations - start, joins)
+    return [{'meeting_instance': meeting_instance.uuid, 'participant': participant.id,
+             'join_offset': join, 'leave_offset': leave}
+            for (_, participant), join, leave in zip(timed, joins.tolist(), leaves.tolist())]
+
+
+class Intervals:
+    """
+    Attendance intervals as parallel arrays. instances holds positions in uuids.
+    """
+    def __init__(self, uuids: List[str], instances: np.ndarray, participants: np.ndarray,
+                 joins: np.ndarray, leaves: np.ndarray):
+        self.uuids = uuids
+        self.instances = instances
+        self.participants = participants
+        self.joins = joins
+        self.leaves = leaves
+
+    def __len__(self):
+        return len(self.joins)
+
+    @classmethod
+    def from_rows(cls, uuids: List[str], rows) -> "Intervals":
+        """
+        From an iterable of (instance position, participant id, join offset, leave offset) rows,
+        packed straight into an array without building a list of them.
+        """
+        columns = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64).reshape(-1, 4)
+        return cls(uuids, columns[:, 0], columns[:, 1], columns[:, 2], columns[:, 3])
+
+
+@traced("fetch intervals")
+def fetch_intervals(meeting_instance_uuids) -> Intervals:
+    uuids = list(dict.fromkeys(str(uuid) for uuid in meeting_instance_uuids))
+    positions = {uuid: i for i, uuid in enumerate(uuids)}
+    queries = (AttendanceInterval
+               .select(AttendanceInterval.meeting_instance, AttendanceInterval.participant,
+                       AttendanceInterval.join_offset, AttendanceInterval.leave_offset)
+               .where(AttendanceInterval.meeting_instance.in_(batch))
+               .tuples()
+               .iterator()
+               for batch in chunked(uuids, BATCH_SIZE))
+    rows = ((positions[uuid], participant, join, leave)
+            for uuid, participant, join, leave in itertools.chain.from_iterable(queries))
+    return Intervals.from_rows(uuids, rows)
+
+
+def group_starts(*keys: np.ndarray) -> np.ndarray:
+    """
+    For arrays sorted by keys, marks the first row of each run of equal keys.
+    """
+    starts = np.zeros(len(keys[0]), dtype=bool)
+    if len(starts):
+        starts[0] = True
+        for key in keys:
+            starts[1:] |= key[1:] != key[:-1]
+    return starts
+
+
+@traced("merge intervals")
+def merge_intervals(intervals: Intervals) -> Intervals:
+    """
+    Merges each participant's overlapping or touching intervals within an instance, so someone who dropped off
+    and rejoined while still shown as present counts once. The result is sorted by instance, participant and join.
+    """
+    order = np.lexsort((intervals.joins, intervals.participants, intervals.instances))
+    instances = intervals.instances[order]
+    participants = intervals.participants[order]
+    joins = intervals.joins[order]
+    leaves = intervals.leaves[order]
+    if not len(joins):
+        return Intervals(intervals.uuids, instances, participants, joins, leaves)
+
+    # The latest leave so far within each (instance, participant) group. Lifting every group above the
+    # previous one lets a single running maximum over the whole array stay within groups.
+    new_group = group_starts(instances, participants)
+    group = np.cumsum(new_group) - 1
+    low = min(int(joins.min()), int(leaves.min()))
+    span = int(leaves.max()) - low + 1
+    lifted = group * span + (leaves - low)
+    latest_leave = np.maximum.accumulate(lifted) - group * span + low
+
+    starts = new_group.copy()
+    starts[1:] |= joins[1:] > latest_leave[:-1]
+    first = np.flatnonzero(starts)
+    return Intervals(intervals.uuids, instances[first], participants[first], joins[first],
+                     np.maximum.reduceat(leaves, first))
+
+
+def seconds_attended(merged: Intervals):
+    """
+    From merged intervals, returns (instances, participants, seconds) with one entry per participant per instance.
+    """
+    first = np.flatnonzero(group_starts(merged.instances, merged.participants))
+    if not len(first):
+        return merged.instances, merged.participants, merged.joins
+    return (merged.instances[first], merged.participants[first],
+            np.add.reduceat(merged.leaves - merged.joins, first))
+
+
+def peak_concurrency(merged: Intervals):
+    """
+    Sweeps over the join and leave events of merged intervals. Returns (instances, peaks): the most participants
+    present at once in each instance that has intervals. Someone leaving at the second another joins isn't
+    counted as overlapping them.
+    """
+    if not len(merged):
+        return merged.instances, merged.instances
+    instances = np.concatenate([merged.instances, merged.instances])
+    times = np.concatenate([merged.joins, merged.leaves])
+    deltas = np.concatenate([np.ones(len(merged), dtype=np.int64), -np.ones(len(merged), dtype=np.int64)])
+    # Leaves sort before joins at the same time
+    order = np.lexsort((deltas, times, instances))
+    instances = instances[order]
+    # Every instance's events add up to zero, so the running count starts from zero in each
+    present = np.cumsum(deltas[order])
+    first = np.flatnonzero(group_starts(instances))
+    return instances[first], np.maximum.reduceat(present, first)
+
+
+@traced("engagement metrics")
+def engagement_metrics(intervals: Intervals) -> Dict[str, Dict]:
+    """
+    Per meeting instance uuid: attendees with an interval, total and average minutes attended,
+    and peak concurrent attendance.
+    """
+    merged = merge_intervals(intervals)
+    instances, _, seconds = seconds_attended(merged)
+    attendees = np.bincount(instances, minlength=len(intervals.uuids))
+    total_seconds = np.bincount(instances, weights=seconds, minlength=len(intervals.uuids))
+    peaks = np.zeros(len(intervals.uuids), dtype=np.int64)
+    peak_instances, peak_values = peak_concurrency(merged)
+    peaks[peak_instances] = peak_values
+
+    metrics = {}
+    for i, uuid in enumerate(intervals.uuids):
+        minutes = total_seconds[i] / 60
+        metrics[uuid] = {"attendees": int(attendees[i]),
+                         "minutes": round(float(minutes), 2),
+                         "average_minutes": round(float(minutes / attendees[i]), 2) if attendees[i] else 0.0,
+                         "peak_concurrent": int(peaks[i])}
+    return metrics
+
+
+def fetch_engagement(meeting_ids) -> Dict[str, Dict]:
+    """
+    engagement_metrics for every stored instance of the meetings.
+    """
+    uuids = []
+    for batch in chunked([str(m) for m in meeting_ids], BATCH_SIZE):
+        uuids.extend(uuid for uuid, in MeetingInstance.select(MeetingInstance.uuid)
+                                                      .where(MeetingInstance.meeting.in_(batch))
+                                                      .order_by(MeetingInstance.meeting, MeetingInstance.start_time)
+                                                      .tuples())
+    return engagement_metrics(fetch_intervals(uuids))
@@ -0,0 +1,143 @@
+import csv
+import itertools
+import os
+
+from peewee import chunked
+
+from processor.db_helper import BATCH_SIZE
+from processor.instrumentation import tracer, traced
+from processor.model import Attendance, Meeting, MeetingInstance, Participant
+
+CSV = "csv"
+PARQUET = "parquet"
+ARROW = "arrow"
+FORMATS = [CSV, PARQUET, ARROW]
+# Rows per Parquet row group / Arrow record batch, and per read from SQLite
+CHUNK_SIZE = 50000
+FACT_COLUMNS = ["meeting_id", "topic", "meeting_instance", "start_time",
+                "participant_id", "participant_name", "participant_email"]
+
+
+def load_pyarrow():
+    """
+    pyarrow is optional: returns the module, or None when it isn't installed.
+    """
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def export_path(path, fmt):
+    return f"{os.path.splitext(path)[0]}.{fmt}"
+
+
+class Exporter:
+    """
+    Writes reports for analysis outside of Sheets: the attendance matrix as it is uploaded, and a long-format
+    fact table with one row per (meeting, instance, participant).
+    Parquet and Arrow need pyarrow. Without it, exports fall back to CSV with a warning.
+    """
+    def __init__(self, fmt=CSV, chunk_size=CHUNK_SIZE):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown export format {fmt}, expected one of {', '.join(FORMATS)}")
+        self.pyarrow = load_pyarrow() if fmt != CSV else None
+        if fmt != CSV and self.pyarrow is None:
+            print(f"pyarrow is not installed, exporting CSV instead of {fmt}")
+            fmt = CSV
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+
+    @traced("export report")
+    def export_report(self, df, path):
+        """
+        Writes a report DataFrame, indexed by meeting id, and returns the path written.
+        """
+        path = export_path(path, self.fmt)
+        if self.fmt == CSV:
+            df.to_csv(path, index=True, header=True)
+            return path
+
+        pa = self.pyarrow
+        # Parquet and Arrow need string column names and one type per column
+        df = df.rename(columns=str)
+        df.index = df.index.astype(str)
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        if self.fmt == PARQUET:
+            pa.parquet.write_table(table, path)
+        else:
+            with pa.ipc.new_file(path, table.schema) as writer:
+                writer.write_table(table)
+        return path
+
+    @traced("export facts")
+    def export_facts(self, meeting_ids, path):
+        """
+        Streams one row per attendance of the meetings, ordered by meeting, instance start time and
+        recording order, to path. At most chunk_size rows are held in memory. Returns the path written
+        and the number of rows.
+        """
+        path = export_path(path, self.fmt)
+        chunks = self.fact_chunks(meeting_ids)
+        if self.fmt == CSV:
+            rows = self.write_csv(path, chunks)
+        else:
+            rows = self.write_arrow(path, chunks)
+        tracer.count("export.fact_rows", rows)
+        print(f"Exported {rows} attendance rows to {path}")
+        return path, rows
+
+    def fact_chunks(self, meeting_ids):
+        """
+        Yields lists of up to chunk_size fact rows, read from a SQLite cursor as they are needed.
+        """
+        for batch in chunked([str(m) for m in dict.fromkeys(meeting_ids)], BATCH_SIZE):
+            query = (Attendance
+                     .select(Meeting.meeting_id, Meeting.topic, MeetingInstance.uuid, MeetingInstance.start_time,
+                             Participant.id, Participant.name, Participant.email)
+                     .join(MeetingInstance)
+                     .join(Meeting)
+                     .switch(Attendance)
+                     .join(Participant)
+                     .where(MeetingInstance.meeting.in_(batch))
+                     .order_by(Meeting.meeting_id, MeetingInstance.start_time, MeetingInstance.uuid,
+                               Attendance.id))
+            rows = query.tuples().iterator()
+            while True:
+                chunk = list(itertools.islice(rows, self.chunk_size))
+                if not chunk:
+                    break
+                yield chunk
+
+    @staticmethod
+    def write_csv(path, chunks):
+        rows = 0
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(FACT_COLUMNS)
+            for chunk in chunks:
+                writer.writerows(chunk)
+                rows += len(chunk)
+        return rows
+
+    def write_arrow(self, path, chunks):
+        pa = self.pyarrow
+        schema = pa.schema([("meeting_id", pa.string()), ("topic", pa.string()),
+                            ("meeting_instance", pa.string()), ("start_time", pa.timestamp("s")),
+                            ("participant_id", pa.int64()), ("participant_name", pa.string()),
+                            ("participant_email", pa.string())])
+        if self.fmt == PARQUET:
+            writer = pa.parquet.ParquetWriter(path, schema)
+        else:
+            writer = pa.ipc.new_file(path, schema)
+        rows = 0
+        with writer:
+            for chunk in chunks:
+                columns = dict(zip(FACT_COLUMNS, (list(column) for column in zip(*chunk))))
+                writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+                rows += len(chunk)
+        return rows
+
@@ -1,21 +1,35 @@
+from functools import cached_property
 from typing import List
 import json
 
-from google.oauth2 import service_account
-from googleapiclient import discovery
-from googleapiclient.errors import HttpError
-from pandas import DataFrame
+from processor.sheets_writer import SheetsWriter
 
 
 class GoogleHelper:
+    """
+    The Google client libraries and the discovery clients are loaded the first time they are used,
+    so runs that don't upload anything don't pay for them.
+    """
     def __init__(self, service_account_file: str, scopes: List[str]):
         self.service_account_file = service_account_file
         self.scopes = scopes
         self.google_sheet_type = "application/vnd.google-apps.spreadsheet"
-        self.creds = service_account.Credentials.from_service_account_file(self.service_account_file,
-                                                                           scopes=self.scopes)
-        self.drive = discovery.build("drive", "v3", credentials=self.creds)
-        self.sheets = discovery.build("sheets", "v4", credentials=self.creds)
+
+    @cached_property
+    def creds(self):
+        from google.oauth2 import service_account
+        return service_account.Credentials.from_service_account_file(self.service_account_file,
+                                                                     scopes=self.scopes)
+
+    @cached_property
+    def drive(self):
+        from googleapiclient import discovery
+        return discovery.build("drive", "v3", credentials=self.creds)
+
+    @cached_property
+    def sheets(self):
+        from googleapiclient import discovery
+        return discovery.build("sheets", "v4", credentials=self.creds)
 
     def get_folder_id(self, folder_name: str) -> str:
         folders: dict = self.drive.files().list(q="mimeType='application/vnd.google-apps.folder'").execute()
@@ -38,6 +52,8 @@ class GoogleHelper:
         return new_sheet.get("id")
 
     def create_new_sheet_helper(self, new_sheet_metadata):
+        from googleapiclient.errors import HttpError
+
         print(new_sheet_metadata)
         try:
             return self.drive.files().create(body=new_sheet_metadata).execute()
@@ -47,16 +63,12 @@ class GoogleHelper:
                 print(reason)
             raise err
 
-    def insert_df_to_sheet(self, google_sheet_id: str, values: List) -> dict:
-        response = self.sheets.spreadsheets().values().append(
-                spreadsheetId=google_sheet_id,
-                valueInputOption="RAW",
-                range="A1",
-                body={"majorDimension": "ROWS",
-                      "values": values}
-        ).execute()
-
-        return response
+    def write_values(self, google_sheet_id: str, values: List, keep_snapshot: bool = True) -> dict:
+        """
+        Writes values to the sheet starting at A1, only sending the cells that changed since the last write.
+        Pass keep_snapshot=False for a sheet that won't be written again.
+        """
+        return SheetsWriter(self.sheets).write(google_sheet_id, values, keep_snapshot)
 
     def get_sheet_link(self, google_sheet_id: str,
                        return_all_fields: bool = False, fields_to_return: str = "webViewLink"):
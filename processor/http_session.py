@@ -0,0 +1,92 @@
+import socket
+import threading
+import time
+from typing import Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Connection setup timings of the request currently being sent on this thread
+_connection_timings = threading.local()
+
+
+def reset_connection_timings():
+    _connection_timings.value = {"dns": 0.0, "connect": 0.0, "tls": 0.0}
+
+
+def get_connection_timings() -> Dict[str, float]:
+    """
+    Returns the DNS, TCP connect and TLS handshake times spent by the current thread since the last reset.
+    They're all zero when the request reused a pooled connection.
+    """
+    return dict(getattr(_connection_timings, "value", {"dns": 0.0, "connect": 0.0, "tls": 0.0}))
+
+
+def record_connection_timing(phase: str, seconds: float):
+    if not hasattr(_connection_timings, "value"):
+        reset_connection_timings()
+    _connection_timings.value[phase] += seconds
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        start = time.perf_counter()
+        try:
+            address = socket.getaddrinfo(self._dns_host, self.port, type=socket.SOCK_STREAM)[0][4][0]
+        except socket.gaierror:
+            # Let urllib3 resolve the name again and raise its own error
+            return super()._new_conn()
+        record_connection_timing("dns", time.perf_counter() - start)
+
+        # Connect straight to the resolved address, so the DNS lookup isn't counted twice
+        dns_host = self._dns_host
+        start = time.perf_counter()
+        try:
+            self._dns_host = address
+            sock = super()._new_conn()
+        except OSError:
+            self._dns_host = dns_host
+            sock = super()._new_conn()
+        finally:
+            self._dns_host = dns_host
+        record_connection_timing("connect", time.perf_counter() - start)
+        return sock
+
+
+class TimedHTTPSConnection(HTTPSConnection, TimedHTTPConnection):
+    def connect(self):
+        before = get_connection_timings()
+        start = time.perf_counter()
+        super().connect()
+        after = get_connection_timings()
+        setup = (after["dns"] - before["dns"]) + (after["connect"] - before["connect"])
+        record_connection_timing("tls", time.perf_counter() - start - setup)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    Keep-alive connection pool whose new connections record their DNS, connect and TLS times.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool,
+                                                   "https": TimedHTTPSConnectionPool}
+
+
+def make_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate"})
+    return session
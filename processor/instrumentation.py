@@ -0,0 +1,196 @@
+import collections
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class Span:
+    def __init__(self, tracer, name: str, category: str, args: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.tracer.record(self.name, self.category, self.start, time.perf_counter() - self.start, self.args)
+        return False
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class SpanStats:
+    def __init__(self, category: str):
+        self.category = category
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+
+class Tracer:
+    """
+    Records span timings and counters for HTTP calls, DB queries and report stages.
+    Disabled by default, in which case span() and count() return right away.
+    """
+    def __init__(self, max_events: int = 200000):
+        self.enabled = False
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.origin = time.perf_counter()
+            self.events = []
+            self.dropped_events = 0
+            self.stats: Dict[str, SpanStats] = {}
+            self.counters = collections.Counter()
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def span(self, name: str, category: str = "stage", **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, args)
+
+    def count(self, name: str, n: int = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += n
+
+    def counter_values(self) -> Dict[str, int]:
+        """
+        A copy of the counters, safe to read while other threads keep counting.
+        """
+        with self.lock:
+            return dict(self.counters)
+
+    def record(self, name: str, category: str, start: float, duration: float, args: Dict):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = SpanStats(category)
+            stats.add(duration)
+            if len(self.events) < self.max_events:
+                self.events.append((name, category, start - self.origin, duration, threading.get_ident(), args))
+            else:
+                self.dropped_events += 1
+
+    @staticmethod
+    def peak_memory() -> int:
+        """
+        Peak resident memory of the process in bytes, or 0 where it isn't available.
+        """
+        if resource is None:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    def write_trace(self, path: str):
+        """
+        Writes the spans in Chrome's trace event format, which chrome://tracing and Perfetto can open,
+        along with the counters and span totals.
+        """
+        pid = os.getpid()
+        with self.lock:
+            trace = {
+                "traceEvents": [{"name": name, "cat": category, "ph": "X",
+                                 "ts": round(start * 1e6, 1), "dur": round(duration * 1e6, 1),
+                                 "pid": pid, "tid": tid, "args": args}
+                                for name, category, start, duration, tid, args in self.events],
+                "displayTimeUnit": "ms",
+                "spans": {name: {"category": s.category, "count": s.count,
+                                 "total_s": round(s.total, 6), "max_s": round(s.max, 6)}
+                          for name, s in self.stats.items()},
+                "counters": dict(self.counters),
+                "dropped_events": self.dropped_events,
+                "peak_memory_bytes": self.peak_memory(),
+                "wall_time_s": round(time.perf_counter() - self.origin, 6),
+            }
+        with open(path, "w") as f:
+            json.dump(trace, f, default=str)
+
+    def summary(self) -> str:
+        with self.lock:
+            lines = [f"{'span':<40}{'category':<10}{'count':>8}{'total s':>12}{'mean ms':>10}{'max ms':>10}"]
+            for name, s in sorted(self.stats.items(), key=lambda item: -item[1].total):
+                lines.append(f"{name:<40}{s.category:<10}{s.count:>8}{s.total:>12.3f}"
+                             f"{s.total / s.count * 1000:>10.2f}{s.max * 1000:>10.2f}")
+            lines.append("")
+            lines.append(f"{'counter':<50}{'value':>10}")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"{name:<50}{value:>10}")
+            lines.append("")
+            lines.append(f"wall time {time.perf_counter() - self.origin:.3f}s, "
+                         f"peak memory {self.peak_memory() / 2 ** 20:.1f} MB")
+            return "\n".join(lines)
+
+
+# The process-wide tracer every component reports to
+tracer = Tracer()
+
+
+def traced(name: str, category: str = "stage"):
+    """
+    Decorator recording a span around every call of the function while the tracer is enabled.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return f(*args, **kwargs)
+            with tracer.span(name, category):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_tracing_from_env():
+    """
+    Set ZOOM_TRACE=<file> to record a trace of the run. Returns the trace file, or None when tracing is off.
+    """
+    trace_file = os.environ.get("ZOOM_TRACE")
+    if trace_file:
+        tracer.enable()
+    return trace_file
+
+
+def finish_tracing(trace_file):
+    if not trace_file:
+        return
+    tracer.write_trace(trace_file)
+    print(tracer.summary())
+    print(f"Trace written to {trace_file}")
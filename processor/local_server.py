@@ -0,0 +1,80 @@
+"""
+What the resident services (daemon, webhooks, report server) share to answer HTTP requests on localhost:
+a ThreadingHTTPServer on a daemon thread next to their main loop, which SIGTERM or SIGINT stops.
+"""
+import json
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+
+LOCALHOST = "127.0.0.1"
+JSON_CONTENT_TYPE = "application/json"
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    """
+    Doesn't log every request to stderr, and sends a whole response in one call.
+    """
+    def send_body(self, status: int, body: bytes, content_type: str = JSON_CONTENT_TYPE,
+                  headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status: int, body):
+        self.send_body(status, json.dumps(body).encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+def json_handler(get: Optional[Callable[[str], Tuple[int, Dict]]] = None,
+                 post: Optional[Callable[[Dict, bytes], Tuple[int, Dict]]] = None):
+    """
+    A handler class answering GET with get(path) and POST with post(headers, body), both returning
+    (HTTP status, JSON body). Methods without a callback get the server's default 501.
+    """
+    class Handler(QuietHandler):
+        if get is not None:
+            def do_GET(self):
+                self.send_json(*get(self.path))
+
+        if post is not None:
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_json(*post(self.headers, body))
+
+    return Handler
+
+
+def start_server(handler, port: int, host: str = LOCALHOST,
+                 request_queue_size: Optional[int] = None) -> ThreadingHTTPServer:
+    """
+    Serves requests with handler on a daemon thread, so it never keeps the process alive on its own.
+    request_queue_size is the listen backlog, for services that expect bursts of new connections.
+    """
+    server_class = ThreadingHTTPServer
+    if request_queue_size is not None:
+        server_class = type("LocalHTTPServer", (ThreadingHTTPServer,), {"request_queue_size": request_queue_size})
+    server = server_class((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def close_server(server: Optional[ThreadingHTTPServer]):
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+def stop_on_signals(stop: Callable[[], None]):
+    """
+    Calls stop() on SIGTERM and SIGINT, so the service's main loop can finish what it is doing and clean up.
+    """
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stop())
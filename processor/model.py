@@ -15,6 +15,37 @@ class MeetingInstance(BaseModel):
     meeting = ForeignKeyField(Meeting, backref='instances')
     start_time = DateTimeField()
     cached = BooleanField(default=False)
+    ingested_at = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            # Also covers uuid, so per-meeting scans ordered by start time never touch the table
+            (('meeting', 'start_time', 'uuid'), False),
+            (('meeting', 'ingested_at'), False),
+        )
+
+
+class MeetingSyncState(BaseModel):
+    meeting = ForeignKeyField(Meeting, primary_key=True, backref='sync_state')
+    last_start_time = DateTimeField(null=True)
+    last_synced = DateTimeField(null=True)
+
+
+class ReportCell(BaseModel):
+    meeting = ForeignKeyField(Meeting, backref='report_cells')
+    date = DateField()
+    attendance = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey('meeting', 'date')
+
+
+class ReportSummary(BaseModel):
+    meeting = ForeignKeyField(Meeting, primary_key=True, backref='report_summary')
+    average = FloatField(null=True)
+    last_four_average = FloatField(null=True)
+    # The newest MeetingInstance.ingested_at already counted in the meeting's ReportCells
+    last_ingested_at = DateTimeField(null=True)
 
 
 class Participant(BaseModel):
@@ -27,7 +58,65 @@ class Attendance(BaseModel):
     meeting_instance = ForeignKeyField(MeetingInstance, backref='attendances')
     participant = ForeignKeyField(Participant, backref='attendances')
 
+    class Meta:
+        indexes = (
+            (('meeting_instance', 'participant'), True),
+        )
+
+
+class AttendanceInterval(BaseModel):
+    """
+    One join/leave record from Zoom's participant report, in seconds from the instance's start time.
+    A participant who drops off and rejoins has several.
+    """
+    # The composite index below serves lookups by instance, so the foreign keys get no index of their own
+    meeting_instance = ForeignKeyField(MeetingInstance, backref='intervals', index=False)
+    participant = ForeignKeyField(Participant, backref='intervals', index=False)
+    join_offset = IntegerField()
+    leave_offset = IntegerField()
+
+    class Meta:
+        indexes = (
+            (('meeting_instance', 'participant', 'join_offset'), False),
+        )
+
+
+class AttendanceBitmap(BaseModel):
+    """
+    The sessions of a meeting a participant attended, as a little-endian bitset:
+    bit i is set when they attended the meeting's i-th instance by start time.
+    """
+    meeting = ForeignKeyField(Meeting, backref='attendance_bitmaps')
+    participant = ForeignKeyField(Participant, backref='attendance_bitmaps')
+    bits = BlobField()
+
+    class Meta:
+        primary_key = CompositeKey('meeting', 'participant')
+
+
+class AttendanceBitmapState(BaseModel):
+    meeting = ForeignKeyField(Meeting, primary_key=True, backref='attendance_bitmap_state')
+    # How many of the meeting's instances the bitmaps cover, and the uuid of the last of them by start time
+    instances = IntegerField()
+    last_uuid = CharField(null=True)
+    # The newest MeetingInstance.ingested_at already in the meeting's bitmaps
+    last_ingested_at = DateTimeField(null=True)
+
 
 class ExecutionLog(BaseModel):
     run_time = DateTimeField()
     exit_code = IntegerField()
+
+
+class BackfillCheckpoint(BaseModel):
+    meeting_id = CharField(primary_key=True)
+    status = CharField()
+    instances = IntegerField(default=0)
+    finished = DateTimeField()
+    error = TextField(null=True)
+
+
+class SheetSnapshot(BaseModel):
+    spreadsheet_id = CharField(primary_key=True)
+    values = TextField()
+    uploaded = DateTimeField()
@@ -0,0 +1,188 @@
+from array import array
+from typing import Optional
+
+import numpy as np
+
+from processor.instrumentation import tracer
+from processor.model import Participant
+
+EMAIL = "email"
+NAME = "name"
+USER_ID = "user_id"
+# Keys added since the last merge are kept in a dict until there are this many, or an eighth of the index
+MIN_PENDING = 1024
+
+
+class StringColumn:
+    """
+    Strings packed back to back in one UTF-8 buffer, addressed by position.
+    NULLs, which are rare, are kept aside.
+    """
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('I', [0])
+        self.nulls = set()
+
+    def append(self, value: Optional[str]):
+        if value is None:
+            self.nulls.add(len(self.offsets) - 1)
+        else:
+            self.data += value.encode("utf-8")
+        self.offsets.append(len(self.data))
+
+    def __getitem__(self, i) -> Optional[str]:
+        if i in self.nulls:
+            return None
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def nbytes(self) -> int:
+        return len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+
+class HashIndex:
+    """
+    Maps string keys to row positions through their hashes, kept in sorted numpy arrays.
+    Only the first row added for a hash is kept, so a hash collision shows up as a row whose key doesn't
+    match, which the caller treats as a miss.
+    """
+    def __init__(self):
+        self.hashes = np.empty(0, dtype=np.int64)
+        self.rows = np.empty(0, dtype=np.int32)
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.hashes) + len(self.pending)
+
+    def get_many(self, keys) -> np.ndarray:
+        """
+        Returns the row of each key, or -1.
+        """
+        hashes = np.fromiter((hash(key) for key in keys), dtype=np.int64, count=len(keys))
+        rows = np.full(len(keys), -1, dtype=np.int32)
+        if len(self.hashes):
+            positions = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+            found = self.hashes[positions] == hashes
+            rows[found] = self.rows[positions[found]]
+        if self.pending:
+            for i in np.flatnonzero(rows < 0):
+                rows[i] = self.pending.get(int(hashes[i]), -1)
+        return rows
+
+    def setdefault(self, key: str, row: int):
+        h = hash(key)
+        if h in self.pending:
+            return
+        position = np.searchsorted(self.hashes, h)
+        if position < len(self.hashes) and self.hashes[position] == h:
+            return
+        self.pending[h] = row
+        if len(self.pending) >= max(MIN_PENDING, len(self.hashes) // 8):
+            self.merge()
+
+    def merge(self):
+        if not self.pending:
+            return
+        hashes = np.concatenate([self.hashes, np.fromiter(self.pending.keys(), dtype=np.int64)])
+        rows = np.concatenate([self.rows, np.fromiter(self.pending.values(), dtype=np.int32)])
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.rows = rows[order]
+        self.pending = {}
+
+    def nbytes(self) -> int:
+        # A dict entry with its two ints takes roughly 100 bytes
+        return self.hashes.nbytes + self.rows.nbytes + 100 * len(self.pending)
+
+
+class ParticipantIndex:
+    """
+    An in-memory copy of the Participant identities, so participant records can be resolved without a
+    query per batch. It answers the same lookups as select_first_by: the first participant by email, by
+    name, and by user id among the participants with neither.
+
+    It is loaded from the DB on first use, and kept current by add() as participants are written.
+    Rows written by someone else, like another process, are not in it: callers go to the DB for the keys
+    it doesn't have and add what they find. A rolled back transaction may have taken rows that were added
+    with it, so the index is then dropped and reloaded on the next lookup.
+
+    Rows are stored in packed columns and the keys only as 64-bit hashes, so a participant takes well under
+    100 bytes, against several hundred as Python objects in dicts.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.clear()
+        db.rollback_hooks.append(self.clear)
+
+    def clear(self):
+        self.loaded = False
+        self.ids = array('q')
+        self.user_ids = StringColumn()
+        self.names = StringColumn()
+        self.emails = StringColumn()
+        self.indexes = {EMAIL: HashIndex(), NAME: HashIndex(), USER_ID: HashIndex()}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self):
+        with tracer.span("load participant index"):
+            query = (Participant.select(Participant.id, Participant.user_id, Participant.name, Participant.email)
+                                .order_by(Participant.id))
+            for participant_id, user_id, name, email in query.tuples().iterator():
+                self.add_row(participant_id, user_id, name, email)
+            for index in self.indexes.values():
+                index.merge()
+        self.loaded = True
+        print(f"Loaded {len(self)} participants into the participant index")
+
+    def add(self, participants):
+        """
+        Records participants that are in the DB, with their ids.
+        """
+        if not self.loaded:
+            return
+        for p in participants:
+            self.add_row(p.id, p.user_id, p.name, p.email)
+
+    def add_row(self, participant_id, user_id, name, email):
+        row = len(self.ids)
+        self.ids.append(participant_id)
+        self.user_ids.append(user_id)
+        self.names.append(name)
+        self.emails.append(email)
+        if email:
+            self.indexes[EMAIL].setdefault(email, row)
+        if name:
+            self.indexes[NAME].setdefault(name, row)
+        if name == "" and email == "":
+            self.indexes[USER_ID].setdefault(user_id, row)
+
+    def participant(self, row) -> Participant:
+        return Participant(id=self.ids[row], user_id=self.user_ids[row], name=self.names[row],
+                           email=self.emails[row])
+
+    def first_by(self, key: str, values):
+        """
+        Returns {value: Participant} for the values found under the key (EMAIL, NAME or USER_ID),
+        and the set of values that weren't.
+        """
+        if not self.loaded:
+            self.load()
+        values = list(values)
+        column = {EMAIL: self.emails, NAME: self.names, USER_ID: self.user_ids}[key]
+        found = {}
+        missing = set()
+        for value, row in zip(values, self.indexes[key].get_many(values)):
+            # A different key under the same hash is a miss
+            if row >= 0 and column[row] == value:
+                found[value] = self.participant(row)
+            else:
+                missing.add(value)
+        tracer.count("participant_index.hits", len(found))
+        tracer.count("participant_index.misses", len(missing))
+        return found, missing
+
+    def nbytes(self) -> int:
+        return (self.ids.itemsize * len(self.ids) + self.user_ids.nbytes() + self.names.nbytes()
+                + self.emails.nbytes()
+                + sum(index.nbytes() for index in self.indexes.values()))
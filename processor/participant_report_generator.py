@@ -1,22 +1,28 @@
 import sys
 import os
-import pandas as pd
 import datetime
 
-from processor.data_fetcher import DataFetcher
 from processor.db_helper import DbHelper
-from processor.report_generator import ReportGenerator
-from processor.zoom_helper import ZoomHelper
+from processor.exporter import Exporter, CSV
+from processor.instrumentation import traced, start_tracing_from_env, finish_tracing
+from processor.report_generator import ReportGenerator, make_data_fetcher, make_response_cache, report_from_db, \
+    export_format
+from processor.zoom_helper import ZoomHelper, ZOOM_URL
 
 
 class ParticipantReportGenerator(ReportGenerator):
-    def __init__(self, data_fetcher, google_helper):
-        super().__init__(data_fetcher, google_helper)
+    def __init__(self, data_fetcher, google_helper, from_db=False):
+        super().__init__(data_fetcher, google_helper, from_db)
         self.data_fetcher = data_fetcher
         self.google = google_helper
 
+    @traced("generate participant report")
     def generate_report(self, meeting_ids):
-        df = pd.DataFrame(data=[], columns=[ReportGenerator.TOPIC_COLUMN])
+        if self.from_db:
+            return self.generate_report_from_db(meeting_ids)
+
+        records = []
+        topics = {}
         for meeting_id in meeting_ids:
             attendances = self.get_attendances(meeting_id)
             meeting = self.data_fetcher.fetch_meeting_details(meeting_id)
@@ -24,9 +30,18 @@ class ParticipantReportGenerator(ReportGenerator):
                 # We will use the dates as the column names
                 # and the meeting id's and topics as the row names
                 date = meeting_instance.start_time.date().strftime('%Y-%m-%d')
-                df.loc[meeting_id, date] = self.get_participants_string(participants)
-            df.loc[meeting_id, ReportGenerator.TOPIC_COLUMN] = meeting.topic
+                records.append((meeting_id, date, self.get_participants_string(participants)))
+            topics[meeting_id] = meeting.topic
+
+        df = self.pivot_report(records, topics)
+        df = df.fillna('')
+        return df
 
+    @traced("generate participant report from db")
+    def generate_report_from_db(self, meeting_ids):
+        topics = self.sync_meetings(meeting_ids)
+        rows = self.data_fetcher.fetch_attendance_names(list(topics))
+        df = self.pivot_report(self.db_records(rows, topics), topics)
         df = df.fillna('')
         return df
 
@@ -39,6 +54,7 @@ class ParticipantReportGenerator(ReportGenerator):
 
 
 def main():
+    trace_file = start_tracing_from_env()
     db_name = sys.argv[1]
     meeting_ids_file = sys.argv[2]
     zoom_api_key = os.environ["ZOOM_API_KEY"]
@@ -51,15 +67,24 @@ def main():
 
     db = DbHelper(db_name)
 
-    zoom = ZoomHelper(ReportGenerator.ZOOM_URL, zoom_api_key, zoom_api_secret)
+    zoom = ZoomHelper(ZOOM_URL, zoom_api_key, zoom_api_secret,
+                      response_cache=make_response_cache())
 
-    data_fetcher = DataFetcher(db, zoom)
-    rg = ParticipantReportGenerator(data_fetcher, None)
+    data_fetcher = make_data_fetcher(db, zoom, meeting_ids)
+    rg = ParticipantReportGenerator(data_fetcher, None, from_db=report_from_db())
     report = rg.generate_report(meeting_ids)
+    zoom.print_rate_limit_metrics()
+    zoom.print_connection_metrics()
+    if zoom.response_cache is not None:
+        zoom.response_cache.print_stats()
 
     run_date = datetime.datetime.now().date().strftime('%Y-%m-%d')
-    export_file = f'participants_{run_date}.csv'
-    report.to_csv(export_file, index=True, header=True)
+    exporter = Exporter(export_format() or CSV)
+    export_file = exporter.export_report(report, f'participants_{run_date}.csv')
+    print(f"Exported the participant report to {export_file}")
+    if export_format():
+        exporter.export_facts(meeting_ids, f'attendance_facts_{run_date}')
+    finish_tracing(trace_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+from typing import Dict, List, Optional, Tuple
+
+from peewee import chunked, fn, JOIN
+
+from processor.db_helper import BATCH_SIZE, batch_size
+from processor.instrumentation import tracer, traced
+from processor.model import Attendance, MeetingInstance, ReportCell, ReportSummary
+
+CELL_BATCH_SIZE = batch_size(3)
+
+
+class ReportCache:
+    """
+    Materialized attendance counts per (meeting, date) and averages per meeting.
+    A refresh only recounts the dates of the meeting instances ingested since the meeting was last refreshed,
+    so keeping the cache current costs as much as the new data, not the whole history.
+    """
+    def __init__(self, db):
+        self.db = db
+
+    @traced("refresh report cache")
+    def refresh(self, meeting_ids) -> int:
+        """
+        Brings the cache up to date for the meetings, returning how many of them had changed.
+        """
+        meeting_ids = [str(meeting_id) for meeting_id in dict.fromkeys(meeting_ids)]
+        latest = {}
+        summaries = {}
+        for batch in chunked(meeting_ids, BATCH_SIZE):
+            latest.update(MeetingInstance.select(MeetingInstance.meeting, fn.MAX(MeetingInstance.ingested_at))
+                                         .where(MeetingInstance.meeting.in_(batch))
+                                         .group_by(MeetingInstance.meeting)
+                                         .tuples())
+            summaries.update((s.meeting_id, s) for s in ReportSummary.select()
+                                                                     .where(ReportSummary.meeting.in_(batch)))
+
+        refreshed = 0
+        for meeting_id in meeting_ids:
+            summary = summaries.get(meeting_id)
+            last_ingested_at = latest.get(meeting_id)
+            if summary is None:
+                self.refresh_meeting(meeting_id, None, last_ingested_at)
+            elif last_ingested_at is not None and (summary.last_ingested_at is None
+                                                   or last_ingested_at > summary.last_ingested_at):
+                self.refresh_meeting(meeting_id, summary.last_ingested_at, last_ingested_at)
+            else:
+                continue
+            refreshed += 1
+
+        tracer.count("report_cache.refreshed", refreshed)
+        print(f"Report cache: refreshed {refreshed} of {len(meeting_ids)} meetings")
+        return refreshed
+
+    def refresh_meeting(self, meeting_id: str, since, last_ingested_at):
+        """
+        Recounts every date that has an instance ingested after `since`, or all of them when since is None.
+        """
+        scope = MeetingInstance.meeting == meeting_id
+        if since is not None:
+            changed = (MeetingInstance.select(MeetingInstance.start_time)
+                                      .where(scope & (MeetingInstance.ingested_at > since)))
+            dates = set(mi.start_time.date().isoformat() for mi in changed)
+            scope &= fn.DATE(MeetingInstance.start_time).in_(list(dates))
+
+        counts = (MeetingInstance
+                  .select(MeetingInstance.start_time, fn.COUNT(Attendance.id))
+                  .join(Attendance, JOIN.LEFT_OUTER)
+                  .where(scope)
+                  .group_by(MeetingInstance.start_time, MeetingInstance.uuid)
+                  .order_by(MeetingInstance.start_time, MeetingInstance.uuid))
+        # When a meeting has several sessions on the same date, the last one wins, as in the report
+        cells = {}
+        for start_time, count in counts.tuples():
+            cells[start_time.date()] = count
+
+        with self.db.db.atomic():
+            if since is None:
+                ReportCell.delete().where(ReportCell.meeting == meeting_id).execute()
+            rows = [{'meeting': meeting_id, 'date': date, 'attendance': count} for date, count in cells.items()]
+            for batch in chunked(rows, CELL_BATCH_SIZE):
+                ReportCell.replace_many(batch).execute()
+
+            attendances = [a for a, in ReportCell.select(ReportCell.attendance)
+                                                 .where(ReportCell.meeting == meeting_id)
+                                                 .order_by(ReportCell.date)
+                                                 .tuples()]
+            average, last_four_average = self.averages(attendances)
+            ReportSummary.replace(meeting=meeting_id, average=average, last_four_average=last_four_average,
+                                  last_ingested_at=last_ingested_at).execute()
+
+    @staticmethod
+    def averages(attendances: List[int], n: int = 4) -> Tuple[Optional[float], Optional[float]]:
+        """
+        The average of every session and of the last n, from attendances ordered by date.
+        """
+        if not attendances:
+            return None, None
+        last_n = attendances[-n:]
+        return sum(attendances) / len(attendances), sum(last_n) / len(last_n)
+
+    @staticmethod
+    def fetch_cells(meeting_ids) -> List[Tuple]:
+        """
+        Returns (meeting_id, date, attendance) for the meetings, ordered by meeting and date.
+        """
+        cells = []
+        for batch in chunked([str(m) for m in meeting_ids], BATCH_SIZE):
+            cells.extend(ReportCell.select(ReportCell.meeting, ReportCell.date, ReportCell.attendance)
+                                   .where(ReportCell.meeting.in_(batch))
+                                   .order_by(ReportCell.meeting, ReportCell.date)
+                                   .tuples())
+        return cells
+
+    @staticmethod
+    def fetch_summaries(meeting_ids) -> Dict[str, Tuple[Optional[float], Optional[float]]]:
+        summaries = {}
+        for batch in chunked([str(m) for m in meeting_ids], BATCH_SIZE):
+            summaries.update((s.meeting_id, (s.average, s.last_four_average))
+                             for s in ReportSummary.select().where(ReportSummary.meeting.in_(batch)))
+        return summaries
@@ -3,14 +3,22 @@ import sys
 import datetime
 from typing import Dict, List
 
+import numpy as np
 import pandas as pd
-from googleapiclient.errors import HttpError
+from peewee import chunked
 
+from processor.async_data_fetcher import AsyncDataFetcher
+from processor.attendance_index import AttendanceIndex
 from processor.data_fetcher import DataFetcher
-from processor.db_helper import DbHelper
+from processor.db_helper import DbHelper, BATCH_SIZE
+from processor.exporter import Exporter
 from processor.google_helper import GoogleHelper
-from processor.model import MeetingInstance, Participant
-from processor.zoom_helper import ZoomHelper
+from processor.instrumentation import traced, start_tracing_from_env, finish_tracing
+from processor.model import Meeting, MeetingInstance, Participant
+from processor.report_cache import ReportCache
+from processor.response_cache import ResponseCache
+from processor.threaded_data_fetcher import ThreadedDataFetcher, MAX_WORKERS
+from processor.zoom_helper import ZoomHelper, RESPONSE_CACHE_TTLS, ZOOM_URL
 
 
 class ReportGenerator:
@@ -20,12 +28,22 @@ class ReportGenerator:
     TOPIC_COLUMN = 'Name'
     AVG_COLUMN = 'Average'
     LAST_FOUR = 'Last Four Average'
-    ZOOM_URL = "https://api.zoom.us/v2"
+    REGULARS = 'Regulars'
+    NEW = 'New'
+    CHURNED = 'Churned'
+    RETENTION_COLUMNS = [REGULARS, NEW, CHURNED]
+    ZOOM_URL = ZOOM_URL
 
-    def __init__(self, data_fetcher, google_helper):
+    def __init__(self, data_fetcher, google_helper, from_db=False, from_cache=False, retention=False, sync=True):
         self.data_fetcher = data_fetcher
         self.google = google_helper
+        self.from_db = from_db
+        self.from_cache = from_cache
+        self.retention = retention
+        # When False, the DB and cache reports use the meetings as stored, without syncing them first
+        self.sync = sync
 
+    @traced("get attendances")
     def get_attendances(self, meeting_id) -> Dict[MeetingInstance, List[Participant]]:
         """
         For any meeting, returns a Dict[MeetingInstance, List[Participant]]
@@ -43,18 +61,81 @@ class ReportGenerator:
         return result
 
     @staticmethod
-    def avg_of_last_four(row):
-        # Drop non-session days (NaN)
-        # Drop the first element, which is not numeric (meeting topic)
-        # Sort by date
-        # Grab last four elements and take mean
-        row = row[1:].dropna()
-        row = row.sort_index(key=lambda x: pd.to_datetime(x))
-        print(row)
-        return row.tail(4).mean()
+    def avg_of_last_n(dates, n=4):
+        """
+        Vectorized avg_of_last_four: for each row of a (meetings x dates) frame, the mean of the last n sessions.
+        """
+        values = dates[sorted(dates.columns)].to_numpy(dtype=float)
+        present = ~np.isnan(values)
+        # Count the sessions from the most recent date backwards
+        sessions_from_end = np.cumsum(present[:, ::-1], axis=1)[:, ::-1]
+        last_n = present & (sessions_from_end <= n)
+        totals = np.where(last_n, values, 0).sum(axis=1)
+        counts = last_n.sum(axis=1)
+        means = np.divide(totals, counts, out=np.full(len(totals), np.nan), where=counts > 0)
+        return pd.Series(means, index=dates.index)
+
+    @staticmethod
+    def pivot_report(records, topics):
+        """
+        Builds the report frame in one go from (meeting_id, date, value) records.
+        Rows follow the order of topics, a Dict[meeting_id, topic], and date columns the order they first appear in.
+        When a meeting has several sessions on the same date, the last one wins.
+        """
+        cells = pd.DataFrame.from_records(records, columns=['meeting_id', 'date', 'value'])
+        dates = list(pd.unique(cells['date']))
+        cells = cells.drop_duplicates(['meeting_id', 'date'], keep='last')
+
+        df = cells.pivot(index='meeting_id', columns='date', values='value')
+        df = df.reindex(index=pd.Index(list(topics), dtype=object), columns=dates)
+        df.index.name = None
+        df.columns.name = None
+        df.insert(0, ReportGenerator.TOPIC_COLUMN, pd.Series(topics, dtype=object))
+        return df
+
+    def sync_meetings(self, meeting_ids):
+        """
+        Syncs every meeting into the DB and returns their topics, keyed by the meeting ids as given.
+        """
+        if not self.sync:
+            return self.stored_topics(meeting_ids)
+        topics = {}
+        for meeting_id in meeting_ids:
+            print(f"\nSyncing meeting {meeting_id}")
+            meeting = self.data_fetcher.sync_meeting(meeting_id)
+            topics[meeting_id] = meeting.topic
+        return topics
+
+    @staticmethod
+    def stored_topics(meeting_ids):
+        """
+        The topics of the meetings already in the DB, keyed by the meeting ids as given.
+        """
+        stored = {}
+        for batch in chunked([str(m) for m in meeting_ids], BATCH_SIZE):
+            stored.update(Meeting.select(Meeting.meeting_id, Meeting.topic)
+                                 .where(Meeting.meeting_id.in_(batch))
+                                 .tuples())
+        return {meeting_id: stored[str(meeting_id)] for meeting_id in meeting_ids if str(meeting_id) in stored}
 
+    @staticmethod
+    def db_records(rows, topics):
+        """
+        Turns (meeting_id, start_time, value) rows from the DB into report records keyed like topics.
+        """
+        meeting_ids = {str(meeting_id): meeting_id for meeting_id in topics}
+        return [(meeting_ids[meeting_id], start_time.date().strftime('%Y-%m-%d'), value)
+                for meeting_id, start_time, value in rows]
+
+    @traced("generate report")
     def generate_report(self, meeting_ids):
-        df = pd.DataFrame(data=[], columns=[self.TOPIC_COLUMN])
+        if self.from_cache:
+            return self.generate_report_from_cache(meeting_ids)
+        if self.from_db:
+            return self.generate_report_from_db(meeting_ids)
+
+        records = []
+        topics = {}
         for meeting_id in meeting_ids:
             attendances = self.get_attendances(meeting_id)
             meeting = self.data_fetcher.fetch_meeting_details(meeting_id)
@@ -62,27 +143,91 @@ class ReportGenerator:
                 # We will use the dates as the column names
                 # and the meeting id's and topics as the row names
                 date = meeting_instance.start_time.date().strftime('%Y-%m-%d')
-                df.loc[meeting_id, date] = len(participants)
-            df.loc[meeting_id, self.TOPIC_COLUMN] = meeting.topic
+                records.append((meeting_id, date, len(participants)))
+            topics[meeting_id] = meeting.topic
 
-        # average attendance per meeting
-        avg = df.mean(skipna=True, numeric_only=True, axis=1)
+        return self.build_report(records, topics)
 
-        last_four = df.apply(ReportGenerator.avg_of_last_four, axis=1)
+    @traced("generate report from db")
+    def generate_report_from_db(self, meeting_ids):
+        """
+        Same report as generate_report, but the attendance counts come straight from
+        one aggregate query, without building a Participant for each attendee.
+        """
+        topics = self.sync_meetings(meeting_ids)
+        rows = self.data_fetcher.fetch_attendance_counts(list(topics))
+        return self.build_report(self.db_records(rows, topics), topics)
+
+    @traced("generate report from cache")
+    def generate_report_from_cache(self, meeting_ids):
+        """
+        Same report as generate_report, read from the report cache after refreshing
+        the meetings that got new instances since the last run.
+        """
+        topics = self.sync_meetings(meeting_ids)
+        report_cache = ReportCache(self.data_fetcher.db)
+        report_cache.refresh(list(topics))
+
+        keys = {str(meeting_id): meeting_id for meeting_id in topics}
+        records = [(keys[meeting_id], date.strftime('%Y-%m-%d'), attendance)
+                   for meeting_id, date, attendance in report_cache.fetch_cells(list(topics))]
+        df = self.pivot_report(records, topics)
+        dates = df.drop(columns=[self.TOPIC_COLUMN]).astype(float)
+        df[dates.columns] = dates
+
+        summaries = report_cache.fetch_summaries(list(topics))
+        no_sessions = (np.nan, np.nan)
+        df[self.AVG_COLUMN] = [summaries.get(str(m), no_sessions)[0] for m in df.index]
+        df[self.LAST_FOUR] = [summaries.get(str(m), no_sessions)[1] for m in df.index]
+        df[[self.AVG_COLUMN, self.LAST_FOUR]] = df[[self.AVG_COLUMN, self.LAST_FOUR]].astype(float)
+        return self.finish_report(df)
+
+    @traced("build report")
+    def build_report(self, records, topics):
+        df = self.pivot_report(records, topics)
+        dates = df.drop(columns=[self.TOPIC_COLUMN]).astype(float)
+        df[dates.columns] = dates
 
-        df[self.AVG_COLUMN] = avg
-        df[self.LAST_FOUR] = last_four
+        # average attendance per meeting
+        df[self.AVG_COLUMN] = dates.mean(axis=1)
+        df[self.LAST_FOUR] = self.avg_of_last_n(dates)
+        return self.finish_report(df)
 
+    def finish_report(self, df):
+        """
+        What every way of building the report does last: zero the dates a meeting didn't run, and add
+        the retention columns when they're asked for.
+        """
         df = df.fillna(0)
+        if self.retention:
+            self.add_retention_columns(df)
         return df
 
+    @traced("add retention columns")
+    def add_retention_columns(self, df, n=4):
+        """
+        Adds, per meeting, how many participants attended at least 3 of the last n sessions,
+        how many first came in the last n, and how many came before but not in the last n.
+        """
+        meeting_ids = [str(meeting_id) for meeting_id in df.index]
+        attendance_index = AttendanceIndex(self.data_fetcher.db)
+        attendance_index.refresh(meeting_ids)
+        attendance = attendance_index.fetch(meeting_ids)
+        df[self.REGULARS] = [float(len(attendance[m].attended_at_least(3, n))) for m in meeting_ids]
+        df[self.NEW] = [float(len(attendance[m].new(n))) for m in meeting_ids]
+        df[self.CHURNED] = [float(len(attendance[m].churned(n))) for m in meeting_ids]
+
     @staticmethod
+    @traced("dataframe to array")
     def dataframe_to_array(df):
+        # Work on a copy, the caller may still export or serve the report
+        df = df.copy()
         rows, cols = df.shape
 
         names = df.pop(ReportGenerator.TOPIC_COLUMN)
         averages = df.pop(ReportGenerator.AVG_COLUMN)
         last_fours = df.pop(ReportGenerator.LAST_FOUR)
+        retention = [(column, df.pop(column)) for column in ReportGenerator.RETENTION_COLUMNS if column in df.columns]
         values_dict = df.to_dict()
 
         # Create all the rows, and add one for the headers row
@@ -129,24 +274,96 @@ class ReportGenerator:
             row_num = row_name_to_num[meeting_id]
             values[row_num].append(avg)
 
+        # Then the retention columns, when the report has them
+        for column, counts in retention:
+            values[header_row].append(column)
+            for meeting_id, count in counts.iteritems():
+                values[row_name_to_num[meeting_id]].append(count)
+
         return values
 
-    def upload_report(self, report, run_date):
-        output_file = f"zoom_report_{run_date}"
-        folder_id = self.google.get_folder_id("CA Reports")
+    @traced("upload report")
+    def upload_report(self, report, run_date, sheet_id=None):
+        """
+        Uploads to a new sheet, or updates sheet_id in place by only sending the cells that changed.
+        A new sheet is never updated again, so its upload isn't kept as a snapshot.
+        """
+        keep_snapshot = sheet_id is not None
+        if sheet_id is None:
+            output_file = f"zoom_report_{run_date}"
+            folder_id = self.google.get_folder_id("CA Reports")
+            sheet_id = self.google.create_new_sheet(output_file, folder_id)
 
-        sheet_id = self.google.create_new_sheet(output_file, folder_id)
-        result = self.google.insert_df_to_sheet(sheet_id, report)
+        result = self.google.write_values(sheet_id, report, keep_snapshot)
         sheet_link = self.google.get_sheet_link(result.get("spreadsheetId"))
         print(f"Finished uploading Zoom report.\n"
-              f"spreadsheetId: {result.get('updates').get('spreadsheetId')}\n"
-              f"updatedRange: {result.get('updates').get('updatedRange')}\n"
-              f"updatedRows: {result.get('updates').get('updatedRows')}\n"
+              f"spreadsheetId: {result.get('spreadsheetId')}\n"
+              f"updatedRanges: {result.get('updatedRanges')} in {result.get('requests')} requests\n"
+              f"updatedCells: {result.get('updatedCells')}\n"
               f"link: {sheet_link}")
         return sheet_link
 
 
+def make_data_fetcher(db, zoom, meeting_ids):
+    """
+    Set ZOOM_FETCH_MODE=async to download all meetings concurrently before generating the report,
+    or ZOOM_FETCH_MODE=threads to do it on ZOOM_FETCH_WORKERS threads (8 by default),
+    and ZOOM_SYNC_MODE=incremental to only store meeting instances newer than the last sync.
+    """
+    fetch_mode = os.environ.get("ZOOM_FETCH_MODE", "sync")
+    incremental = os.environ.get("ZOOM_SYNC_MODE", "full") == "incremental"
+    if fetch_mode == "async":
+        data_fetcher = AsyncDataFetcher(db, zoom, incremental=incremental)
+        data_fetcher.prefetch(meeting_ids)
+        return data_fetcher
+    if fetch_mode == "threads":
+        max_workers = int(os.environ.get("ZOOM_FETCH_WORKERS", MAX_WORKERS))
+        data_fetcher = ThreadedDataFetcher(db, zoom, incremental=incremental, max_workers=max_workers)
+        data_fetcher.prefetch(meeting_ids)
+        return data_fetcher
+    return DataFetcher(db, zoom, incremental=incremental)
+
+
+def make_response_cache():
+    """
+    Set ZOOM_RESPONSE_CACHE=<file> to keep meeting details and instance lists on disk between runs.
+    """
+    path = os.environ.get("ZOOM_RESPONSE_CACHE")
+    if not path:
+        return None
+    return ResponseCache(path, RESPONSE_CACHE_TTLS)
+
+
+def report_from_db():
+    """
+    Set ZOOM_REPORT_SOURCE=db to compute the report with aggregate queries over the attendance DB.
+    """
+    return os.environ.get("ZOOM_REPORT_SOURCE", "memory") == "db"
+
+
+def report_from_cache():
+    """
+    Set ZOOM_REPORT_SOURCE=cache to read the report from the materialized report cache, only recounting what changed.
+    """
+    return os.environ.get("ZOOM_REPORT_SOURCE", "memory") == "cache"
+
+
+def export_format():
+    """
+    Set ZOOM_EXPORT_FORMAT to csv, parquet or arrow to also export the report and its attendance fact table.
+    """
+    return os.environ.get("ZOOM_EXPORT_FORMAT")
+
+
+def retention_columns():
+    """
+    Set ZOOM_RETENTION_COLUMNS=1 to add regulars, new and churned participant counts over the last four sessions.
+    """
+    return os.environ.get("ZOOM_RETENTION_COLUMNS", "0") == "1"
+
+
 def main():
+    trace_file = start_tracing_from_env()
     db_name = sys.argv[1]
     meeting_ids_file = sys.argv[2]
     zoom_api_key = os.environ["ZOOM_API_KEY"]
@@ -159,19 +376,32 @@ def main():
 
     db = DbHelper(db_name)
 
-    zoom = ZoomHelper(ReportGenerator.ZOOM_URL, zoom_api_key, zoom_api_secret)
+    zoom = ZoomHelper(ZOOM_URL, zoom_api_key, zoom_api_secret,
+                      response_cache=make_response_cache())
 
     service_account_file = f".secrets/{os.listdir('.secrets')[0]}"
     google_helper = GoogleHelper(service_account_file, ReportGenerator.SCOPES)
 
-    data_fetcher = DataFetcher(db, zoom)
-    rg = ReportGenerator(data_fetcher, google_helper)
+    data_fetcher = make_data_fetcher(db, zoom, meeting_ids)
+    rg = ReportGenerator(data_fetcher, google_helper, from_db=report_from_db(), from_cache=report_from_cache(),
+                         retention=retention_columns())
     report = rg.generate_report(meeting_ids)
-    values = rg.dataframe_to_array(report)
 
     run_date = datetime.datetime.now().date().strftime('%Y-%m-%d')
+    if export_format():
+        exporter = Exporter(export_format())
+        print(f"Exported the report to {exporter.export_report(report, f'attendance_{run_date}')}")
+        exporter.export_facts(meeting_ids, f'attendance_facts_{run_date}')
+    values = rg.dataframe_to_array(report)
 
-    return rg.upload_report(values, run_date)
+    zoom.print_rate_limit_metrics()
+    zoom.print_connection_metrics()
+    if zoom.response_cache is not None:
+        zoom.response_cache.print_stats()
+    # Set ZOOM_SHEET_ID to keep updating the same sheet instead of creating one per run
+    sheet_link = rg.upload_report(values, run_date, os.environ.get("ZOOM_SHEET_ID"))
+    finish_tracing(trace_file)
+    return sheet_link
 
 
 if __name__ == "__main__":
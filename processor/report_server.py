@@ -0,0 +1,316 @@
+"""
+Serves the attendance and participant reports, and each meeting's attendance series, as JSON or CSV over local HTTP.
+Responses come from a snapshot of the DB held in memory, rebuilt when something new is ingested, so reads never wait
+on the DB and never hold up ingestion. Every response has an ETag, and a matching If-None-Match gets a 304.
+
+    python processor/report_server.py prod.db --port 8083
+
+    curl 'http://127.0.0.1:8083/report?meetings=123,456&from=2020-08-01&to=2020-08-31'
+    curl 'http://127.0.0.1:8083/participants?meetings=123&format=csv'
+    curl 'http://127.0.0.1:8083/meetings/123'
+"""
+import argparse
+import csv
+import datetime
+import hashlib
+import io
+import json
+import sys
+import threading
+import urllib.parse
+from typing import Dict, List, Optional, Tuple
+
+from peewee import fn
+
+from processor.data_fetcher import DataFetcher
+from processor.db_helper import DbHelper
+from processor.instrumentation import tracer, traced
+from processor.local_server import LOCALHOST, QuietHandler, close_server, start_server, stop_on_signals
+from processor.model import Attendance, Meeting, MeetingInstance
+from processor.participant_report_generator import ParticipantReportGenerator
+from processor.report_generator import ReportGenerator
+
+DEFAULT_PORT = 8083
+# Seconds between checks for newly ingested data
+DEFAULT_REFRESH = 30
+# Responses kept per snapshot, the most common queries are asked over and over
+MAX_CACHED_RESPONSES = 1024
+JSON = "json"
+CSV = "csv"
+CONTENT_TYPES = {JSON: "application/json", CSV: "text/csv; charset=utf-8"}
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class ReportSnapshot:
+    """
+    The attendance counts and participant names of every stored meeting instance, by meeting and date,
+    as of one version of the DB. Never changed once built, so any number of threads can read it.
+    """
+    def __init__(self, version, topics: Dict[str, str], counts: List[Tuple], names: List[Tuple]):
+        self.version = version
+        self.topics = topics
+        # (meeting_id, date, value) records, as ReportGenerator.db_records makes them
+        self.counts = counts
+        self.names = names
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def current_version():
+        """
+        Changes whenever a meeting or an instance is stored, an instance is ingested, or an attendance is stored,
+        which is how webhooks record participants of instances that aren't ingested yet.
+        """
+        count, last_ingested_at = (MeetingInstance.select(fn.COUNT(MeetingInstance.uuid),
+                                                          fn.MAX(MeetingInstance.ingested_at))
+                                                  .tuples()
+                                                  .get())
+        # Attendances are never deleted, so the newest id changes with every one stored, without counting them all
+        last_attendance = Attendance.select(fn.MAX(Attendance.id)).scalar()
+        return Meeting.select().count(), count, str(last_ingested_at), last_attendance
+
+    @classmethod
+    @traced("build report snapshot")
+    def build(cls, meeting_ids: Optional[List[str]] = None) -> "ReportSnapshot":
+        """
+        Reads the meetings, or every meeting in the DB, with one aggregate query for the counts and one for the names.
+        """
+        version = cls.current_version()
+        if meeting_ids is None:
+            topics = dict(Meeting.select(Meeting.meeting_id, Meeting.topic).order_by(Meeting.meeting_id).tuples())
+        else:
+            topics = ReportGenerator.stored_topics(meeting_ids)
+        counts = ReportGenerator.db_records(DataFetcher.fetch_attendance_counts(list(topics)), topics)
+        names = ReportGenerator.db_records(DataFetcher.fetch_attendance_names(list(topics)), topics)
+        return cls(version, topics, counts, names)
+
+    def cached(self, key, build):
+        """
+        The response for key, building it with build() the first time. Returns (etag, body).
+        """
+        with self.lock:
+            response = self.responses.get(key)
+        if response is not None:
+            tracer.count("report_server.cache_hit")
+            return response
+        tracer.count("report_server.cache_miss")
+        body = build()
+        response = f'"{hashlib.sha256(body).hexdigest()[:32]}"', body
+        with self.lock:
+            if len(self.responses) >= MAX_CACHED_RESPONSES:
+                self.responses.clear()
+            self.responses[key] = response
+        return response
+
+
+def parse_date(value: Optional[str]) -> Optional[str]:
+    if not value:
+        return None
+    try:
+        return datetime.date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise BadRequest(f"invalid date {value}, expected YYYY-MM-DD")
+
+
+class ReportQuery:
+    """
+    The meetings and inclusive date range a request asks for, and the format to answer in.
+    """
+    def __init__(self, params: Dict[str, List[str]], meeting_ids: Optional[List[str]] = None):
+        meetings = params.get("meetings", [""])[0]
+        self.meeting_ids = tuple(m for m in meetings.split(",") if m) if meeting_ids is None else tuple(meeting_ids)
+        self.start = parse_date(params.get("from", [None])[0])
+        self.end = parse_date(params.get("to", [None])[0])
+        self.format = params.get("format", [JSON])[0]
+        if self.format not in CONTENT_TYPES:
+            raise BadRequest(f"invalid format {self.format}, expected json or csv")
+
+    def key(self, resource: str):
+        return resource, self.meeting_ids, self.start, self.end, self.format
+
+    def topics(self, snapshot: ReportSnapshot) -> Dict[str, str]:
+        if not self.meeting_ids:
+            return snapshot.topics
+        return {m: snapshot.topics[m] for m in self.meeting_ids if m in snapshot.topics}
+
+    def select(self, records: List[Tuple], topics: Dict[str, str]) -> List[Tuple]:
+        return [(meeting_id, date, value) for meeting_id, date, value in records
+                if meeting_id in topics and (self.start is None or date >= self.start)
+                and (self.end is None or date <= self.end)]
+
+
+def encode(values: List[List], fmt: str) -> bytes:
+    """
+    A matrix whose first row is the header, as CSV or as JSON with the header as "columns".
+    """
+    if fmt == CSV:
+        output = io.StringIO()
+        csv.writer(output).writerows(values)
+        return output.getvalue().encode()
+    return json.dumps({"columns": values[0], "rows": values[1:]}).encode()
+
+
+def attendance_report(snapshot: ReportSnapshot, query: ReportQuery) -> bytes:
+    """
+    The same matrix as the uploaded sheet, with the averages taken over the selected dates.
+    """
+    topics = query.topics(snapshot)
+    report = ReportGenerator(None, None).build_report(query.select(snapshot.counts, topics), topics)
+    return encode(ReportGenerator.dataframe_to_array(report), query.format)
+
+
+def participant_report(snapshot: ReportSnapshot, query: ReportQuery) -> bytes:
+    topics = query.topics(snapshot)
+    df = ParticipantReportGenerator.pivot_report(query.select(snapshot.names, topics), topics).fillna('')
+    dates = sorted(c for c in df.columns if c != ReportGenerator.TOPIC_COLUMN)
+    values = [['Meeting ID', ReportGenerator.TOPIC_COLUMN] + dates]
+    values.extend([meeting_id] + row for meeting_id, row in zip(df.index, df[[ReportGenerator.TOPIC_COLUMN] + dates]
+                                                                .values.tolist()))
+    return encode(values, query.format)
+
+
+def meeting_series(snapshot: ReportSnapshot, query: ReportQuery) -> bytes:
+    """
+    One row per date the meeting ran.
+    """
+    meeting_id, = query.meeting_ids
+    topics = {meeting_id: snapshot.topics[meeting_id]}
+    # When a meeting has several sessions on the same date, the last one wins, as in the report
+    series = {date: [count, ""] for _, date, count in query.select(snapshot.counts, topics)}
+    for _, date, names in query.select(snapshot.names, topics):
+        series[date][1] = names
+    if query.format == CSV:
+        return encode([["date", "attendance", "participants"]] + [[date] + row for date, row in series.items()], CSV)
+    return json.dumps({"meeting_id": meeting_id, "topic": topics[meeting_id],
+                       "series": [{"date": date, "attendance": count, "participants": names}
+                                  for date, (count, names) in series.items()]}).encode()
+
+
+class ReportServer:
+    """
+    Answers reads from the current ReportSnapshot on the HTTP server's threads. refresh() rebuilds the snapshot
+    when the DB changed, on the thread that owns the DB connection, and swaps it in whole, so readers see either
+    the old snapshot or the new one.
+    """
+    def __init__(self, db, meeting_ids: Optional[List[str]] = None):
+        self.db = db
+        self.meeting_ids = [str(m) for m in meeting_ids] if meeting_ids is not None else None
+        self.snapshot = ReportSnapshot.build(self.meeting_ids)
+        self.stopping = threading.Event()
+        self.server = None
+
+    def refresh(self) -> bool:
+        """
+        Rebuilds the snapshot if something was stored since it was built, returning whether it was.
+        """
+        if ReportSnapshot.current_version() == self.snapshot.version:
+            return False
+        self.snapshot = ReportSnapshot.build(self.meeting_ids)
+        tracer.count("report_server.snapshots")
+        return True
+
+    def respond(self, path: str, params: Dict[str, List[str]]) -> Tuple[int, Optional[str], bytes, str]:
+        """
+        Returns (HTTP status, ETag, body, content type) for a GET request.
+        """
+        snapshot = self.snapshot
+        parts = path.strip("/").split("/")
+        try:
+            if parts == ["report"]:
+                query = ReportQuery(params)
+                etag, body = snapshot.cached(query.key("report"), lambda: attendance_report(snapshot, query))
+            elif parts == ["participants"]:
+                query = ReportQuery(params)
+                etag, body = snapshot.cached(query.key("participants"), lambda: participant_report(snapshot, query))
+            elif parts == ["meetings"]:
+                query = ReportQuery(params, meeting_ids=[])
+                etag, body = snapshot.cached(query.key("meetings"), lambda: encode(
+                    [["Meeting ID", ReportGenerator.TOPIC_COLUMN]] + [list(t) for t in snapshot.topics.items()],
+                    query.format))
+            elif len(parts) == 2 and parts[0] == "meetings":
+                if parts[1] not in snapshot.topics:
+                    return 404, None, json.dumps({"error": f"no meeting {parts[1]}"}).encode(), CONTENT_TYPES[JSON]
+                query = ReportQuery(params, meeting_ids=[parts[1]])
+                etag, body = snapshot.cached(query.key("series"), lambda: meeting_series(snapshot, query))
+            else:
+                return 404, None, json.dumps({"error": "not found"}).encode(), CONTENT_TYPES[JSON]
+        except BadRequest as e:
+            return 400, None, json.dumps({"error": str(e)}).encode(), CONTENT_TYPES[JSON]
+        return 200, etag, body, CONTENT_TYPES[query.format]
+
+    def make_handler(self):
+        report_server = self
+
+        class Handler(QuietHandler):
+            # Keeps connections open between requests from the same client
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                status, etag, body, content_type = report_server.respond(url.path,
+                                                                         urllib.parse.parse_qs(url.query))
+                if etag is not None and etag in self.if_none_match():
+                    tracer.count("report_server.not_modified")
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                # Clients may keep the response but must check it's still current before using it
+                headers = {"ETag": etag, "Cache-Control": "no-cache"} if etag is not None else None
+                self.send_body(status, body, content_type, headers)
+
+            def if_none_match(self):
+                header = self.headers.get("If-None-Match", "")
+                return {tag.strip().lstrip("W/") for tag in header.split(",") if tag.strip()}
+
+        return Handler
+
+    def start_server(self, port: int = DEFAULT_PORT, host: str = LOCALHOST):
+        self.server = start_server(self.make_handler(), port, host, request_queue_size=512)
+        return self.server
+
+    def serve_forever(self, refresh: float = DEFAULT_REFRESH):
+        while not self.stopping.wait(refresh):
+            self.refresh()
+
+    def stop(self):
+        self.stopping.set()
+
+    def close(self):
+        close_server(self.server)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db")
+    parser.add_argument("--meetings", help="only serve the meetings in this file, one ID per line")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--refresh", type=float, default=DEFAULT_REFRESH,
+                        help="seconds between checks for newly ingested data")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    meeting_ids = None
+    if args.meetings:
+        with open(args.meetings) as f:
+            meeting_ids = [line.strip() for line in f.read().splitlines() if line.strip()]
+
+    report_server = ReportServer(DbHelper(args.db), meeting_ids)
+    stop_on_signals(report_server.stop)
+    report_server.start_server(args.port)
+    print(f"Report server: serving {len(report_server.snapshot.topics)} meetings on http://127.0.0.1:{args.port}/")
+    try:
+        report_server.serve_forever(args.refresh)
+    finally:
+        report_server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import email.utils
+import json
+import sqlite3
+import threading
+import time
+import urllib.parse
+import zlib
+from typing import Dict, Optional
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+from processor.instrumentation import tracer
+
+MINUTE = 60
+DAY = 24 * 60 * MINUTE
+# Like HTTP's heuristic freshness, a response whose data last changed N days ago is trusted for N / 10 days
+HEURISTIC_FRACTION = 0.1
+MAX_BYTES = 64 * 1024 * 1024
+KEPT_HEADERS = ["Content-Type", "ETag", "Last-Modified"]
+
+
+class CacheEntry:
+    def __init__(self, key: str, status: int, headers: Dict[str, str], body: bytes, expires_at: float):
+        self.key = key
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires_at = expires_at
+
+    def fresh(self, now: float) -> bool:
+        return now < self.expires_at
+
+    def conditional_headers(self) -> Dict[str, str]:
+        """
+        Headers that let the server answer 304 Not Modified instead of sending the body again.
+        """
+        headers = {}
+        if "ETag" in self.headers:
+            headers["If-None-Match"] = self.headers["ETag"]
+        if "Last-Modified" in self.headers:
+            headers["If-Modified-Since"] = self.headers["Last-Modified"]
+        return headers
+
+    def response(self, url: str) -> Response:
+        r = Response()
+        r.status_code = self.status
+        r.headers = CaseInsensitiveDict(self.headers)
+        r._content = self.body
+        r.encoding = "utf-8"
+        r.url = url
+        r.from_cache = True
+        return r
+
+
+class ResponseCache:
+    """
+    On-disk cache of Zoom API responses, keyed by endpoint, URL and query params.
+    Only endpoints with a TTL are cached. Bodies are stored zlib-compressed, and once the store grows past
+    max_bytes the least recently used responses are evicted.
+    Safe to share between threads.
+    """
+    def __init__(self, path: str, ttls: Dict[str, float], max_bytes: int = MAX_BYTES, clock=time.time):
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "revalidated": 0, "stored": 0, "evicted": 0}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            PRAGMA journal_mode = wal;
+            CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, status INTEGER, headers TEXT, body BLOB,
+                                                 size INTEGER, expires_at REAL, accessed_at REAL);
+            CREATE INDEX IF NOT EXISTS response_accessed_at ON response (accessed_at);
+        """)
+
+    def cacheable(self, endpoint: str) -> bool:
+        return self.ttls.get(endpoint, 0) > 0
+
+    @staticmethod
+    def key(endpoint: str, url: str, params: Optional[Dict] = None) -> str:
+        query = urllib.parse.urlencode(sorted((params or {}).items()))
+        return f"{endpoint} {url}?{query}"
+
+    def lookup(self, endpoint: str, url: str, params: Optional[Dict] = None) -> Optional[CacheEntry]:
+        """
+        Returns the stored response, fresh or not, or None if there is none.
+        """
+        key = self.key(endpoint, url, params)
+        with self.lock:
+            row = self.db.execute("SELECT status, headers, body, expires_at FROM response WHERE key = ?",
+                                  (key,)).fetchone()
+            if row is None:
+                self.count("misses")
+                return None
+            status, headers, body, expires_at = row
+            entry = CacheEntry(key, status, json.loads(headers), zlib.decompress(body), expires_at)
+            if entry.fresh(self.clock()):
+                self.count("hits")
+                self.db.execute("UPDATE response SET accessed_at = ? WHERE key = ?", (self.clock(), key))
+                self.db.commit()
+            else:
+                self.count("stale")
+            return entry
+
+    def lifetime(self, endpoint: str, last_modified: Optional[float]) -> float:
+        ttl = self.ttls.get(endpoint, 0)
+        if last_modified is not None:
+            ttl = min(ttl, HEURISTIC_FRACTION * max(0.0, self.clock() - last_modified))
+        return ttl
+
+    def store(self, endpoint: str, url: str, params: Optional[Dict], response: Response,
+              last_modified: Optional[float] = None):
+        """
+        Stores a successful response. last_modified, in epoch seconds, is when its data last changed,
+        which shortens how long it is trusted. It defaults to the Last-Modified header.
+        """
+        if response.status_code != 200:
+            return
+        if last_modified is None:
+            last_modified = self.parse_http_date(response.headers.get("Last-Modified"))
+        headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+        body = zlib.compress(response.content)
+        now = self.clock()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (self.key(endpoint, url, params), response.status_code, json.dumps(headers), body,
+                             len(body), now + self.lifetime(endpoint, last_modified), now))
+            self.count("stored")
+            self.evict()
+            self.db.commit()
+
+    def revalidated(self, endpoint: str, entry: CacheEntry, last_modified: Optional[float] = None):
+        """
+        The server answered 304 Not Modified, so the stored response is good for another lifetime.
+        """
+        if last_modified is None:
+            last_modified = self.parse_http_date(entry.headers.get("Last-Modified"))
+        now = self.clock()
+        entry.expires_at = now + self.lifetime(endpoint, last_modified)
+        with self.lock:
+            self.db.execute("UPDATE response SET expires_at = ?, accessed_at = ? WHERE key = ?",
+                            (entry.expires_at, now, entry.key))
+            self.count("revalidated")
+            self.db.commit()
+
+    def evict(self):
+        size, = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM response").fetchone()
+        if size <= self.max_bytes:
+            return
+        for key, entry_size in self.db.execute("SELECT key, size FROM response ORDER BY accessed_at").fetchall():
+            self.db.execute("DELETE FROM response WHERE key = ?", (key,))
+            self.count("evicted")
+            size -= entry_size
+            if size <= self.max_bytes:
+                return
+
+    def count(self, stat: str):
+        self.stats[stat] += 1
+        tracer.count(f"response_cache.{stat}")
+
+    def size(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM response").fetchone()[0]
+
+    def print_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        print(f"Zoom response cache: {stats['hits']} hits, {stats['revalidated']} revalidated, "
+              f"{stats['stale']} stale, {stats['misses']} misses, {stats['evicted']} evicted")
+
+    @staticmethod
+    def parse_http_date(value: Optional[str]) -> Optional[float]:
+        if not value:
+            return None
+        try:
+            return email.utils.parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,155 @@
+import datetime
+import json
+from typing import Dict, List, Tuple
+
+from processor.instrumentation import tracer
+from processor.model import SheetSnapshot
+
+# Well under the ~10MB request limit of the Sheets API, so a chunk uploads in one quick request
+MAX_CHUNK_BYTES = 1024 * 1024
+# Unchanged cells between two changed ones in a row are rewritten when the gap is this small,
+# which saves a range per gap
+MAX_GAP = 2
+
+# (top, left, bottom, right), zero-based and inclusive
+Block = Tuple[int, int, int, int]
+
+
+def column_letter(index: int) -> str:
+    """
+    Zero-based column index to its A1 letters, e.g. 0 -> A, 26 -> AA
+    """
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def a1_range(block: Block) -> str:
+    top, left, bottom, right = block
+    return f"{column_letter(left)}{top + 1}:{column_letter(right)}{bottom + 1}"
+
+
+def cell(values: List[List], row: int, column: int):
+    if row >= len(values) or column >= len(values[row]):
+        return ""
+    return values[row][column]
+
+
+def changed_runs(old: List, new: List) -> List[Tuple[int, int]]:
+    runs = []
+    for column in range(max(len(old), len(new))):
+        old_value = old[column] if column < len(old) else ""
+        new_value = new[column] if column < len(new) else ""
+        if old_value == new_value:
+            continue
+        if runs and column - runs[-1][1] <= MAX_GAP + 1:
+            runs[-1] = (runs[-1][0], column)
+        else:
+            runs.append((column, column))
+    return runs
+
+
+def changed_blocks(previous: List[List], values: List[List]) -> List[Block]:
+    """
+    Returns the rectangles covering every cell that differs between the two grids. Consecutive rows with the same
+    changed columns share a rectangle, so a new date column is a single block.
+    Cells that are no longer in values count as changed to '', so they get cleared.
+    """
+    height = max(len(previous), len(values))
+    blocks = []
+    open_blocks: Dict[Tuple[int, int], int] = {}
+    for row in range(height):
+        old = previous[row] if row < len(previous) else []
+        new = values[row] if row < len(values) else []
+        still_open = {}
+        for run in changed_runs(old, new):
+            still_open[run] = open_blocks.pop(run, row)
+        blocks.extend((top, left, row - 1, right) for (left, right), top in open_blocks.items())
+        open_blocks = still_open
+    blocks.extend((top, left, height - 1, right) for (left, right), top in open_blocks.items())
+    return sorted(blocks)
+
+
+class SheetsWriter:
+    """
+    Uploads a grid of values to a spreadsheet through values().batchUpdate, only sending the cells that changed
+    since the last upload to the same spreadsheet. The changes are split into requests of at most max_chunk_bytes,
+    and each request is retried on rate limit, server and connection errors.
+    Spreadsheets that are written once, like a new sheet per run, don't need their upload kept as a snapshot.
+    """
+    def __init__(self, sheets, max_chunk_bytes: int = MAX_CHUNK_BYTES, max_retries: int = 5):
+        self.sheets = sheets
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+
+    def write(self, spreadsheet_id: str, values: List[List], keep_snapshot: bool = True) -> Dict:
+        # Compare and store what the API will actually receive
+        values = json.loads(json.dumps(values))
+        previous = self.load_snapshot(spreadsheet_id)
+        value_ranges = self.value_ranges(values, changed_blocks(previous, values))
+
+        result = {"spreadsheetId": spreadsheet_id, "requests": 0, "updatedRanges": len(value_ranges),
+                  "updatedCells": 0}
+        for data in self.chunks(value_ranges):
+            with tracer.span("sheets batchUpdate", "http", ranges=len(data)):
+                response = self.sheets.spreadsheets().values().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body={"valueInputOption": "RAW", "data": data}
+                ).execute(num_retries=self.max_retries)
+            result["requests"] += 1
+            result["updatedCells"] += response.get("totalUpdatedCells", 0)
+
+        # Only once every chunk made it, otherwise the next upload sends the missing ones again
+        if keep_snapshot:
+            self.save_snapshot(spreadsheet_id, values)
+        return result
+
+    def value_ranges(self, values: List[List], blocks: List[Block]) -> List[Dict]:
+        """
+        Builds a ValueRange for each block, splitting blocks bigger than a chunk into bands of rows.
+        Blocks taller than they are wide, like a new date column, are sent column by column to keep the payload small.
+        """
+        value_ranges = []
+        for top, left, bottom, right in blocks:
+            band_top, band, band_bytes = top, [], 0
+            for row in range(top, bottom + 1):
+                cells = [cell(values, row, column) for column in range(left, right + 1)]
+                row_bytes = len(json.dumps(cells))
+                if band and band_bytes + row_bytes > self.max_chunk_bytes:
+                    value_ranges.append(self.value_range((band_top, left, row - 1, right), band))
+                    band_top, band, band_bytes = row, [], 0
+                band.append(cells)
+                band_bytes += row_bytes
+            value_ranges.append(self.value_range((band_top, left, bottom, right), band))
+        return value_ranges
+
+    @staticmethod
+    def value_range(block: Block, rows: List[List]) -> Dict:
+        if len(rows[0]) < len(rows):
+            return {"range": a1_range(block), "majorDimension": "COLUMNS", "values": [list(c) for c in zip(*rows)]}
+        return {"range": a1_range(block), "majorDimension": "ROWS", "values": rows}
+
+    def chunks(self, value_ranges: List[Dict]):
+        chunk, chunk_bytes = [], 0
+        for value_range in value_ranges:
+            size = len(json.dumps(value_range))
+            if chunk and chunk_bytes + size > self.max_chunk_bytes:
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append(value_range)
+            chunk_bytes += size
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def load_snapshot(spreadsheet_id: str) -> List[List]:
+        snapshot = SheetSnapshot.get_or_none(SheetSnapshot.spreadsheet_id == spreadsheet_id)
+        return [] if snapshot is None else json.loads(snapshot.values)
+
+    @staticmethod
+    def save_snapshot(spreadsheet_id: str, values: List[List]):
+        SheetSnapshot.replace(spreadsheet_id=spreadsheet_id, values=json.dumps(values),
+                              uploaded=datetime.datetime.now()).execute()
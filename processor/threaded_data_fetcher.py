@@ -0,0 +1,207 @@
+import collections
+import heapq
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from peewee import chunked
+
+from processor.data_fetcher import DataFetcher, ParticipantIngest
+from processor.db_helper import BATCH_SIZE
+from processor.model import Meeting
+
+MAX_WORKERS = 8
+
+
+class OrderedIngest:
+    """
+    Applies downloaded participant pages in the order a sequential run would: meeting by meeting, and
+    instance by instance within a meeting. Pages that arrive early are held until their turn, so which
+    record creates a Participant, and so its id and name, doesn't depend on how the downloads interleave.
+    To bound what is held, start() only lets a few instances be downloaded ahead of the one being stored.
+    """
+    def __init__(self, db, meetings):
+        self.db = db
+        self.order = [None] * meetings
+        self.ingests = {}
+        self.pages = collections.defaultdict(list)
+        self.downloaded = set()
+        # Instances not started yet, by meeting index and position, and those started but not stored
+        self.waiting = []
+        self.active = set()
+        self.meeting = 0
+        self.instance = 0
+
+    def expect(self, index, meeting_instances):
+        """
+        Sets which instances of the index-th meeting will be downloaded.
+        """
+        self.order[index] = [mi.uuid for mi in meeting_instances]
+        for position, mi in enumerate(meeting_instances):
+            self.ingests[mi.uuid] = ParticipantIngest(self.db, mi)
+            heapq.heappush(self.waiting, (index, position, mi.uuid))
+
+    def next_uuid(self):
+        """
+        The instance to be stored next, or None until the meeting it belongs to is known.
+        """
+        meeting, instance = self.meeting, self.instance
+        while meeting < len(self.order) and self.order[meeting] is not None:
+            if instance < len(self.order[meeting]):
+                return self.order[meeting][instance]
+            meeting += 1
+            instance = 0
+        return None
+
+    def start(self, limit):
+        """
+        Returns the instances to download now, in order, keeping at most limit of them downloading or
+        waiting to be stored. The instance to be stored next always starts, so the writer never waits on a
+        download that can't begin.
+        """
+        started = []
+        while self.waiting and (len(self.active) < limit or self.waiting[0][2] == self.next_uuid()):
+            uuid = heapq.heappop(self.waiting)[2]
+            self.active.add(uuid)
+            started.append(uuid)
+        return started
+
+    def add_page(self, uuid, page):
+        self.pages[uuid].append(page)
+
+    def finish(self, uuid):
+        self.downloaded.add(uuid)
+
+    def drain(self):
+        """
+        Stores everything that is next in order and has arrived.
+        """
+        while self.meeting < len(self.order) and self.order[self.meeting] is not None:
+            uuids = self.order[self.meeting]
+            if self.instance == len(uuids):
+                self.meeting += 1
+                self.instance = 0
+                continue
+            uuid = uuids[self.instance]
+            ingest = self.ingests[uuid]
+            for page in self.pages.pop(uuid, []):
+                for batch in chunked(page, BATCH_SIZE):
+                    ingest.add(batch)
+            if uuid not in self.downloaded:
+                return
+            del self.ingests[uuid]
+            self.active.discard(uuid)
+            ingest.finish()
+            DataFetcher.mark_cached(ingest.meeting_instance)
+            self.instance += 1
+
+
+class ThreadedDataFetcher(DataFetcher):
+    """
+    DataFetcher that downloads a batch of meetings on a pool of worker threads.
+
+    Call prefetch() with the meeting ids before generating a report. Meetings, and the participants of
+    their instances, are downloaded in parallel, sharing the ZoomHelper's rate limits. peewee connections
+    are per thread, so the workers never touch the DB: they hand what they download to a queue, and the
+    calling thread is the single writer. Afterwards the usual synchronous report path reads the instances
+    from memory and the participants from the DB cache.
+    """
+    def __init__(self, db, zoom, incremental=False, max_workers=MAX_WORKERS):
+        super().__init__(db, zoom, incremental)
+        self.max_workers = max_workers
+        self.past_meeting_instances = {}
+
+    def prefetch(self, meeting_ids):
+        meeting_ids = list(dict.fromkeys(meeting_ids))
+        # Bounded, and only a few instances are downloaded ahead of the one being stored,
+        # so downloads wait for the writer instead of piling up in memory
+        writes = queue.Queue(maxsize=4 * self.max_workers)
+        ordered = OrderedIngest(self.db, len(meeting_ids))
+        futures = []
+        error = None
+
+        with ThreadPoolExecutor(self.max_workers, thread_name_prefix="zoom-fetch") as executor:
+            def submit(task, *args):
+                futures.append(executor.submit(self.run_task, writes, task, *args))
+
+            for index, meeting_id in enumerate(meeting_ids):
+                meeting = Meeting.get_or_none(Meeting.meeting_id == meeting_id)
+                submit(self.download_meeting, index, meeting_id, meeting is None)
+
+            running = len(futures)
+            while running:
+                kind, *args = writes.get()
+                if kind == "done":
+                    running -= 1
+                    continue
+                if error is not None:
+                    continue
+                try:
+                    if kind == "error":
+                        raise args[0]
+                    if kind == "meeting":
+                        self.store_meeting(ordered, *args)
+                    elif kind == "page":
+                        ordered.add_page(*args)
+                    elif kind == "downloaded":
+                        ordered.finish(*args)
+                    ordered.drain()
+                    for uuid in ordered.start(2 * self.max_workers):
+                        submit(self.download_participants, uuid)
+                        running += 1
+                except Exception as e:
+                    error = e
+                    # Tasks that haven't started never report back, and the rest are drained without storing
+                    running -= sum(f.cancel() for f in futures)
+
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def run_task(writes, task, *args):
+        try:
+            task(writes, *args)
+        except Exception as e:
+            writes.put(("error", e))
+        finally:
+            writes.put(("done",))
+
+    def download_meeting(self, writes, index, meeting_id, fetch_details):
+        topic = None
+        if fetch_details:
+            response = self.zoom.get_meeting_details(meeting_id)
+            if not response.ok:
+                print(f"Response failed with code {response.status_code} for meeting {meeting_id}")
+                raise RuntimeError
+            topic = response.json().get("topic")
+
+        response = self.zoom.get_past_meeting_instances(meeting_id)
+        if not response.ok:
+            print(f"Response failed with code {response.status_code} for meeting {meeting_id}")
+            raise RuntimeError
+        writes.put(("meeting", index, meeting_id, fetch_details, topic, response.json().get("meetings")))
+
+    def download_participants(self, writes, uuid):
+        for page in self.zoom.iter_meeting_participant_pages(uuid):
+            writes.put(("page", uuid, page))
+        writes.put(("downloaded", uuid))
+
+    def store_meeting(self, ordered, index, meeting_id, fetched_details, topic, instances_json):
+        """
+        Stores a downloaded meeting and its instances, returning the instances whose participants are missing.
+        """
+        if fetched_details:
+            meeting = self.store_meeting_details(meeting_id, topic)
+        else:
+            meeting = Meeting.get(Meeting.meeting_id == meeting_id)
+        meeting_instances = self.store_past_meeting_instances(meeting, instances_json)
+        self.past_meeting_instances[str(meeting.meeting_id)] = meeting_instances
+
+        uncached = [mi for mi in meeting_instances if not mi.cached]
+        ordered.expect(index, uncached)
+        return uncached
+
+    def fetch_past_meeting_instances(self, meeting):
+        meeting_instances = self.past_meeting_instances.get(str(meeting.meeting_id))
+        if meeting_instances is None:
+            return super().fetch_past_meeting_instances(meeting)
+        return meeting_instances
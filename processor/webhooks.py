@@ -0,0 +1,332 @@
+"""
+Receives Zoom webhook events for meetings and their participants, and writes them to the DB as they arrive.
+An instance whose every event was received, from meeting.started to meeting.ended, is marked cached,
+so its participants never get downloaded from the report API.
+
+    export ZOOM_WEBHOOK_SECRET=<the app's secret token>
+    python processor/webhooks.py serve prod.db --port 8082
+
+    # Sign and send recorded events to a receiver, for local testing
+    python processor/webhooks.py replay events.json http://127.0.0.1:8082/
+"""
+import argparse
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+from processor.data_fetcher import DataFetcher, ParticipantIngest
+from processor.db_helper import DbHelper
+from processor.instrumentation import tracer
+from processor.local_server import LOCALHOST, close_server, json_handler, start_server, stop_on_signals
+from processor.model import Meeting, MeetingInstance
+
+SIGNATURE_VERSION = "v0"
+# Requests signed longer ago than this are refused, so a captured request can't be replayed later
+MAX_CLOCK_SKEW = 300
+DEFAULT_PORT = 8082
+QUEUE_SIZE = 10000
+# Queued events the writer commits together in one transaction
+EVENT_BATCH_SIZE = 100
+
+URL_VALIDATION = "endpoint.url_validation"
+MEETING_STARTED = "meeting.started"
+MEETING_ENDED = "meeting.ended"
+PARTICIPANT_JOINED = "meeting.participant_joined"
+PARTICIPANT_LEFT = "meeting.participant_left"
+EVENTS = {MEETING_STARTED, MEETING_ENDED, PARTICIPANT_JOINED, PARTICIPANT_LEFT}
+
+
+def sign(secret: str, timestamp: str, body: bytes) -> str:
+    """
+    The x-zm-signature header Zoom sends with a request body.
+    """
+    message = f"{SIGNATURE_VERSION}:{timestamp}:".encode() + body
+    return f"{SIGNATURE_VERSION}=" + hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def verify_signature(secret: str, timestamp: Optional[str], body: bytes, signature: Optional[str],
+                     now: Optional[float] = None) -> bool:
+    if not timestamp or not signature:
+        return False
+    try:
+        age = abs((time.time() if now is None else now) - int(timestamp))
+    except ValueError:
+        return False
+    return age <= MAX_CLOCK_SKEW and hmac.compare_digest(sign(secret, timestamp, body), signature)
+
+
+def participant_record(participant: Dict) -> Dict:
+    """
+    A webhook participant in the shape of a record from the participants report.
+    """
+    return {"id": participant.get("id") or "",
+            "name": participant.get("user_name") or "",
+            "user_email": participant.get("email") or "",
+            "join_time": participant.get("join_time")}
+
+
+def participant_key(participant: Dict) -> str:
+    return participant.get("participant_uuid") or participant.get("user_id") or participant.get("user_name") or ""
+
+
+class InstanceEvents:
+    """
+    What has been received for a meeting instance that hasn't ended yet.
+    """
+    def __init__(self, ingest: ParticipantIngest, covered: bool):
+        self.ingest = ingest
+        # Whether meeting.started was received, so no participant events can have been missed before it
+        self.covered = covered
+        # Join records of the participants still in the meeting, by participant_key
+        self.present = {}
+        # Records waiting for the end of the batch: joins, and joins completed by a leave
+        self.joins = []
+        self.intervals = []
+        # Zoom redelivers events that weren't acknowledged in time
+        self.seen = set()
+
+
+class EventWriter:
+    """
+    Applies batches of webhook events to the DB, each in one transaction. Participants go through the same
+    ParticipantIngest as the participants report, so they are resolved and deduplicated the same way.
+    Only used from the thread that owns the DB connection.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.instances: Dict[str, InstanceEvents] = {}
+
+    def apply(self, events: List[Dict]):
+        touched = {}
+        ended = []
+        with tracer.span("apply webhook events", events=len(events)), self.db.db.atomic():
+            for event in events:
+                name = event.get("event")
+                meeting = event["payload"]["object"]
+                state = self.instance(meeting, started=name == MEETING_STARTED)
+                if state is None:
+                    continue
+                touched[meeting["uuid"]] = state
+                if name == MEETING_ENDED:
+                    ended.append((meeting["uuid"], meeting.get("end_time")))
+                elif name in (PARTICIPANT_JOINED, PARTICIPANT_LEFT):
+                    self.participant_event(state, event)
+
+            for state in touched.values():
+                self.flush(state)
+            for uuid, end_time in ended:
+                self.finish(uuid, end_time)
+        tracer.count("webhooks.events_applied", len(events))
+
+    def instance(self, meeting: Dict, started: bool) -> Optional[InstanceEvents]:
+        """
+        The state of the event's instance, storing the Meeting and MeetingInstance on its first event.
+        None when the instance is already cached, as there's nothing left to record.
+        """
+        uuid = meeting["uuid"]
+        state = self.instances.get(uuid)
+        if state is not None:
+            return state
+        topic = meeting.get("topic") or ""
+        stored, _ = Meeting.get_or_create(meeting_id=str(meeting["id"]), defaults={'topic': topic})
+        start_time = datetime.datetime.strptime(meeting["start_time"], '%Y-%m-%dT%H:%M:%SZ')
+        meeting_instance, _ = MeetingInstance.get_or_create(uuid=uuid, defaults={'meeting': stored,
+                                                                                 'start_time': start_time})
+        if meeting_instance.cached:
+            return None
+        if not started:
+            print(f"Webhooks: instance {uuid} started before its events were received, it will be polled instead")
+        state = self.instances[uuid] = InstanceEvents(ParticipantIngest(self.db, meeting_instance), started)
+        return state
+
+    @staticmethod
+    def participant_event(state: InstanceEvents, event: Dict):
+        participant = event["payload"]["object"].get("participant", {})
+        key = participant_key(participant)
+        delivery = (event["event"], event.get("event_ts"), key)
+        if delivery in state.seen:
+            return
+        state.seen.add(delivery)
+
+        if event["event"] == PARTICIPANT_JOINED:
+            record = participant_record(participant)
+            state.present[key] = record
+            state.joins.append(record)
+            return
+        record = state.present.pop(key, None)
+        if record is None:
+            # The join went missing, so this instance's attendance can't be trusted
+            state.covered = False
+            return
+        state.intervals.append({**record, "leave_time": participant.get("leave_time")})
+
+    def flush(self, state: InstanceEvents):
+        if state.joins:
+            state.ingest.add(state.joins, intervals=False)
+            state.joins = []
+        if state.intervals:
+            participants = DataFetcher.resolve_participants(state.intervals, self.db.participant_index)
+            state.ingest.add_intervals(state.intervals, participants)
+            state.intervals = []
+
+    def finish(self, uuid: str, end_time: Optional[str]):
+        state = self.instances.pop(uuid, None)
+        if state is None:
+            # meeting.ended was delivered twice in one batch
+            return
+        # Whoever is still in the meeting leaves when it ends
+        state.intervals = [{**record, "leave_time": end_time} for record in state.present.values()]
+        self.flush(state)
+        meeting_instance = state.ingest.meeting_instance
+        if state.covered:
+            DataFetcher.mark_cached(meeting_instance)
+            tracer.count("webhooks.instances_covered")
+        print(f"Webhooks: meeting instance {uuid} ended with {len(state.ingest.participants)} participants, "
+              f"{'stored' if state.covered else 'to be polled'}")
+
+
+class WebhookReceiver:
+    """
+    Verifies webhook requests and queues their events, which flush() writes to the DB in batches.
+    The HTTP server answers from its own threads, so a slow write never delays the acknowledgement Zoom waits for,
+    while flush() runs on the thread that owns the DB connection.
+    """
+    def __init__(self, db, secret: str, queue_size: int = QUEUE_SIZE, batch_size: int = EVENT_BATCH_SIZE,
+                 clock=time.time):
+        self.secret = secret
+        self.events = queue.Queue(queue_size)
+        self.writer = EventWriter(db)
+        self.batch_size = batch_size
+        self.clock = clock
+        self.stopping = threading.Event()
+        self.server = None
+
+    def handle(self, headers, body: bytes) -> Tuple[int, Dict]:
+        """
+        Returns (HTTP status, response body) for a webhook request.
+        """
+        if not verify_signature(self.secret, headers.get("x-zm-request-timestamp"), body,
+                                headers.get("x-zm-signature"), self.clock()):
+            tracer.count("webhooks.rejected")
+            return 401, {"error": "invalid signature"}
+        try:
+            event = json.loads(body)
+        except ValueError:
+            return 400, {"error": "invalid JSON"}
+
+        name = event.get("event")
+        if name == URL_VALIDATION:
+            plain_token = event["payload"]["plainToken"]
+            encrypted_token = hmac.new(self.secret.encode(), plain_token.encode(), hashlib.sha256).hexdigest()
+            return 200, {"plainToken": plain_token, "encryptedToken": encrypted_token}
+        if name not in EVENTS:
+            return 200, {}
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            # Zoom retries failed deliveries, by then the writer has caught up
+            tracer.count("webhooks.queue_full")
+            return 503, {"error": "busy"}
+        tracer.count("webhooks.received")
+        return 200, {}
+
+    def flush(self, timeout: float = 0) -> int:
+        """
+        Writes up to batch_size queued events in one transaction, waiting up to timeout seconds for the first one.
+        Returns how many were written.
+        """
+        try:
+            batch = [self.events.get(timeout=timeout) if timeout else self.events.get_nowait()]
+        except queue.Empty:
+            return 0
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        self.writer.apply(batch)
+        return len(batch)
+
+    def drain(self) -> int:
+        written = 0
+        while True:
+            n = self.flush()
+            if not n:
+                return written
+            written += n
+
+    def serve_forever(self, poll: float = 1.0):
+        while not self.stopping.is_set():
+            self.flush(timeout=poll)
+        self.drain()
+
+    def stop(self):
+        self.stopping.set()
+
+    def start_server(self, port: int = DEFAULT_PORT, host: str = LOCALHOST):
+        self.server = start_server(json_handler(post=self.handle), port, host)
+        return self.server
+
+    def close(self):
+        close_server(self.server)
+
+
+def replay(events: List[Dict], url: str, secret: str) -> List[int]:
+    """
+    Signs recorded events as Zoom would and posts them to a receiver, returning the response statuses.
+    """
+    statuses = []
+    for event in events:
+        body = json.dumps(event).encode()
+        timestamp = str(int(time.time()))
+        response = requests.post(url, data=body, headers={"Content-Type": "application/json",
+                                                          "x-zm-request-timestamp": timestamp,
+                                                          "x-zm-signature": sign(secret, timestamp, body)})
+        statuses.append(response.status_code)
+    return statuses
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="receive events and write them to the DB")
+    serve.add_argument("db")
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    replay_parser = commands.add_parser("replay", help="send recorded events to a receiver")
+    replay_parser.add_argument("events_file", help="a JSON list of event payloads")
+    replay_parser.add_argument("url")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    secret = os.environ["ZOOM_WEBHOOK_SECRET"]
+
+    if args.command == "replay":
+        with open(args.events_file) as f:
+            statuses = replay(json.load(f), args.url, secret)
+        print(f"Replayed {len(statuses)} events, {sum(1 for s in statuses if s != 200)} failed")
+        return 0 if all(s == 200 for s in statuses) else 1
+
+    receiver = WebhookReceiver(DbHelper(args.db), secret)
+    stop_on_signals(receiver.stop)
+    receiver.start_server(args.port)
+    print(f"Webhooks: listening on http://127.0.0.1:{args.port}/")
+    try:
+        receiver.serve_forever()
+    finally:
+        receiver.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,254 @@
+import asyncio
+import collections
+import datetime
+import email.utils
+import functools
+import random
+import threading
 import time
-from typing import Any, Dict, Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
-import requests
-from authlib.jose import jwt
 from requests import Response
-from ratelimit import limits
 import urllib.parse
 
+from processor.http_session import make_session, reset_connection_timings, get_connection_timings
+from processor.instrumentation import tracer
+from processor.response_cache import ResponseCache, CacheEntry, DAY, MINUTE
+
+ZOOM_URL = "https://api.zoom.us/v2"
 # see https://marketplace.zoom.us/docs/api-reference/rate-limits#rate-limits
 ONE_SECOND = 1
 HEAVY_CALLS = 9
 MEDIUM_CALLS = 19
+HEAVY = "heavy"
+MEDIUM = "medium"
+PARTICIPANTS = "participants"
+MEETING_DETAILS = "meeting_details"
+PAST_MEETING_INSTANCES = "past_meeting_instances"
+# How long a ResponseCache may serve each endpoint without asking Zoom. Participants are kept in the DB instead.
+# A meeting can run again at any time, so its instance list is only reused by runs a few minutes apart.
+RESPONSE_CACHE_TTLS = {MEETING_DETAILS: 30 * DAY, PAST_MEETING_INSTANCES: 5 * MINUTE}
+# How often a caller checks again for a free slot while every slot of the window is in flight
+IN_FLIGHT_POLL = 0.01
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.wire_time = 0.0
+        self.max_wire_time = 0.0
+
+    def record_wait(self, seconds: float):
+        with self.lock:
+            self.wait_time += seconds
+            self.max_wait_time = max(self.max_wait_time, seconds)
+
+    def record_response(self, response: Response, seconds: float):
+        with self.lock:
+            self.requests += 1
+            self.wire_time += seconds
+            self.max_wire_time = max(self.max_wire_time, seconds)
+            if response.status_code == 429:
+                self.throttled += 1
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def summary(self) -> Dict[str, Union[int, float]]:
+        with self.lock:
+            return {"requests": self.requests,
+                    "retries": self.retries,
+                    "throttled": self.throttled,
+                    "wait_time": round(self.wait_time, 3),
+                    "max_wait_time": round(self.max_wait_time, 3),
+                    "wire_time": round(self.wire_time, 3),
+                    "max_wire_time": round(self.max_wire_time, 3)}
+
+
+class TokenBucket:
+    """
+    Hands out `rate` tokens per second, up to `capacity` at once.
+    Tokens are reserved under a lock and the caller sleeps (or awaits) outside of it, so a single bucket
+    can be shared by threads and async tasks alike.
+
+    Spacing tokens out isn't enough on its own: a request can reach Zoom any time between being sent and its
+    response coming back, so on top of it at most `limit` requests are let through per `window` seconds.
+    A request holds its slot until release() is called with its response, and the slot only frees up
+    `window` seconds after that, so no window at Zoom's end can see more than `limit` of them.
+    """
+    def __init__(self, rate: float, capacity: float = 1, clock=time.monotonic, limit: Optional[int] = None,
+                 window: float = ONE_SECOND):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+        self.paused_until = 0.0
+        self.limit = limit if limit is not None else max(1, int(rate * window))
+        self.window = window
+        self.in_flight = 0
+        # When each request of the last window got its response, oldest first
+        self.finished = collections.deque()
+        self.lock = threading.Lock()
+        self.metrics = RequestMetrics()
+
+    def reserve(self) -> float:
+        """
+        Takes a token, going into debt if there is none, and returns how long to wait before using it.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(wait, self.paused_until - now)
+
+    def claim(self) -> Optional[float]:
+        """
+        Takes a slot of the window and returns None, or returns how long to wait before trying again when
+        `limit` requests are in flight or got their response less than `window` seconds ago.
+        """
+        with self.lock:
+            now = self.clock()
+            while self.finished and self.finished[0] <= now - self.window:
+                self.finished.popleft()
+            if self.in_flight + len(self.finished) < self.limit:
+                self.in_flight += 1
+                return None
+            if not self.finished:
+                return IN_FLIGHT_POLL
+            return self.finished[0] + self.window - now
+
+    def release(self):
+        """
+        Gives back the slot taken by claim() once the request's response is in.
+        """
+        with self.lock:
+            self.in_flight -= 1
+            self.finished.append(self.clock())
+
+    def pause(self, seconds: float):
+        """
+        Holds back every caller for `seconds`, e.g. when Zoom answers with a Retry-After.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+    def acquire(self) -> float:
+        """
+        Waits for a token and a slot of the window. The caller must release() the slot when the request is done.
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        retry = self.claim()
+        while retry is not None:
+            time.sleep(retry)
+            wait += retry
+            retry = self.claim()
+        self.metrics.record_wait(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        retry = self.claim()
+        while retry is not None:
+            await asyncio.sleep(retry)
+            wait += retry
+            retry = self.claim()
+        self.metrics.record_wait(wait)
+        return wait
+
+
+class ConnectionMetrics:
+    """
+    Totals of the per-request timings, to see how much of a run is spent setting up connections.
+    """
+    PHASES = ["dns", "connect", "tls", "first_byte", "total"]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.totals = {phase: 0.0 for phase in self.PHASES}
+
+    def record(self, timings: Dict[str, float]):
+        with self.lock:
+            self.requests += 1
+            if timings["connect"] > 0:
+                self.new_connections += 1
+            for phase in self.PHASES:
+                self.totals[phase] += timings[phase]
+
+    def summary(self) -> Dict[str, Union[int, float]]:
+        with self.lock:
+            summary = {"requests": self.requests, "new_connections": self.new_connections}
+            summary.update({phase: round(seconds, 3) for phase, seconds in self.totals.items()})
+            return summary
+
+
+class JwtTokenProvider:
+    """
+    Caches a signed JWT and signs a new one `refresh_margin` seconds before it expires.
+    token() only holds the lock while checking or signing, so one provider can be shared by threads and async tasks.
+    """
+    def __init__(self, generate: Callable[[], bytes], lifetime: float, refresh_margin: float = 300,
+                 clock=time.time):
+        self.generate = generate
+        self.lifetime = lifetime
+        self.refresh_margin = min(refresh_margin, lifetime / 2)
+        self.clock = clock
+        self.current: Optional[bytes] = None
+        self.expires_at = 0.0
+        self.refreshes = 0
+        self.lock = threading.Lock()
+
+    def token(self) -> bytes:
+        with self.lock:
+            now = self.clock()
+            if self.current is None or now >= self.expires_at - self.refresh_margin:
+                self.current = self.generate()
+                self.expires_at = now + self.lifetime
+                self.refreshes += 1
+            return self.current
+
+    def invalidate(self, token: bytes):
+        """
+        Drops the cached token if it is still `token`, so that callers which got a 401 with the same
+        token at the same time only cause a single refresh.
+        """
+        with self.lock:
+            if self.current == token:
+                self.current = None
+
+
+def make_rate_limits(processes: int = 1) -> Dict[str, TokenBucket]:
+    """
+    Zoom's limits apply to the whole account, so processes calling it at the same time each get their share.
+    """
+    return {HEAVY: TokenBucket(HEAVY_CALLS / processes, limit=max(1, HEAVY_CALLS // processes)),
+            MEDIUM: TokenBucket(MEDIUM_CALLS / processes, limit=max(1, MEDIUM_CALLS // processes))}
+
+
+# One bucket per Zoom rate limit category, shared by every ZoomHelper in the process
+RATE_LIMITS: Dict[str, TokenBucket] = make_rate_limits()
 
 
 class ZoomHelper:
-    def __init__(self, base_url: str, api_key: str, api_secret: str):
+    def __init__(self, base_url: str, api_key: str, api_secret: str,
+                 pool_size: int = HEAVY_CALLS + MEDIUM_CALLS,
+                 timeout: Tuple[float, float] = (5, 60),
+                 response_cache: Optional[ResponseCache] = None):
         self.api_key = api_key
         self.api_secret = api_secret
         self.base_url = base_url
@@ -22,13 +256,47 @@ class ZoomHelper:
         self.past_meetings_url = f"{self.base_url}/past_meetings"
         self.jwt_token_exp = 1800
         self.jwt_token_algo = "HS256"
+        self.rate_limits = RATE_LIMITS
+        self.max_retries = 5
+        self.backoff_base = 0.5
+        self.backoff_cap = 30
+        # (connect, read) timeouts in seconds
+        self.timeout = timeout
+        self.session = make_session(pool_size)
+        self.connection_metrics = ConnectionMetrics()
+        self.tokens = JwtTokenProvider(self.generate_jwt_token, self.jwt_token_exp)
+        self.response_cache = response_cache
 
-    @limits(calls=HEAVY_CALLS, period=ONE_SECOND)
     def get_meeting_participants(self,
                                  meeting_id: str,
-                                 jwt_token: bytes,
+                                 jwt_token: Optional[bytes] = None,
                                  next_page_token: Optional[str] = None) -> Response:
+        url, query_params = self.meeting_participants_request(meeting_id, next_page_token)
+        print(f"Zoom: Getting participants for {meeting_id}")
+        return self.request(HEAVY, PARTICIPANTS, url, jwt_token, query_params)
+
+    def iter_meeting_participant_pages(self, meeting_id: str, jwt_token: Optional[bytes] = None) -> Iterator[List[Dict]]:
+        """
+        Follows next_page_token through every page of participants of a meeting, parsing each page once.
+        Yields the records of one page at a time, so only the current page is held in memory.
+        """
+        next_page_token = None
+        while True:
+            response = self.get_meeting_participants(meeting_id, jwt_token, next_page_token)
+            if not response.ok:
+                print(f"Response failed with code {response.status_code} for meeting {meeting_id}")
+                raise RuntimeError
+            page = response.json()
+            yield page.get("participants")
+            next_page_token = page.get("next_page_token")
+            if not next_page_token:
+                return
+
+    def iter_meeting_participants(self, meeting_id: str, jwt_token: Optional[bytes] = None) -> Iterator[Dict]:
+        for page in self.iter_meeting_participant_pages(meeting_id, jwt_token):
+            yield from page
 
+    def meeting_participants_request(self, meeting_id: str, next_page_token: Optional[str] = None):
         encoded_meeting_id = str(meeting_id)
         # Encode the meetingId twice to handle meetingIds that have slashes in them
         # See https://devforum.zoom.us/t/uuid-with-a-slash-failed-get-meetings-info/10433/2
@@ -41,13 +309,12 @@ class ZoomHelper:
         query_params: Dict[str, Union[int, str]] = {"page_size": 300}
         if next_page_token:
             query_params.update({"next_page_token": next_page_token})
-        print(f"Zoom: Getting participants for {meeting_id}")
-        r: Response = requests.get(url,
-                                   headers={"Authorization": f"Bearer {jwt_token.decode('utf-8')}"},
-                                   params=query_params)
-        return r
+        return url, query_params
 
     def generate_jwt_token(self) -> bytes:
+        # authlib is only needed once a token is signed, so it stays out of startup
+        from authlib.jose import jwt
+
         iat = int(time.time())
         jwt_payload: Dict[str, Any] = {
             "aud": None,
@@ -60,21 +327,238 @@ class ZoomHelper:
         jwt_token: bytes = jwt.encode(header, jwt_payload, self.api_secret)
         return jwt_token
 
-    @limits(calls=HEAVY_CALLS, period=ONE_SECOND)
     def get_meeting_details(self,
                             meeting_id: str,
-                            jwt_token: bytes) -> Response:
+                            jwt_token: Optional[bytes] = None) -> Response:
         url = f"{self.reports_url}/{meeting_id}"
 
         print(f"Zoom: Getting meeting details for {meeting_id}")
-        r: Response = requests.get(url, headers={"Authorization": f"Bearer {jwt_token.decode('utf-8')}"})
-        return r
+        return self.request(HEAVY, MEETING_DETAILS, url, jwt_token)
 
-    @limits(calls=MEDIUM_CALLS, period=ONE_SECOND)
     def get_past_meeting_instances(self,
                                    meeting_id: str,
-                                   jwt_token: bytes) -> Response:
+                                   jwt_token: Optional[bytes] = None) -> Response:
         url = f"{self.past_meetings_url}/{meeting_id}/instances"
         print(f"Zoom: Getting past meeting instances for {meeting_id}")
-        r: Response = requests.get(url, headers={"Authorization": f"Bearer {jwt_token.decode('utf-8')}"})
+        return self.request(MEDIUM, PAST_MEETING_INSTANCES, url, jwt_token)
+
+    def request(self, category: str, endpoint: str, url: str, jwt_token: Optional[bytes] = None,
+                params: Optional[Dict] = None) -> Response:
+        """
+        Waits for a token of the given rate limit category and sends the request,
+        retrying throttled (429) and server error (5xx) responses.
+        Without an explicit jwt_token, the request is signed with the cached token,
+        which is refreshed and the request replayed once if Zoom answers 401.
+        With a response_cache, fresh cached responses are returned without calling Zoom at all.
+        """
+        entry = self.cache_lookup(endpoint, url, params)
+        if entry is not None and entry.fresh(self.response_cache.clock()):
+            return entry.response(url)
+        headers = entry.conditional_headers() if entry is not None else None
+
+        bucket = self.rate_limits[category]
+        attempt = 0
+        refreshed = False
+        while True:
+            token = jwt_token or self.tokens.token()
+            bucket.acquire()
+            try:
+                r = self.send(bucket, endpoint, url, token, params, headers)
+            finally:
+                bucket.release()
+            if self.should_refresh_token(r, jwt_token, token, refreshed):
+                refreshed = True
+                continue
+            delay = self.retry_delay(bucket, r, attempt)
+            if delay is None:
+                return self.cache_update(endpoint, url, params, r, entry)
+            time.sleep(delay)
+            attempt += 1
+
+    def cache_lookup(self, endpoint: str, url: str, params: Optional[Dict] = None) -> Optional[CacheEntry]:
+        if self.response_cache is None or not self.response_cache.cacheable(endpoint):
+            return None
+        return self.response_cache.lookup(endpoint, url, params)
+
+    def cache_update(self, endpoint: str, url: str, params: Optional[Dict], response: Response,
+                     entry: Optional[CacheEntry]) -> Response:
+        """
+        Stores a new response in the cache, or returns the cached one when Zoom answers 304 Not Modified.
+        """
+        if self.response_cache is None or not self.response_cache.cacheable(endpoint):
+            return response
+        if entry is not None and response.status_code == 304:
+            self.response_cache.revalidated(endpoint, entry)
+            return entry.response(url)
+        self.response_cache.store(endpoint, url, params, response)
+        return response
+
+    def send(self, bucket: TokenBucket, endpoint: str, url: str, jwt_token: bytes,
+             params: Optional[Dict] = None, headers: Optional[Dict] = None) -> Response:
+        tracer.count(f"zoom.{endpoint}.calls")
+        start = time.monotonic()
+        with tracer.span(f"zoom {endpoint}", "http"):
+            r = self.get(url, jwt_token, params, headers)
+        bucket.metrics.record_response(r, time.monotonic() - start)
+        if not r.ok or r.status_code == 304:
+            tracer.count(f"zoom.{endpoint}.status_{r.status_code}")
         return r
+
+    def should_refresh_token(self, response: Response, jwt_token: Optional[bytes], token: bytes,
+                             refreshed: bool) -> bool:
+        if response.status_code != 401 or jwt_token is not None or refreshed:
+            return False
+        print(f"Zoom: Got 401 for {response.url}, refreshing the token")
+        tracer.count("zoom.token_refreshes")
+        self.tokens.invalidate(token)
+        return True
+
+    def retry_delay(self, bucket: TokenBucket, response: Response, attempt: int) -> Optional[float]:
+        """
+        Returns how long to wait before retrying the request, or None if it shouldn't be retried.
+        """
+        if response.status_code != 429 and response.status_code < 500:
+            return None
+        if attempt >= self.max_retries:
+            print(f"Zoom: Giving up on {response.url} after {attempt} retries")
+            return None
+
+        bucket.metrics.record_retry()
+        retry_after = self.parse_retry_after(response.headers.get("Retry-After"))
+        if retry_after is not None:
+            # Zoom told us when to come back, so hold back every caller of this category
+            bucket.pause(retry_after)
+            delay = retry_after
+        else:
+            # Exponential backoff with full jitter
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        print(f"Zoom: Got {response.status_code} for {response.url}, retrying in {delay:.2f}s")
+        return delay
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            # A -0000 offset parses to a naive datetime, which is in UTC all the same
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+            return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def rate_limit_metrics(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        return {category: bucket.metrics.summary() for category, bucket in self.rate_limits.items()}
+
+    def print_rate_limit_metrics(self):
+        for category, metrics in self.rate_limit_metrics().items():
+            print(f"Zoom {category} calls: {metrics['requests']} requests, {metrics['retries']} retries, "
+                  f"{metrics['throttled']} throttled, waited {metrics['wait_time']}s for tokens, "
+                  f"{metrics['wire_time']}s on the wire")
+
+    def get(self, url: str, jwt_token: bytes, params: Optional[Dict] = None,
+            headers: Optional[Dict] = None) -> Response:
+        """
+        Sends the request over the pooled session. The response gets a `timings` dict with the DNS, connect
+        and TLS times (zero on a reused connection), the time to first byte after the connection was set up,
+        and the total time including reading the body.
+        """
+        reset_connection_timings()
+        start = time.perf_counter()
+        r: Response = self.session.get(url,
+                                       headers={"Authorization": f"Bearer {jwt_token.decode('utf-8')}",
+                                                **(headers or {})},
+                                       params=params,
+                                       timeout=self.timeout)
+        timings = get_connection_timings()
+        setup = timings["dns"] + timings["connect"] + timings["tls"]
+        timings["first_byte"] = max(0.0, r.elapsed.total_seconds() - setup)
+        timings["total"] = time.perf_counter() - start
+        r.timings = timings
+        self.connection_metrics.record(timings)
+        return r
+
+    def print_connection_metrics(self):
+        metrics = self.connection_metrics.summary()
+        print(f"Zoom connections: {metrics['requests']} requests over {metrics['new_connections']} new connections, "
+              f"{metrics['dns']}s DNS, {metrics['connect']}s connect, {metrics['tls']}s TLS, "
+              f"{metrics['first_byte']}s waiting for first byte, {metrics['total']}s total")
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncZoomHelper:
+    """
+    Async counterpart of ZoomHelper. Requests are issued from a thread pool so that many of them
+    can be in flight at once, while awaiting the shared token buckets keeps us under Zoom's per-second limits.
+    Must be used from within a running event loop.
+    """
+    def __init__(self, zoom: ZoomHelper, max_workers: int = HEAVY_CALLS + MEDIUM_CALLS):
+        self.zoom = zoom
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def get_meeting_participants(self,
+                                       meeting_id: str,
+                                       jwt_token: Optional[bytes] = None,
+                                       next_page_token: Optional[str] = None) -> Response:
+        url, query_params = self.zoom.meeting_participants_request(meeting_id, next_page_token)
+        print(f"Zoom: Getting participants for {meeting_id}")
+        return await self.request(HEAVY, PARTICIPANTS, url, jwt_token, query_params)
+
+    async def iter_meeting_participant_pages(self, meeting_id: str, jwt_token: Optional[bytes] = None) -> AsyncIterator[List[Dict]]:
+        next_page_token = None
+        while True:
+            response = await self.get_meeting_participants(meeting_id, jwt_token, next_page_token)
+            if not response.ok:
+                print(f"Response failed with code {response.status_code} for meeting {meeting_id}")
+                raise RuntimeError
+            page = response.json()
+            yield page.get("participants")
+            next_page_token = page.get("next_page_token")
+            if not next_page_token:
+                return
+
+    async def get_meeting_details(self, meeting_id: str, jwt_token: Optional[bytes] = None) -> Response:
+        url = f"{self.zoom.reports_url}/{meeting_id}"
+        print(f"Zoom: Getting meeting details for {meeting_id}")
+        return await self.request(HEAVY, MEETING_DETAILS, url, jwt_token)
+
+    async def get_past_meeting_instances(self, meeting_id: str, jwt_token: Optional[bytes] = None) -> Response:
+        url = f"{self.zoom.past_meetings_url}/{meeting_id}/instances"
+        print(f"Zoom: Getting past meeting instances for {meeting_id}")
+        return await self.request(MEDIUM, PAST_MEETING_INSTANCES, url, jwt_token)
+
+    async def request(self, category: str, endpoint: str, url: str, jwt_token: Optional[bytes] = None,
+                      params: Optional[Dict] = None) -> Response:
+        entry = self.zoom.cache_lookup(endpoint, url, params)
+        if entry is not None and entry.fresh(self.zoom.response_cache.clock()):
+            return entry.response(url)
+        headers = entry.conditional_headers() if entry is not None else None
+
+        bucket = self.zoom.rate_limits[category]
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        refreshed = False
+        while True:
+            token = jwt_token or self.zoom.tokens.token()
+            await bucket.acquire_async()
+            try:
+                r = await loop.run_in_executor(self.executor, functools.partial(self.zoom.send, bucket, endpoint,
+                                                                                url, token, params, headers))
+            finally:
+                bucket.release()
+            if self.zoom.should_refresh_token(r, jwt_token, token, refreshed):
+                refreshed = True
+                continue
+            delay = self.zoom.retry_delay(bucket, r, attempt)
+            if delay is None:
+                return self.zoom.cache_update(endpoint, url, params, r, entry)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self.executor.shutdown(wait=True)
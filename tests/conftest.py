@@ -1,3 +1,4 @@
+import json
 import pytest
 import uuid
 import datetime
@@ -7,12 +8,23 @@ from processor.data_fetcher import DataFetcher
 from processor.db_helper import DbHelper
 from processor.model import MeetingInstance, Meeting, Participant, Attendance
 from processor.report_generator import ReportGenerator
-from processor.zoom_helper import ZoomHelper
+from processor.zoom_helper import ZoomHelper, make_rate_limits
+from tests.fake_zoom import FakeZoomServer
 
 
 @pytest.fixture()
 def zoom_helper():
-    return ZoomHelper('https://test.example.com/v2', 'test_key', 'test_secret')
+    zoom = ZoomHelper('https://test.example.com/v2', 'test_key', 'test_secret')
+    # Don't let throttling in one test hold back the next one
+    zoom.rate_limits = make_rate_limits()
+    return zoom
+
+
+@pytest.fixture
+def fake_zoom():
+    server = FakeZoomServer().start()
+    yield server
+    server.stop()
 
 
 @pytest.fixture
@@ -71,3 +83,8 @@ def attend_meeting_with_new_participant(meeting_instance, name, email=None):
 def attend_meeting(meeting_instance, participant):
     return Attendance.create(meeting_instance=meeting_instance, participant=participant)
 
+
+
+def load_participants(file_name='past_participants_report.json'):
+    with open(f'tests/test_data/{file_name}') as f:
+        return json.load(f).get("participants")
@@ -0,0 +1,104 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httplib2
+from googleapiclient import discovery
+
+
+def parse_a1(a1_range):
+    """
+    "C5:F9" -> zero-based (top, left, bottom, right)
+    """
+    cells = []
+    for letters, row in re.findall(r"([A-Z]+)(\d+)", a1_range.split("!")[-1]):
+        column = 0
+        for letter in letters:
+            column = column * 26 + ord(letter) - ord('A') + 1
+        cells.append((int(row) - 1, column - 1))
+    (top, left), (bottom, right) = cells
+    return top, left, bottom, right
+
+
+class FakeSheetsServer:
+    """
+    A local stand-in for the values().batchUpdate endpoint of the Sheets API.
+    Point a client from client() at it, and read back what was written with grid().
+    """
+    def __init__(self):
+        self.cells = {}
+        self.requests = []
+        self.failures = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/"
+
+    def client(self):
+        return discovery.build("sheets", "v4", http=httplib2.Http(), static_discovery=True,
+                               client_options={"api_endpoint": self.base_url})
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail_next(self, *statuses):
+        self.failures.extend(statuses)
+
+    def grid(self, spreadsheet_id):
+        cells = {k[1:]: v for k, v in self.cells.items() if k[0] == spreadsheet_id and v != ""}
+        height = max((row for row, _ in cells), default=-1) + 1
+        width = max((column for _, column in cells), default=-1) + 1
+        return [[cells.get((row, column), "") for column in range(width)] for row in range(height)]
+
+    def batch_update(self, spreadsheet_id, body):
+        updated = 0
+        for value_range in body["data"]:
+            top, left, bottom, right = parse_a1(value_range["range"])
+            values = value_range["values"]
+            if value_range.get("majorDimension") == "COLUMNS":
+                values = [list(row) for row in zip(*values)]
+            for i, row in enumerate(values):
+                for j, value in enumerate(row):
+                    assert top + i <= bottom and left + j <= right
+                    self.cells[(spreadsheet_id, top + i, left + j)] = value
+                    updated += 1
+        return {"spreadsheetId": spreadsheet_id, "totalUpdatedCells": updated}
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                payload = self.rfile.read(int(self.headers["Content-Length"]))
+                match = re.match(r"/v4/spreadsheets/([^/]+)/values:batchUpdate", self.path)
+                with fake.lock:
+                    fake.requests.append(len(payload))
+                    if fake.failures:
+                        status, body = fake.failures.pop(0), {"error": {"message": "try again"}}
+                    elif match is None:
+                        status, body = 404, {"error": {"message": "not found"}}
+                    else:
+                        status, body = 200, fake.batch_update(match.group(1), json.loads(payload))
+                response = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeZoomServer:
+    """
+    A local stand-in for the parts of the Zoom API that ZoomHelper uses.
+    Register data with add_meeting(), start() it, and point a ZoomHelper at base_url.
+    """
+    def __init__(self, page_size=300):
+        self.page_size = page_size
+        self.meetings = {}
+        self.instances = {}
+        self.participants = {}
+        self.calls = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/v2"
+
+    def add_meeting(self, meeting_id, topic, instances):
+        """
+        instances is a list of (uuid, start_time, participants_json) tuples
+        """
+        meeting_id = str(meeting_id)
+        self.meetings[meeting_id] = {"id": meeting_id, "topic": topic}
+        self.instances[meeting_id] = [{"uuid": uuid, "start_time": start_time}
+                                      for uuid, start_time, _ in instances]
+        for uuid, _, participants in instances:
+            self.participants[uuid] = participants
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def calls_to(self, endpoint):
+        return [t for e, t in self.calls if e == endpoint]
+
+    def max_calls_per_second(self, endpoint):
+        times = sorted(self.calls_to(endpoint))
+        most, start = 0, 0
+        for end, t in enumerate(times):
+            while t - times[start] >= 1:
+                start += 1
+            most = max(most, end - start + 1)
+        return most
+
+    def respond(self, path, query):
+        parts = path.strip("/").split("/")
+        if parts[:2] == ["v2", "past_meetings"] and parts[-1] == "instances":
+            meeting_id = parts[2]
+            return "instances", self.instances.get(meeting_id) is not None, \
+                {"meetings": self.instances.get(meeting_id)}
+        if parts[:3] == ["v2", "report", "meetings"] and parts[-1] == "participants":
+            # Meeting UUIDs with slashes arrive double encoded
+            uuid = urllib.parse.unquote_plus(urllib.parse.unquote_plus("/".join(parts[3:-1])))
+            if uuid not in self.participants:
+                return "participants", False, None
+            page_size = int(query.get("page_size", [self.page_size])[0])
+            offset = int(query.get("next_page_token", ["0"])[0])
+            records = self.participants[uuid][offset:offset + page_size]
+            next_offset = offset + page_size
+            next_token = str(next_offset) if next_offset < len(self.participants[uuid]) else ""
+            return "participants", True, {"page_size": page_size,
+                                          "total_records": len(self.participants[uuid]),
+                                          "next_page_token": next_token,
+                                          "participants": records}
+        if parts[:3] == ["v2", "report", "meetings"] and len(parts) == 4:
+            meeting = self.meetings.get(parts[3])
+            return "details", meeting is not None, meeting
+        return "unknown", False, None
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections alive like the real API does
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, don't let delayed ACKs stall every response
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                endpoint, found, body = fake.respond(url.path, urllib.parse.parse_qs(url.query))
+                with fake.lock:
+                    fake.calls.append((endpoint, time.monotonic()))
+                if not found:
+                    self.send_response(404)
+                    body = {"code": 3001, "message": "Meeting does not exist"}
+                else:
+                    self.send_response(200)
+                payload = json.dumps(body).encode("utf-8")
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,68 @@
+import pytest
+
+from processor.async_data_fetcher import AsyncDataFetcher
+from processor.db_helper import DbHelper
+from processor.model import Attendance, MeetingInstance
+from processor.report_generator import ReportGenerator
+from processor.zoom_helper import ZoomHelper, HEAVY_CALLS, make_rate_limits
+from tests.conftest import load_participants
+
+
+@pytest.fixture
+def async_data_fetcher(fake_zoom):
+    db = DbHelper(':memory:')
+    zoom = ZoomHelper(fake_zoom.base_url, 'test_key', 'test_secret')
+    zoom.rate_limits = make_rate_limits()
+    return AsyncDataFetcher(db, zoom)
+
+
+def test_prefetch_meetings(fake_zoom, async_data_fetcher):
+    participants = load_participants()
+    fake_zoom.add_meeting(1, "topic 1", [("uuid-1", "2020-08-01T18:06:45Z", participants),
+                                         ("uuid/2", "2020-08-08T18:06:45Z", participants[:3])])
+    fake_zoom.add_meeting(2, "topic 2", [("uuid-3", "2020-08-01T19:06:45Z", [])])
+
+    async_data_fetcher.prefetch(["1", "2"])
+
+    assert 3 == MeetingInstance.select().where(MeetingInstance.cached == True).count()
+    assert 20 + 3 == Attendance.select().count()
+    assert 3 == len(fake_zoom.calls_to("participants"))
+
+
+def test_prefetch_paginates(fake_zoom, async_data_fetcher):
+    fake_zoom.page_size = 7
+    participants = load_participants()
+    fake_zoom.add_meeting(1, "topic 1", [("uuid-1", "2020-08-01T18:06:45Z", participants)])
+
+    async_data_fetcher.prefetch(["1"])
+
+    assert 20 == Attendance.select().count()
+
+
+def test_prefetch_stays_under_rate_limit(fake_zoom, async_data_fetcher):
+    instances = [(f"uuid-{i}", "2020-08-01T18:06:45Z", []) for i in range(HEAVY_CALLS * 2)]
+    fake_zoom.add_meeting(1, "topic 1", instances)
+
+    async_data_fetcher.prefetch(["1"])
+
+    assert HEAVY_CALLS * 2 == len(fake_zoom.calls_to("participants"))
+    assert fake_zoom.max_calls_per_second("participants") <= HEAVY_CALLS
+
+
+def test_prefetch_missing_meeting(fake_zoom, async_data_fetcher):
+    with pytest.raises(RuntimeError):
+        async_data_fetcher.prefetch(["404"])
+
+
+def test_report_after_prefetch_uses_cache(fake_zoom, async_data_fetcher):
+    participants = load_participants()
+    fake_zoom.add_meeting(1, "topic 1", [("uuid-1", "2020-08-01T18:06:45Z", participants),
+                                         ("uuid-2", "2020-08-08T18:06:45Z", participants[:3])])
+    async_data_fetcher.prefetch(["1"])
+    calls = len(fake_zoom.calls)
+
+    df = ReportGenerator(async_data_fetcher, None).generate_report(["1"])
+
+    assert calls == len(fake_zoom.calls)
+    assert 20 == df.at["1", "2020-08-01"]
+    assert 3 == df.at["1", "2020-08-08"]
@@ -0,0 +1,138 @@
+import datetime as dt
+import random
+
+from processor.attendance_index import AttendanceIndex, MeetingAttendance
+from processor.data_fetcher import DataFetcher
+from processor.model import Attendance, AttendanceBitmap, Participant
+from tests.conftest import make_meeting_instance, attend_meeting
+
+
+def ingest(meeting, uuid, start_time, participants):
+    meeting_instance = make_meeting_instance(meeting, uuid, start_time=start_time)
+    for participant in participants:
+        attend_meeting(meeting_instance, participant)
+    DataFetcher.mark_cached(meeting_instance)
+    return meeting_instance
+
+
+def people(*names):
+    return [Participant.create(user_id=name, name=name) for name in names]
+
+
+def attendance(meeting):
+    return AttendanceIndex.fetch_bitmaps([meeting.meeting_id])[meeting.meeting_id]
+
+
+def test_refresh_builds_a_bitmap_per_participant(data_fetcher, meeting):
+    a, b, c = people("a", "b", "c")
+    for day, attendees in enumerate([[a], [a, b], [], [a, c]], start=1):
+        ingest(meeting, f"uuid-{day}", dt.datetime(2020, 5, day), attendees)
+    attendance_index = AttendanceIndex(data_fetcher.db)
+
+    assert 1 == attendance_index.refresh([meeting.meeting_id])
+    assert 0 == attendance_index.refresh([meeting.meeting_id])
+
+    assert {a.id: 0b1011, b.id: 0b0010, c.id: 0b1000} == attendance(meeting)
+
+
+def test_refresh_appends_new_sessions(data_fetcher, meeting, mocker):
+    a, b = people("a", "b")
+    ingest(meeting, "uuid-1", dt.datetime(2020, 5, 1), [a])
+    attendance_index = AttendanceIndex(data_fetcher.db)
+    attendance_index.refresh([meeting.meeting_id])
+    ingest(meeting, "uuid-2", dt.datetime(2020, 5, 8), [a, b])
+    queries = mocker.spy(Attendance, "select")
+
+    assert 1 == attendance_index.refresh([meeting.meeting_id])
+
+    # Only the new session's attendance is read
+    assert 1 == queries.call_count
+    assert {a.id: 0b11, b.id: 0b10} == attendance(meeting)
+
+
+def test_reingested_sessions_replace_their_bits(data_fetcher, meeting):
+    a, b = people("a", "b")
+    first = ingest(meeting, "uuid-1", dt.datetime(2020, 5, 1), [a, b])
+    ingest(meeting, "uuid-2", dt.datetime(2020, 5, 8), [a])
+    attendance_index = AttendanceIndex(data_fetcher.db)
+    attendance_index.refresh([meeting.meeting_id])
+
+    Attendance.delete().where((Attendance.meeting_instance == first) & (Attendance.participant == b)).execute()
+    DataFetcher.mark_cached(first)
+    attendance_index.refresh([meeting.meeting_id])
+
+    assert {a.id: 0b11} == attendance(meeting)
+    assert 1 == AttendanceBitmap.select().count()
+
+
+def test_earlier_sessions_rebuild_the_meeting(data_fetcher, meeting):
+    a, b = people("a", "b")
+    ingest(meeting, "uuid-2", dt.datetime(2020, 5, 8), [a])
+    attendance_index = AttendanceIndex(data_fetcher.db)
+    attendance_index.refresh([meeting.meeting_id])
+
+    # Backfilling an older session shifts the later ones up a bit
+    ingest(meeting, "uuid-1", dt.datetime(2020, 5, 1), [b])
+    attendance_index.refresh([meeting.meeting_id])
+
+    assert {a.id: 0b10, b.id: 0b01} == attendance(meeting)
+
+
+def test_queries():
+    start_times = [dt.datetime(2020, 5, day) for day in range(1, 7)]
+    meeting_attendance = MeetingAttendance("1", start_times, {
+        1: 0b111111,  # every session
+        2: 0b000111,  # the first three
+        3: 0b110000,  # the last two
+        4: 0b101101,
+    })
+
+    assert [1, 4] == meeting_attendance.attended_at_least(3, 4)
+    assert [3] == meeting_attendance.new(2)
+    assert [2] == meeting_attendance.churned(3)
+    # 1, 2 and 4 came to the three sessions before the last three, 2 didn't come back
+    assert 2 / 3 == meeting_attendance.retention(3)
+    assert {1: 0, 2: 0, 3: 4, 4: 0} == meeting_attendance.first_seen()
+    assert {1: 6, 3: 2, 4: 1} == meeting_attendance.streaks()
+    assert [0, 2, 3, 5] == meeting_attendance.attended(4)
+    assert 2 == meeting_attendance.sessions_since(dt.datetime(2020, 5, 5))
+
+
+def test_queries_match_the_attendance_rows(data_fetcher, meeting):
+    rng = random.Random(3)
+    participants = people(*[f"p{i}" for i in range(20)])
+    sessions = []
+    for day in rng.sample(range(1, 29), 12):
+        attendees = rng.sample(participants, rng.randint(0, 12))
+        ingest(meeting, f"uuid-{day:02d}", dt.datetime(2020, 2, day), attendees)
+        sessions.append((day, {p.id for p in attendees}))
+    sessions = [attendees for _, attendees in sorted(sessions)]
+    attendance_index = AttendanceIndex(data_fetcher.db)
+    attendance_index.refresh([meeting.meeting_id])
+
+    meeting_attendance = attendance_index.fetch([meeting.meeting_id])[meeting.meeting_id]
+
+    seen = set().union(*sessions)
+    last_four = set().union(*sessions[-4:])
+    assert sorted(p for p in seen if sum(p in s for s in sessions[-4:]) >= 3) == \
+           sorted(meeting_attendance.attended_at_least(3, 4))
+    assert sorted(seen - set().union(*sessions[:-4])) == sorted(meeting_attendance.new(4))
+    assert sorted(seen - last_four) == sorted(meeting_attendance.churned(4))
+    assert {p: min(i for i, s in enumerate(sessions) if p in s) for p in seen} == meeting_attendance.first_seen()
+
+
+def test_report_retention_columns(report_generator, meeting):
+    a, b, c = people("a", "b", "c")
+    for day, attendees in enumerate([[c], [a], [a, b], [a, b], [a]], start=1):
+        ingest(meeting, f"uuid-{day}", dt.datetime(2020, 5, day), attendees)
+    report_generator.retention = True
+    report_generator.data_fetcher.sync_meeting = lambda meeting_id: meeting
+
+    df = report_generator.generate_report_from_db([meeting.meeting_id])
+    values = report_generator.dataframe_to_array(df)
+
+    assert ["Average", "Last Four Average", "Regulars", "New", "Churned"] == values[0][-5:]
+    # a came to all of the last four, b first came in them, and c only came before
+    assert [1.0, 2.0, 1.0] == values[1][-3:]
+    from_cache = report_generator.generate_report_from_cache([meeting.meeting_id])
+    assert values == report_generator.dataframe_to_array(from_cache)
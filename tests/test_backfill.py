@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from processor.backfill import Backfill, DONE, FAILED, shard
+from processor.db_helper import DbHelper
+from processor.model import Attendance, AttendanceInterval, BackfillCheckpoint, Meeting, MeetingInstance, Participant
+from tests.conftest import load_participants
+
+
+@pytest.fixture
+def backfill(fake_zoom, tmp_path):
+    participants = load_participants()
+    fake_zoom.add_meeting(1, "topic 1", [("uuid-1", "2020-08-01T18:06:45Z", participants),
+                                         ("uuid/2", "2020-08-08T18:06:45Z", participants[:3])])
+    fake_zoom.add_meeting(2, "topic 2", [("uuid-3", "2020-08-01T19:06:45Z", participants[5:12])])
+    fake_zoom.add_meeting(3, "topic 3", [("uuid-4", "2020-08-02T19:06:45Z", participants[10:])])
+    db = DbHelper(str(tmp_path / "main.db"))
+    return Backfill(db, fake_zoom.base_url, 'test_key', 'test_secret', workers=2,
+                    staging_dir=str(tmp_path / "staging"))
+
+
+def test_shard():
+    assert [["1", "3", "5"], ["2", "4"]] == shard(["1", "2", "3", "4", "5"], 2)
+    assert [["1"]] == shard(["1"], 4)
+
+
+def test_backfill_merges_every_meeting(backfill, tmp_path):
+    os.mkdir(tmp_path / "staging")
+    summary = backfill.run(["1", "2", "3", "2"])
+
+    assert {"skipped": 0, "merged": 3, "failed": 0} == summary
+    assert 3 == Meeting.select().count()
+    assert 4 == MeetingInstance.select().where(MeetingInstance.cached == True).count()
+    assert 20 + 3 + 7 + 18 == Attendance.select().count()
+    assert 20 == Participant.select().count()
+    assert [("1", 2), ("2", 1), ("3", 1)] == [(c.meeting_id, c.instances) for c in
+                                              BackfillCheckpoint.select().order_by(BackfillCheckpoint.meeting_id)
+                                              if c.status == DONE]
+
+
+def test_backfill_resumes_from_checkpoints(backfill, fake_zoom, tmp_path):
+    os.mkdir(tmp_path / "staging")
+    Backfill.checkpoint("1", DONE, instances=2)
+
+    summary = backfill.run(["1", "2", "3"])
+
+    assert {"skipped": 1, "merged": 2, "failed": 0} == summary
+    assert 2 == len(fake_zoom.calls_to("details"))
+    assert {"2", "3"} == set(m.meeting_id for m in Meeting.select())
+
+
+def test_backfill_checkpoints_failed_meetings_and_retries_them(backfill, fake_zoom, tmp_path):
+    os.mkdir(tmp_path / "staging")
+    summary = backfill.run(["1", "404"])
+
+    assert {"skipped": 0, "merged": 1, "failed": 1} == summary
+    assert FAILED == BackfillCheckpoint.get_by_id("404").status
+
+    fake_zoom.add_meeting(404, "topic 404", [])
+    summary = backfill.run(["1", "404"])
+
+    assert {"skipped": 1, "merged": 1, "failed": 0} == summary
+    assert DONE == BackfillCheckpoint.get_by_id("404").status
+
+
+def test_backfill_merges_join_leave_intervals(backfill, fake_zoom, tmp_path):
+    os.mkdir(tmp_path / "staging")
+    participants = load_participants('past_participants_duplicates.json')
+    fake_zoom.add_meeting(4, "topic 4", [("uuid-5", "2020-08-07T21:55:00Z", participants)])
+
+    assert {"skipped": 0, "merged": 1, "failed": 0} == backfill.run(["4"])
+
+    intervals = [(i.participant.name, i.join_offset, i.leave_offset)
+                 for i in AttendanceInterval.select().order_by(AttendanceInterval.id)]
+    assert len(participants) == len(intervals)
+    assert ("CircleAnywhere Sessions Evens", 147, 4143) == intervals[0]
@@ -0,0 +1,64 @@
+import json
+
+from benchmarks import startup
+from benchmarks.datagen import SyntheticDataset
+from benchmarks.run_benchmarks import main, STAGES
+from processor.db_helper import DbHelper, MAX_VARIABLES
+from processor.model import MeetingInstance, Attendance
+
+
+def test_dataset_is_reproducible():
+    first = SyntheticDataset(meetings=2, instances=3, participants=20, attendees=5, seed=7)
+    second = SyntheticDataset(meetings=2, instances=3, participants=20, attendees=5, seed=7)
+    meeting_id = first.meeting_ids()[0]
+
+    assert list(first.meeting_instances(meeting_id)) == list(second.meeting_instances(meeting_id))
+
+
+def test_populate_db():
+    DbHelper(':memory:')
+    SyntheticDataset(meetings=2, instances=3, participants=20, attendees=5).populate_db()
+
+    assert 6 == MeetingInstance.select().where(MeetingInstance.cached == True).count()
+    assert 30 == Attendance.select().count()
+
+
+def test_populate_db_stays_within_the_variable_limit(mocker):
+    execute_sql = mocker.spy(DbHelper(':memory:').db, "execute_sql")
+    SyntheticDataset(meetings=1, instances=200, participants=20, attendees=2).populate_db()
+
+    assert 200 == MeetingInstance.select().count()
+    assert MAX_VARIABLES >= max(len(call.args[1] or ()) for call in execute_sql.call_args_list
+                                if call.args[0].startswith("INSERT"))
+
+
+def test_benchmark_writes_and_compares_results(tmp_path):
+    output = str(tmp_path / "bench.json")
+    args = ["--meetings", "2", "--instances", "3", "--participants", "20", "--attendees", "5",
+            "--page-size", "4", "--output", output]
+    assert 0 == main(args)
+
+    with open(output) as f:
+        results = json.load(f)
+    assert STAGES == list(results["stages"])
+    assert [2, 3 + 3] == results["rows"]["report_shape"]
+    assert 1 == results["rows"]["upload_requests"]
+
+    # Against an impossibly fast baseline every stage is a regression
+    for stage in results["stages"]:
+        results["stages"][stage] = 1e-9
+    with open(output, "w") as f:
+        json.dump(results, f)
+    assert 1 == main(args[:-2] + ["--compare", output])
+
+
+def test_entry_points_defer_heavy_imports(tmp_path):
+    output = str(tmp_path / "startup.json")
+
+    assert 0 == startup.main(["--repeat", "1", "--output", output])
+
+    with open(output) as f:
+        results = json.load(f)
+    # Writing the participant CSV doesn't need the Google client libraries
+    assert "googleapiclient" not in results["loaded"]["processor.participant_report_generator"]
+    assert [] == startup.eager_imports(results)
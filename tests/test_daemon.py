@@ -0,0 +1,141 @@
+import datetime as dt
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from processor.daemon import Daemon, Scheduler
+from processor.db_helper import DbHelper
+from processor.instrumentation import tracer
+from processor.model import ExecutionLog, Meeting, MeetingSyncState
+from processor.zoom_helper import ZoomHelper, make_rate_limits
+from tests.conftest import load_participants
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeGoogleHelper:
+    def __init__(self):
+        self.sheets = {}
+
+    def get_folder_id(self, name):
+        return "folder"
+
+    def create_new_sheet(self, file_name, parent_folder_id):
+        sheet_id = f"sheet-{len(self.sheets) + 1}"
+        self.sheets[sheet_id] = None
+        return sheet_id
+
+    def write_values(self, sheet_id, values, keep_snapshot=True):
+        self.sheets[sheet_id] = values
+        return {"spreadsheetId": sheet_id}
+
+    def get_sheet_link(self, sheet_id):
+        return f"https://example.com/{sheet_id}"
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def participants():
+    return load_participants()
+
+
+@pytest.fixture
+def daemon(fake_zoom, participants, clock):
+    fake_zoom.add_meeting(1, "topic 1", [("uuid-1", "2020-08-01T18:06:45Z", participants[:5])])
+    fake_zoom.add_meeting(2, "topic 2", [("uuid-2", "2020-08-01T19:06:45Z", participants[5:8])])
+    zoom = ZoomHelper(fake_zoom.base_url, 'test_key', 'test_secret')
+    zoom.rate_limits = make_rate_limits()
+    daemon = Daemon(DbHelper(':memory:'), zoom, FakeGoogleHelper(), ["1", "2"], interval=60, clock=clock)
+    yield daemon
+    daemon.close()
+
+
+def test_scheduler_resumes_from_the_last_sync(data_fetcher, clock):
+    last_synced = dt.datetime.fromtimestamp(clock.now - 30)
+    MeetingSyncState.create(meeting=Meeting.create(meeting_id="1", topic="topic 1"), last_synced=last_synced)
+    scheduler = Scheduler(60, clock)
+    scheduler.load(["1", "2"])
+
+    assert ["2"] == scheduler.pop_due()
+    assert 30 == pytest.approx(scheduler.seconds_until_due())
+    clock.now += 30
+    assert 1 == scheduler.depth()
+    assert ["1"] == scheduler.pop_due()
+    assert [] == scheduler.pop_due()
+
+
+def test_runs_sync_what_is_due_and_upload_changes(daemon, fake_zoom, participants, clock):
+    assert 0 == daemon.run_once()
+    report = daemon.google.sheets["sheet-1"]
+    # Two of the first five records are the same person
+    assert [["1", "topic 1", 4.0], ["2", "topic 2", 3.0]] == [row[:3] for row in report[1:]]
+
+    # Nothing is due until the interval has passed
+    assert daemon.run_once() is None
+    fake_zoom.add_meeting(1, "topic 1", [("uuid-1", "2020-08-01T18:06:45Z", participants[:5]),
+                                         ("uuid-3", "2020-08-08T18:06:45Z", participants[:2])])
+    calls = len(fake_zoom.calls)
+    clock.now += 60
+
+    assert 0 == daemon.run_once()
+
+    # Only the new instance's participants were downloaded
+    assert 1 == len([t for e, t in fake_zoom.calls[calls:] if e == "participants"])
+    assert ["sheet-1"] == list(daemon.google.sheets)
+    assert ["Meeting ID", "Name", "2020-08-01", "2020-08-08"] == daemon.google.sheets["sheet-1"][0][:4]
+    assert [0, 0] == [log.exit_code for log in ExecutionLog.select()]
+
+
+def test_failed_syncs_are_logged_and_reported(daemon, fake_zoom, clock):
+    daemon.meeting_ids.append("404")
+    daemon.scheduler.reschedule(["404"])
+    clock.now += 60
+
+    assert 1 == daemon.run_once()
+
+    assert [1] == [log.exit_code for log in ExecutionLog.select()]
+    status, body = daemon.health()
+    assert 503 == status and "failing" == body["status"]
+    # The meetings that synced still made it into the report
+    assert 2 == len(daemon.google.sheets["sheet-1"]) - 1
+
+
+def test_health_and_metrics_endpoint(daemon):
+    server = daemon.start_server(port=0)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    daemon.run_once()
+
+    with urllib.request.urlopen(f"{base_url}/health") as response:
+        assert {"status": "ok"}.items() <= json.load(response).items()
+    with urllib.request.urlopen(f"{base_url}/metrics") as response:
+        metrics = json.load(response)
+    assert 1 == metrics["runs"] and 0 == metrics["queue_depth"] and 2 == metrics["synced_meetings"]
+    assert metrics["run_seconds"]["max"] > 0
+    assert metrics["counters"] is None
+    with pytest.raises(urllib.error.HTTPError):
+        urllib.request.urlopen(f"{base_url}/missing")
+
+
+def test_metrics_report_counters_while_tracing(daemon):
+    tracer.enable()
+    try:
+        daemon.run_once()
+        counters = daemon.metrics_summary()["counters"]
+    finally:
+        tracer.disable()
+        tracer.reset()
+
+    assert 2 == counters["zoom.participants.calls"]
+    assert 2 == counters["daemon.new_instances"]
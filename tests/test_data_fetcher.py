@@ -3,7 +3,8 @@ import responses
 import json
 import datetime
 
-from processor.model import Meeting, Participant
+from processor.db_helper import MAX_VARIABLES
+from processor.model import Meeting, MeetingInstance, MeetingSyncState, Participant, Attendance
 from tests.conftest import make_meeting_instance, attend_meeting_with_new_participant
 
 
@@ -160,3 +161,113 @@ def test_does_not_create_new_participant_if_name_already_exists(data_fetcher, me
 
 
 
+def test_ingesting_same_instance_twice_is_idempotent(data_fetcher, meeting_instance):
+    with open('tests/test_data/past_participants_report.json') as f:
+        data = json.load(f)
+    first = data_fetcher.get_unique_participants(meeting_instance, data.get("participants"))
+    participant_count = Participant.select().count()
+    second = data_fetcher.get_unique_participants(meeting_instance, data.get("participants"))
+
+    assert [p.id for p in first] == [p.id for p in second]
+    assert participant_count == Participant.select().count()
+    assert 20 == Attendance.select().count()
+
+
+def test_new_participants_are_matched_within_the_same_batch(data_fetcher, meeting_instance):
+    data = [{"id": "1", "name": "Alice", "user_email": "alice@bmail.com"},
+            {"id": "2", "name": "Alice", "user_email": ""},
+            {"id": "3", "name": "Alicia", "user_email": "alice@bmail.com"},
+            {"id": "4", "name": "", "user_email": ""},
+            {"id": "4", "name": "", "user_email": ""}]
+    ps = data_fetcher.get_unique_participants(meeting_instance, data)
+
+    assert ["Alice", ""] == [p.name for p in ps]
+    assert 2 == Participant.select().count()
+    assert all(p.id is not None for p in ps)
+
+
+@responses.activate
+def test_incremental_sync_only_stores_new_instances(data_fetcher, meeting):
+    with open('tests/test_data/past_meetings.json') as f:
+        data = json.load(f)
+    base = data_fetcher.zoom.past_meetings_url
+    responses.add(responses.GET, f"{base}/{meeting.meeting_id}/instances",
+                  json={"meetings": data["meetings"][:6]}, status=200)
+    data_fetcher.incremental = True
+
+    meetings = data_fetcher.fetch_past_meeting_instances(meeting)
+    assert 6 == len(meetings)
+    assert meetings[0].start_time == datetime.datetime(2020, 6, 27, 18, 4, 12)
+    state = MeetingSyncState.get(MeetingSyncState.meeting == meeting)
+    assert state.last_start_time == datetime.datetime(2020, 8, 8, 18, 3, 47)
+
+    # Known instances are left alone, only the one after the watermark is stored
+    MeetingInstance.update(start_time=datetime.datetime(2020, 1, 1)) \
+                   .where(MeetingInstance.uuid == "8mfM3bNP7X6W7k7pdMOUXw==").execute()
+    responses.replace(responses.GET, f"{base}/{meeting.meeting_id}/instances",
+                      json={"meetings": data["meetings"] + [{"uuid": "new==", "start_time": "2020-08-15T18:00:00Z"}]},
+                      status=200)
+
+    # The unknown instance from before the watermark is skipped as well
+    meetings = data_fetcher.fetch_past_meeting_instances(meeting)
+    assert 7 == len(meetings)
+    assert "yh7deEZaR7yE1u9B7eGXHw==" not in [m.uuid for m in meetings]
+    assert meetings[0].start_time == datetime.datetime(2020, 1, 1)
+    assert meetings[-1].uuid == "new=="
+    state = MeetingSyncState.get(MeetingSyncState.meeting == meeting)
+    assert state.last_start_time == datetime.datetime(2020, 8, 15, 18)
+
+
+def most_variables_per_insert(execute_sql):
+    return max(len(call.args[1] or ()) for call in execute_sql.call_args_list if call.args[0].startswith("INSERT"))
+
+
+@responses.activate
+def test_instances_are_inserted_within_the_variable_limit(data_fetcher, meeting, mocker):
+    instances = [{"uuid": f"uuid-{i}", "start_time": f"2020-08-01T{i // 60 % 24:02d}:{i % 60:02d}:00Z"}
+                 for i in range(700)]
+    responses.add(responses.GET, f"{data_fetcher.zoom.past_meetings_url}/{meeting.meeting_id}/instances",
+                  json={"meetings": instances}, status=200)
+    data_fetcher.incremental = True
+    execute_sql = mocker.spy(data_fetcher.db.db, "execute_sql")
+
+    assert 700 == len(data_fetcher.fetch_past_meeting_instances(meeting))
+    assert most_variables_per_insert(execute_sql) <= MAX_VARIABLES
+
+
+def test_participants_are_inserted_within_the_variable_limit(data_fetcher, meeting_instance, mocker):
+    participants = [{"id": f"user{i}", "name": f"Person {i}", "user_email": f"person{i}@example.com"}
+                    for i in range(700)]
+    execute_sql = mocker.spy(data_fetcher.db.db, "execute_sql")
+
+    assert 700 == len(data_fetcher.get_unique_participants(meeting_instance, participants))
+    assert most_variables_per_insert(execute_sql) <= MAX_VARIABLES
+
+
+def test_ingesting_in_batches_matches_a_single_batch(data_fetcher, meeting_instance, mocker):
+    with open('tests/test_data/past_participants_duplicates.json') as f:
+        data = json.load(f).get("participants")
+    other_instance = make_meeting_instance(meeting_instance.meeting, "other_uuid")
+
+    whole = data_fetcher.get_unique_participants(meeting_instance, list(data))
+    mocker.patch("processor.data_fetcher.BATCH_SIZE", 2)
+    batched = data_fetcher.get_unique_participants(other_instance, iter(data))
+
+    assert [p.id for p in whole] == [p.id for p in batched]
+    assert len(whole) == Attendance.select().where(Attendance.meeting_instance == other_instance).count()
+
+
+@responses.activate
+def test_get_participants_ingests_every_page(data_fetcher, meeting_instance):
+    with open('tests/test_data/past_participants_report.json') as f:
+        data = json.load(f)
+    participants = data.pop("participants")
+
+    url = f"{data_fetcher.zoom.reports_url}/{meeting_instance.uuid}/participants"
+    responses.add(responses.GET, url, json=dict(data, next_page_token="a", participants=participants[:10]))
+    responses.add(responses.GET, url, json=dict(data, next_page_token="", participants=participants[10:]))
+    ps = data_fetcher.fetch_meeting_participants(meeting_instance)
+
+    assert 20 == len(ps)
+    assert 20 == Attendance.select().count()
+    assert meeting_instance.cached
@@ -0,0 +1,56 @@
+import sqlite3
+import datetime
+
+from processor.db_helper import DbHelper, MIGRATIONS
+from processor.model import Attendance, MeetingInstance
+
+
+def make_old_database(path):
+    # The schema before indexes and migrations were added, with a duplicate attendance
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE meeting (meeting_id VARCHAR(255) NOT NULL PRIMARY KEY, topic VARCHAR(255) NOT NULL);
+        CREATE TABLE meetinginstance (uuid VARCHAR(255) NOT NULL PRIMARY KEY, meeting_id VARCHAR(255) NOT NULL,
+                                      start_time DATETIME NOT NULL, cached INTEGER NOT NULL);
+        CREATE TABLE participant (id INTEGER NOT NULL PRIMARY KEY, user_id VARCHAR(255) NOT NULL,
+                                  name VARCHAR(255), email VARCHAR(255));
+        CREATE TABLE attendance (id INTEGER NOT NULL PRIMARY KEY, meeting_instance_id VARCHAR(255) NOT NULL,
+                                 participant_id INTEGER NOT NULL);
+        INSERT INTO meeting VALUES ('1', 'topic');
+        INSERT INTO meetinginstance VALUES ('uuid', '1', '2020-05-17 00:00:00', 1);
+        INSERT INTO participant VALUES (1, 'u1', 'Alice', ''), (2, 'u2', 'Bob', '');
+        INSERT INTO attendance VALUES (1, 'uuid', 1), (2, 'uuid', 2), (3, 'uuid', 1);
+    """)
+    db.commit()
+    db.close()
+
+
+def index_names(db, table):
+    return [index.name for index in db.get_indexes(table)]
+
+
+def test_new_database_is_tuned_and_current(tmp_path):
+    db = DbHelper(str(tmp_path / "new.db")).db
+
+    assert 'wal' == db.pragma('journal_mode')
+    assert 1 == db.pragma('synchronous')
+    assert len(MIGRATIONS) == db.pragma('user_version')
+    assert 'attendance_meeting_instance_id_participant_id' in index_names(db, 'attendance')
+    assert 'meetinginstance_meeting_id_start_time_uuid' in index_names(db, 'meetinginstance')
+
+
+def test_migrates_old_database_in_place(tmp_path):
+    path = str(tmp_path / "old.db")
+    make_old_database(path)
+
+    db = DbHelper(path).db
+
+    assert len(MIGRATIONS) == db.pragma('user_version')
+    assert [1, 2] == [a.id for a in Attendance.select().order_by(Attendance.id)]
+    assert MeetingInstance.get_by_id('uuid').ingested_at is not None
+    assert 'attendance_meeting_instance_id_participant_id' in index_names(db, 'attendance')
+    assert 'meetinginstance_meeting_id_start_time_uuid' in index_names(db, 'meetinginstance')
+
+    # Opening it again doesn't migrate twice
+    DbHelper(path)
+    assert 2 == Attendance.select().count()
@@ -0,0 +1,107 @@
+import datetime as dt
+import json
+
+import numpy as np
+
+from processor.engagement import Intervals, interval_rows, merge_intervals, seconds_attended, peak_concurrency, \
+    engagement_metrics, fetch_engagement, fetch_intervals
+from processor.model import AttendanceInterval, Participant
+from tests.conftest import make_meeting_instance
+
+
+def intervals(rows, uuids=("uuid-1",)):
+    return Intervals.from_rows(list(uuids), rows)
+
+
+def record(name, join_time, leave_time=None, duration=None):
+    r = {"id": name, "name": name, "user_email": "", "join_time": join_time}
+    if leave_time is not None:
+        r["leave_time"] = leave_time
+    if duration is not None:
+        r["duration"] = duration
+    return r
+
+
+def test_interval_rows_are_offsets_from_the_instance_start(data_fetcher, meeting):
+    mi = make_meeting_instance(meeting, "uuid-1", dt.datetime(2020, 8, 7, 21, 55))
+    records = [record("a", "2020-08-07T21:57:27Z", "2020-08-07T23:04:03Z"),
+               record("b", "2020-08-07T21:58:00Z", duration=120),
+               {"id": "c", "name": "c", "user_email": ""}]
+    participants = [Participant(id=i) for i in (1, 2, 3)]
+
+    rows = interval_rows(mi, records, participants)
+
+    assert [(1, 147, 4143), (2, 180, 300)] == [(r["participant"], r["join_offset"], r["leave_offset"]) for r in rows]
+
+
+def test_ingestion_stores_every_interval(data_fetcher, meeting):
+    with open('tests/test_data/past_participants_duplicates.json') as f:
+        participants_json = json.load(f).get("participants")
+    mi = make_meeting_instance(meeting, "uuid-1", dt.datetime(2020, 8, 7, 21, 55))
+
+    data_fetcher.get_unique_participants(mi, participants_json)
+    data_fetcher.get_unique_participants(mi, participants_json)
+
+    # Rejoins and duplicate names still get their interval, and ingesting again replaces them
+    assert len(participants_json) == AttendanceInterval.select().count()
+    assert len(participants_json) == len(fetch_intervals(["uuid-1"]))
+
+
+def test_merge_overlapping_and_touching_intervals():
+    merged = merge_intervals(intervals([(0, 1, 0, 100), (0, 1, 50, 150), (0, 1, 150, 200), (0, 1, 300, 400),
+                                        (0, 2, 10, 20)]))
+
+    assert [(1, 0, 200), (1, 300, 400), (2, 10, 20)] == \
+           list(zip(merged.participants.tolist(), merged.joins.tolist(), merged.leaves.tolist()))
+    instances, participants, seconds = seconds_attended(merged)
+    assert [300, 10] == seconds.tolist()
+
+
+def test_peak_concurrency_counts_people_not_rejoins():
+    merged = merge_intervals(intervals([(0, 1, 0, 100), (0, 1, 10, 20), (0, 2, 50, 60), (0, 3, 100, 200),
+                                        (1, 1, 0, 10)], uuids=["uuid-1", "uuid-2"]))
+
+    instances, peaks = peak_concurrency(merged)
+
+    # Participant 3 joins as participant 1 leaves, which isn't an overlap
+    assert [0, 1] == instances.tolist()
+    assert [2, 1] == peaks.tolist()
+
+
+def brute_force(rows, uuids):
+    metrics = {}
+    for i, uuid in enumerate(uuids):
+        seconds = {}
+        for instance, participant, join, leave in rows:
+            if instance == i:
+                seconds.setdefault(participant, set()).update(range(join, leave))
+        present = [sum(1 for s in seconds.values() if t in s) for t in range(0, 200)]
+        minutes = sum(len(s) for s in seconds.values()) / 60
+        metrics[uuid] = {"attendees": len(seconds),
+                         "minutes": round(minutes, 2),
+                         "average_minutes": round(minutes / len(seconds), 2) if seconds else 0.0,
+                         "peak_concurrent": max(present)}
+    return metrics
+
+
+def test_metrics_match_a_brute_force_count():
+    rng = np.random.default_rng(1)
+    joins = rng.integers(0, 150, 400)
+    rows = list(zip(rng.integers(0, 5, 400).tolist(), rng.integers(0, 30, 400).tolist(), joins.tolist(),
+                    (joins + rng.integers(1, 50, 400)).tolist()))
+    uuids = [f"uuid-{i}" for i in range(6)]
+
+    assert brute_force(rows, uuids) == engagement_metrics(Intervals.from_rows(uuids, rows))
+
+
+def test_fetch_engagement(data_fetcher, meeting):
+    mi = make_meeting_instance(meeting, "uuid-1", dt.datetime(2020, 8, 7, 21, 55))
+    make_meeting_instance(meeting, "uuid-2", dt.datetime(2020, 8, 14, 21, 55))
+    data_fetcher.get_unique_participants(mi, [record("a", "2020-08-07T21:55:00Z", "2020-08-07T22:55:00Z"),
+                                              record("b", "2020-08-07T22:00:00Z", "2020-08-07T22:30:00Z"),
+                                              record("b", "2020-08-07T22:40:00Z", "2020-08-07T22:50:00Z")])
+
+    metrics = fetch_engagement([meeting.meeting_id])
+
+    assert {"attendees": 2, "minutes": 100.0, "average_minutes": 50.0, "peak_concurrent": 2} == metrics["uuid-1"]
+    assert {"attendees": 0, "minutes": 0.0, "average_minutes": 0.0, "peak_concurrent": 0} == metrics["uuid-2"]
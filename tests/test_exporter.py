@@ -0,0 +1,98 @@
+import csv
+import datetime as dt
+
+import pandas as pd
+import pytest
+
+from processor.exporter import Exporter, FACT_COLUMNS, CSV, PARQUET, ARROW
+from processor.model import Meeting
+from tests.conftest import make_meeting_instance, attend_meeting_with_new_participant
+
+
+@pytest.fixture
+def attendances(data_fetcher):
+    meetings = [Meeting.create(meeting_id=meeting_id, topic=f"topic {meeting_id}") for meeting_id in ["1", "2"]]
+    for meeting in meetings:
+        for day in [8, 1]:
+            mi = make_meeting_instance(meeting, f"{meeting.meeting_id}-{day}", dt.datetime(2020, 5, day, 18))
+            for i in range(3):
+                attend_meeting_with_new_participant(mi, f"{meeting.meeting_id} person {day}-{i}")
+    return meetings
+
+
+def read_csv(path):
+    with open(path, newline="") as f:
+        return list(csv.reader(f))
+
+
+def test_export_facts_csv(attendances, tmp_path):
+    exporter = Exporter(CSV, chunk_size=4)
+
+    path, rows = exporter.export_facts(["2", "1"], tmp_path / "facts.csv")
+
+    assert 12 == rows
+    table = read_csv(path)
+    assert FACT_COLUMNS == table[0]
+    # Ordered by meeting, then by instance start time
+    assert [("1", "1-1")] * 3 + [("1", "1-8")] * 3 + [("2", "2-1")] * 3 + [("2", "2-8")] * 3 == \
+           [(row[0], row[2]) for row in table[1:]]
+    assert "1 person 1-0" == table[1][5]
+
+
+def test_fact_chunks_are_bounded(attendances):
+    chunks = list(Exporter(CSV, chunk_size=5).fact_chunks(["1", "2"]))
+
+    assert [5, 5, 2] == [len(chunk) for chunk in chunks]
+
+
+def test_export_facts_only_exports_given_meetings(attendances, tmp_path):
+    path, rows = Exporter(CSV).export_facts(["2"], tmp_path / "facts")
+
+    assert str(tmp_path / "facts.csv") == path
+    assert 6 == rows
+    assert {"2"} == set(row[0] for row in read_csv(path)[1:])
+
+
+def test_export_report_csv(tmp_path):
+    df = pd.DataFrame({"Name": ["topic 1"], "2020-05-01": [3.0]}, index=["1"])
+
+    path = Exporter(CSV).export_report(df, tmp_path / "report.csv")
+
+    assert [["", "Name", "2020-05-01"], ["1", "topic 1", "3.0"]] == read_csv(path)
+
+
+def test_falls_back_to_csv_without_pyarrow(attendances, tmp_path, mocker):
+    mocker.patch("processor.exporter.load_pyarrow", return_value=None)
+
+    exporter = Exporter(PARQUET)
+    path, rows = exporter.export_facts(["1"], tmp_path / "facts.parquet")
+
+    assert CSV == exporter.fmt
+    assert str(tmp_path / "facts.csv") == path
+    assert 6 == rows
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        Exporter("xlsx")
+
+
+@pytest.mark.parametrize("fmt", [PARQUET, ARROW])
+def test_export_columnar(attendances, tmp_path, fmt):
+    pa = pytest.importorskip("pyarrow")
+    exporter = Exporter(fmt, chunk_size=5)
+
+    path, rows = exporter.export_facts(["1", "2"], tmp_path / "facts")
+    report_path = exporter.export_report(pd.DataFrame({"Name": ["topic 1"], "2020-05-01": [3.0]}, index=["1"]),
+                                         tmp_path / "report")
+
+    if fmt == PARQUET:
+        import pyarrow.parquet
+        table, report = pa.parquet.read_table(path), pa.parquet.read_table(report_path)
+    else:
+        import pyarrow.ipc
+        table, report = pa.ipc.open_file(path).read_all(), pa.ipc.open_file(report_path).read_all()
+    assert 12 == rows == table.num_rows
+    assert FACT_COLUMNS == table.column_names
+    assert ["1"] * 6 + ["2"] * 6 == table.column("meeting_id").to_pylist()
+    assert [3.0] == report.column("2020-05-01").to_pylist()
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from processor.instrumentation import tracer, traced, NULL_SPAN
+
+
+@pytest.fixture
+def tracing():
+    tracer.enable()
+    yield tracer
+    tracer.disable()
+    tracer.reset()
+
+
+@traced("double")
+def double(x):
+    return 2 * x
+
+
+def test_disabled_tracer_records_nothing():
+    assert NULL_SPAN is tracer.span("anything")
+    tracer.count("anything")
+    assert 4 == double(2)
+    assert not tracer.stats
+    assert not tracer.counters
+
+
+def test_spans_and_counters(tracing):
+    with tracing.span("outer", "stage", meeting="1"):
+        double(1)
+        double(2)
+    tracing.count("pages", 3)
+
+    assert 2 == tracing.stats["double"].count
+    assert 1 == tracing.stats["outer"].count
+    assert tracing.stats["outer"].total >= tracing.stats["double"].total
+    assert 3 == tracing.counters["pages"]
+    assert "double" in tracing.summary()
+
+
+def test_write_trace(tracing, tmp_path):
+    with tracing.span("stage one"):
+        pass
+    tracing.count("rows", 5)
+    path = str(tmp_path / "trace.json")
+    tracing.write_trace(path)
+
+    with open(path) as f:
+        trace = json.load(f)
+    assert ["stage one"] == [e["name"] for e in trace["traceEvents"]]
+    assert "X" == trace["traceEvents"][0]["ph"]
+    assert 5 == trace["counters"]["rows"]
+    assert trace["peak_memory_bytes"] >= 0
+
+
+def test_pipeline_is_instrumented(tracing, data_fetcher, meeting_instance):
+    with open('tests/test_data/past_participants_report.json') as f:
+        data = json.load(f)
+    data_fetcher.get_unique_participants(meeting_instance, data.get("participants"))
+    meeting_instance.cached = True
+    data_fetcher.fetch_meeting_participants(meeting_instance)
+
+    assert 1 == tracing.stats["ingest participants"].count
+    assert tracing.counters["db.queries"] > 0
+    assert 20 == tracing.counters["rows.attendance_inserted"]
+    assert 1 == tracing.counters["cache.participants.hit"]
@@ -0,0 +1,23 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from processor.local_server import close_server, json_handler, start_server
+
+
+def test_json_handler_routes_methods():
+    server = start_server(json_handler(get=lambda path: (200, {"path": path})), port=0)
+    url = f"http://127.0.0.1:{server.server_address[1]}/health"
+    try:
+        with urllib.request.urlopen(url) as response:
+            assert {"path": "/health"} == json.load(response)
+            assert "application/json" == response.headers["Content-Type"]
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url, data=b"{}")
+        assert 501 == error.value.code
+    finally:
+        close_server(server)
+    # Services close their server whether or not they started one
+    close_server(None)
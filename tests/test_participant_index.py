@@ -0,0 +1,109 @@
+import pytest
+
+from processor.data_fetcher import DataFetcher, select_first_by
+from processor.model import Attendance, Participant
+from processor.participant_index import EMAIL, NAME, USER_ID, HashIndex
+from tests.conftest import make_meeting_instance
+
+
+def record(user_id, name, email=""):
+    return {"id": user_id, "name": name, "user_email": email}
+
+
+def test_resolves_known_participants_without_queries(data_fetcher, meeting, mocker):
+    data_fetcher.get_unique_participants(make_meeting_instance(meeting, "uuid-1"),
+                                         [record("1", "Alice", "alice@example.com"), record("2", "Bob"),
+                                          record("3", "")])
+    queries = mocker.patch("processor.data_fetcher.select_first_by", wraps=select_first_by)
+
+    participants = data_fetcher.get_unique_participants(
+        make_meeting_instance(meeting, "uuid-2"),
+        [record("1", "Alice Smith", "alice@example.com"), record("2", "Bob"), record("3", "")])
+
+    queries.assert_not_called()
+    # A name change under the same email resolves to the participant as first seen
+    assert ["Alice", "Bob", ""] == [p.name for p in participants]
+    assert 3 == Participant.select().count()
+    assert 6 == Attendance.select().count()
+
+
+def test_index_matches_the_db(data_fetcher, meeting):
+    participants_json = [record(str(i), f"Person {i % 7}", f"p{i % 5}@example.com" if i % 2 else "")
+                         for i in range(40)] + [record("blank", "")]
+    data_fetcher.get_unique_participants(make_meeting_instance(meeting, "uuid-1"), participants_json)
+    index = data_fetcher.db.participant_index
+
+    from_index = DataFetcher.resolve_participants(participants_json, index)
+    from_db = DataFetcher.resolve_participants(participants_json)
+
+    assert [(p.id, p.name, p.email) for p in from_db] == [(p.id, p.name, p.email) for p in from_index]
+
+
+def test_falls_back_to_the_db_for_rows_written_elsewhere(data_fetcher, meeting):
+    index = data_fetcher.db.participant_index
+    DataFetcher.resolve_participants([record("1", "Alice")], index)
+    bob = Participant.create(user_id="2", name="Bob", email="bob@example.com")
+
+    participants = DataFetcher.resolve_participants([record("2", "Robert", "bob@example.com")], index)
+
+    assert [bob.id] == [p.id for p in participants]
+    found, missing = index.first_by(EMAIL, ["bob@example.com"])
+    assert bob.id == found["bob@example.com"].id and not missing
+
+
+def test_rollback_drops_the_index(data_fetcher):
+    index = data_fetcher.db.participant_index
+    DataFetcher.resolve_participants([record("1", "Alice")], index)
+
+    with pytest.raises(RuntimeError):
+        with data_fetcher.db.db.atomic():
+            DataFetcher.resolve_participants([record("2", "Bob")], index)
+            raise RuntimeError
+
+    assert not index.loaded
+    found, missing = index.first_by(NAME, ["Alice", "Bob"])
+    assert ["Alice"] == list(found) and {"Bob"} == missing
+    assert ["Alice"] == [p.name for p in Participant.select()]
+
+
+def test_hash_collisions_are_misses(data_fetcher):
+    index = data_fetcher.db.participant_index
+    alice, = DataFetcher.resolve_participants([record("1", "Alice", "alice@example.com")], index)
+    # Point another key at Alice's row, as a colliding hash would
+    index.indexes[EMAIL].setdefault("mallory@example.com", 0)
+
+    found, missing = index.first_by(EMAIL, ["alice@example.com", "mallory@example.com"])
+
+    assert alice.id == found["alice@example.com"].id
+    assert {"mallory@example.com"} == missing
+
+
+def test_blank_participants_are_indexed_by_user_id(data_fetcher):
+    index = data_fetcher.db.participant_index
+    blank, = DataFetcher.resolve_participants([record("42", "")], index)
+    Participant.create(user_id="43", name="Named")
+
+    found, missing = index.first_by(USER_ID, ["42", "43"])
+
+    assert blank.id == found["42"].id
+    assert {"43"} == missing
+
+
+def test_hash_index_merges_pending_keys():
+    index = HashIndex()
+    keys = [f"key {i}" for i in range(3000)]
+    for row, key in enumerate(keys):
+        index.setdefault(key, row)
+    index.setdefault("key 5", 9999)
+
+    assert 3000 == len(index)
+    assert list(range(3000)) + [-1] == list(index.get_many(keys + ["missing"]))
+
+
+def test_index_is_compact(data_fetcher):
+    index = data_fetcher.db.participant_index
+    index.load()
+    for i in range(100000):
+        index.add_row(i + 1, f"{i:020d}", f"Person Name {i}", f"person{i}@example.com" if i % 3 == 0 else "")
+
+    assert index.nbytes() < 10 * 1024 * 1024
@@ -0,0 +1,69 @@
+import datetime as dt
+
+from processor.data_fetcher import DataFetcher
+from processor.db_helper import MAX_VARIABLES
+from processor.model import ReportCell, ReportSummary
+from processor.report_cache import ReportCache
+from tests.conftest import make_meeting_instance, attend_meeting_with_new_participant
+
+
+def ingest(meeting, uuid, start_time, names):
+    meeting_instance = make_meeting_instance(meeting, uuid, start_time=start_time)
+    for name in names:
+        attend_meeting_with_new_participant(meeting_instance, name)
+    DataFetcher.mark_cached(meeting_instance)
+    return meeting_instance
+
+
+def cells(meeting):
+    return [(c.date, c.attendance) for c in ReportCell.select().where(ReportCell.meeting == meeting)
+                                                      .order_by(ReportCell.date)]
+
+
+def test_refresh_builds_cells_and_averages(data_fetcher, meeting):
+    for day, names in enumerate([["a"], ["b", "c"], [], ["d", "e", "f"], ["g"]], start=1):
+        ingest(meeting, f"uuid-{day}", dt.datetime(2020, 5, day), names)
+    report_cache = ReportCache(data_fetcher.db)
+
+    assert 1 == report_cache.refresh([meeting.meeting_id])
+
+    assert [1, 2, 0, 3, 1] == [attendance for _, attendance in cells(meeting)]
+    assert {meeting.meeting_id: (7 / 5, 6 / 4)} == report_cache.fetch_summaries([meeting.meeting_id])
+
+
+def test_refresh_only_recounts_new_instances(data_fetcher, meeting, mocker):
+    ingest(meeting, "uuid-1", dt.datetime(2020, 5, 1), ["a"])
+    report_cache = ReportCache(data_fetcher.db)
+    report_cache.refresh([meeting.meeting_id])
+
+    assert 0 == report_cache.refresh([meeting.meeting_id])
+
+    # A later session on the same date replaces the earlier one
+    ingest(meeting, "uuid-2", dt.datetime(2020, 5, 1, 18), ["b", "c"])
+    ingest(meeting, "uuid-3", dt.datetime(2020, 5, 8), ["d"])
+    refresh_meeting = mocker.spy(report_cache, "refresh_meeting")
+
+    assert 1 == report_cache.refresh([meeting.meeting_id])
+    assert refresh_meeting.call_args.args[1] is not None
+    assert [(dt.date(2020, 5, 1), 2), (dt.date(2020, 5, 8), 1)] == cells(meeting)
+    assert (1.5, 1.5) == report_cache.fetch_summaries([meeting.meeting_id])[meeting.meeting_id]
+
+
+def test_refresh_meeting_without_instances(data_fetcher, meeting):
+    ReportCache(data_fetcher.db).refresh([meeting.meeting_id])
+
+    summary = ReportSummary.get_by_id(meeting.meeting_id)
+    assert summary.average is None
+    assert [] == cells(meeting)
+
+
+def test_cells_are_written_within_the_variable_limit(data_fetcher, meeting, mocker):
+    for day in range(400):
+        make_meeting_instance(meeting, f"uuid-{day}", start_time=dt.datetime(2020, 1, 1) + dt.timedelta(days=day))
+    execute_sql = mocker.spy(data_fetcher.db.db, "execute_sql")
+
+    ReportCache(data_fetcher.db).refresh([meeting.meeting_id])
+
+    assert 400 == len(cells(meeting))
+    assert max(len(call.args[1] or ()) for call in execute_sql.call_args_list
+               if call.args[0].startswith("INSERT")) <= MAX_VARIABLES
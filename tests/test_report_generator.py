@@ -1,11 +1,14 @@
+import csv
 import math
+import sys
 
 import responses
 import pandas as pd
 import datetime as dt
 
 from processor.model import Meeting
-from processor.report_generator import ReportGenerator
+from processor.participant_report_generator import ParticipantReportGenerator
+from processor.report_generator import ReportGenerator, main
 
 from tests.conftest import make_meeting_instance, attend_meeting_with_new_participant
 from tests.conftest import attend_meeting
@@ -91,6 +94,9 @@ def test_dataframe_to_array():
                 ['meeting_1', 'topic 1', 1.0, 2.0, 1.5, 1.5],
                 ['meeting_2', 'topic 2', 3.0, '', 3.0, 3.0]]
     assert ReportGenerator.dataframe_to_array(df) == expected
+    # The report itself keeps all of its columns
+    assert ['Name', "2020-08-01", "2020-08-02", ReportGenerator.AVG_COLUMN, ReportGenerator.LAST_FOUR] == \
+           list(df.columns)
 
 
 def test_dataframe_to_array_sorted():
@@ -159,3 +165,124 @@ def test_last_four_average(report_generator, mocker):
     avg = df.at[m2.meeting_id, ReportGenerator.LAST_FOUR]
     assert math.isclose(1.0, avg, rel_tol=1e-5)
 
+
+
+def test_avg_of_last_n_skips_missing_sessions():
+    dates = pd.DataFrame({"2020-05-03": [3.0, None], "2020-05-01": [1.0, 2.0],
+                          "2020-05-05": [None, None], "2020-05-04": [4.0, None],
+                          "2020-05-02": [2.0, None]},
+                         index=["meeting_1", "meeting_2"])
+    last_two = ReportGenerator.avg_of_last_n(dates, n=2)
+
+    assert math.isclose(3.5, last_two["meeting_1"], rel_tol=1e-5)
+    assert math.isclose(2.0, last_two["meeting_2"], rel_tol=1e-5)
+    assert math.isnan(ReportGenerator.avg_of_last_n(dates[["2020-05-05"]])["meeting_1"])
+
+
+def test_pivot_report_keeps_last_session_per_date():
+    records = [("meeting_1", "2020-05-02", 1), ("meeting_2", "2020-05-01", 2), ("meeting_1", "2020-05-02", 3)]
+    topics = {"meeting_1": "topic 1", "meeting_2": "topic 2", "meeting_3": "topic 3"}
+    df = ReportGenerator.pivot_report(records, topics)
+
+    assert ['Name', "2020-05-02", "2020-05-01"] == list(df.columns)
+    assert ["meeting_1", "meeting_2", "meeting_3"] == list(df.index)
+    assert 3 == df.at["meeting_1", "2020-05-02"]
+    assert "topic 3" == df.at["meeting_3", "Name"]
+
+
+def make_cached_meetings():
+    m1 = Meeting.create(meeting_id="meeting one", topic="meeting one topic")
+    m2 = Meeting.create(meeting_id="meeting two", topic="meeting two topic")
+    mi_1_1 = make_meeting_instance(m1, "meeting instance 1_1", start_time=dt.datetime(2020, 5, 1))
+    mi_1_2 = make_meeting_instance(m1, "meeting instance 1_2", start_time=dt.datetime(2020, 5, 2))
+    mi_2_1 = make_meeting_instance(m2, "meeting instance 2_1", start_time=dt.datetime(2020, 5, 2))
+    a, _ = attend_meeting_with_new_participant(mi_1_1, "a")
+    b, _ = attend_meeting_with_new_participant(mi_1_2, "b")
+    attend_meeting(mi_1_2, a)
+    attend_meeting(mi_2_1, b)
+    instances = {m1.meeting_id: [mi_1_1, mi_1_2], m2.meeting_id: [mi_2_1]}
+    for mi in [mi_1_1, mi_1_2, mi_2_1]:
+        mi.cached = True
+        mi.save()
+    return [m1.meeting_id, m2.meeting_id], instances
+
+
+def test_report_from_db_matches_report_from_participants(report_generator, data_fetcher, mocker):
+    meeting_ids, instances = make_cached_meetings()
+    mocker.patch.object(data_fetcher, "fetch_past_meeting_instances")
+    data_fetcher.fetch_past_meeting_instances.side_effect = lambda m: instances[m.meeting_id]
+
+    expected = report_generator.generate_report(meeting_ids)
+    report_generator.from_db = True
+    df = report_generator.generate_report(meeting_ids)
+
+    pd.testing.assert_frame_equal(expected, df)
+    assert 2 == df.at["meeting one", "2020-05-02"]
+
+
+def test_participant_report_from_db(data_fetcher, mocker):
+    meeting_ids, instances = make_cached_meetings()
+    mocker.patch.object(data_fetcher, "fetch_past_meeting_instances")
+    data_fetcher.fetch_past_meeting_instances.side_effect = lambda m: instances[m.meeting_id]
+    rg = ParticipantReportGenerator(data_fetcher, None)
+
+    expected = rg.generate_report(meeting_ids)
+    rg.from_db = True
+    df = rg.generate_report(meeting_ids)
+
+    pd.testing.assert_frame_equal(expected, df)
+    assert "b, a" == df.at["meeting one", "2020-05-02"]
+    assert "" == df.at["meeting two", "2020-05-01"]
+
+
+def test_attendance_counts_include_empty_instances(data_fetcher, meeting, meeting_instance):
+    attend_meeting_with_new_participant(meeting_instance, "a")
+    make_meeting_instance(meeting, "empty", start_time=dt.datetime(2020, 5, 18))
+
+    counts = data_fetcher.fetch_attendance_counts([meeting.meeting_id])
+    assert [(meeting.meeting_id, dt.datetime(2020, 5, 17), 1),
+            (meeting.meeting_id, dt.datetime(2020, 5, 18), 0)] == counts
+
+
+def test_report_from_cache_matches_report_from_db(report_generator, data_fetcher, mocker):
+    meeting_ids, instances = make_cached_meetings()
+    mocker.patch.object(data_fetcher, "fetch_past_meeting_instances")
+    data_fetcher.fetch_past_meeting_instances.side_effect = lambda m: instances[m.meeting_id]
+
+    report_generator.from_db = True
+    expected = report_generator.generate_report(meeting_ids)
+    report_generator.from_cache = True
+    df = report_generator.generate_report(meeting_ids)
+
+    pd.testing.assert_frame_equal(expected, df)
+
+
+def test_main_exports_the_full_report(data_fetcher, mocker, monkeypatch, tmp_path):
+    meeting_ids, instances = make_cached_meetings()
+    mocker.patch.object(data_fetcher, "fetch_past_meeting_instances")
+    data_fetcher.fetch_past_meeting_instances.side_effect = lambda m: instances[m.meeting_id]
+    mocker.patch("processor.report_generator.DbHelper")
+    mocker.patch("processor.report_generator.make_data_fetcher", return_value=data_fetcher)
+    google = mocker.patch("processor.report_generator.GoogleHelper").return_value
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".secrets").mkdir()
+    (tmp_path / ".secrets" / "service_account.json").write_text("{}")
+    (tmp_path / "meetings.txt").write_text("\n".join(meeting_ids))
+    monkeypatch.setattr(sys, "argv", ["report_generator.py", "test.db", "meetings.txt"])
+    monkeypatch.setenv("ZOOM_API_KEY", "test_key")
+    monkeypatch.setenv("ZOOM_API_SECRET", "test_secret")
+    monkeypatch.setenv("ZOOM_EXPORT_FORMAT", "csv")
+    for name in ["ZOOM_FETCH_MODE", "ZOOM_REPORT_SOURCE", "ZOOM_RESPONSE_CACHE", "ZOOM_SHEET_ID", "ZOOM_TRACE"]:
+        monkeypatch.delenv(name, raising=False)
+
+    main()
+
+    run_date = dt.datetime.now().date().strftime('%Y-%m-%d')
+    with open(tmp_path / f"attendance_{run_date}.csv", newline="") as f:
+        header = next(csv.reader(f))
+    assert {ReportGenerator.TOPIC_COLUMN, ReportGenerator.AVG_COLUMN, ReportGenerator.LAST_FOUR} <= set(header)
+    uploaded, keep_snapshot = google.write_values.call_args[0][1:]
+    assert ['Meeting ID', ReportGenerator.TOPIC_COLUMN] == uploaded[0][:2]
+    assert ReportGenerator.LAST_FOUR == uploaded[0][-1]
+    # Without ZOOM_SHEET_ID each run uploads to a new sheet, which is never diffed against again
+    assert not keep_snapshot
@@ -0,0 +1,111 @@
+import csv
+import datetime as dt
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from processor.data_fetcher import DataFetcher
+from processor.model import Meeting
+from processor.report_server import ReportServer
+from tests.conftest import make_meeting_instance, attend_meeting_with_new_participant
+
+
+def ingest(meeting, uuid, start_time, names):
+    meeting_instance = make_meeting_instance(meeting, uuid, start_time=start_time)
+    for name in names:
+        attend_meeting_with_new_participant(meeting_instance, name)
+    DataFetcher.mark_cached(meeting_instance)
+
+
+@pytest.fixture
+def report_server(data_fetcher):
+    first = Meeting.create(meeting_id="1", topic="topic 1")
+    second = Meeting.create(meeting_id="2", topic="topic 2")
+    ingest(first, "uuid-1", dt.datetime(2020, 8, 1), ["a", "b"])
+    ingest(first, "uuid-2", dt.datetime(2020, 8, 8), ["c"])
+    ingest(second, "uuid-3", dt.datetime(2020, 8, 8), ["d", "e", "f"])
+    report_server = ReportServer(data_fetcher.db)
+    server = report_server.start_server(port=0)
+    report_server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield report_server
+    report_server.close()
+
+
+def test_report_matches_the_sheet(report_server):
+    report = requests.get(f"{report_server.url}/report").json()
+
+    assert ["Meeting ID", "Name", "2020-08-01", "2020-08-08", "Average", "Last Four Average"] == report["columns"]
+    assert [["1", "topic 1", 2.0, 1.0, 1.5, 1.5], ["2", "topic 2", "", 3.0, 3.0, 3.0]] == report["rows"]
+
+
+def test_filters_by_meeting_and_date(report_server):
+    report = requests.get(f"{report_server.url}/report",
+                          params={"meetings": "1", "from": "2020-08-02", "to": "2020-08-31"}).json()
+
+    # The averages only cover the selected dates
+    assert [["1", "topic 1", 1.0, 1.0, 1.0]] == report["rows"]
+    assert 400 == requests.get(f"{report_server.url}/report", params={"from": "August"}).status_code
+
+
+def test_participants_as_csv(report_server):
+    response = requests.get(f"{report_server.url}/participants", params={"format": "csv"})
+
+    assert response.headers["Content-Type"].startswith("text/csv")
+    assert [["Meeting ID", "Name", "2020-08-01", "2020-08-08"],
+            ["1", "topic 1", "a, b", "c"],
+            ["2", "topic 2", "", "d, e, f"]] == list(csv.reader(io.StringIO(response.text)))
+
+
+def test_meeting_series(report_server):
+    series = requests.get(f"{report_server.url}/meetings/1").json()
+
+    assert {"meeting_id": "1", "topic": "topic 1",
+            "series": [{"date": "2020-08-01", "attendance": 2, "participants": "a, b"},
+                       {"date": "2020-08-08", "attendance": 1, "participants": "c"}]} == series
+    assert 404 == requests.get(f"{report_server.url}/meetings/3").status_code
+    meetings = requests.get(f"{report_server.url}/meetings").json()
+    assert [["1", "topic 1"], ["2", "topic 2"]] == meetings["rows"]
+
+
+def test_etags_and_refresh(report_server):
+    response = requests.get(f"{report_server.url}/report")
+    etag = response.headers["ETag"]
+
+    not_modified = requests.get(f"{report_server.url}/report", headers={"If-None-Match": etag})
+    assert 304 == not_modified.status_code and b"" == not_modified.content
+    assert not report_server.refresh()
+
+    ingest(Meeting.get_by_id("2"), "uuid-4", dt.datetime(2020, 8, 15), ["g"])
+    assert report_server.refresh()
+
+    changed = requests.get(f"{report_server.url}/report", headers={"If-None-Match": etag})
+    assert 200 == changed.status_code and etag != changed.headers["ETag"]
+    assert "2020-08-15" in changed.json()["columns"]
+
+
+def test_refreshes_on_attendance_of_instances_not_ingested(report_server):
+    # Webhooks store participants as they join, well before the instance is ingested
+    meeting_instance = make_meeting_instance(Meeting.get_by_id("1"), "uuid-live", start_time=dt.datetime(2020, 8, 15))
+    assert report_server.refresh()
+
+    attend_meeting_with_new_participant(meeting_instance, "g")
+    assert report_server.refresh()
+
+    series = requests.get(f"{report_server.url}/meetings/1").json()["series"]
+    assert {"date": "2020-08-15", "attendance": 1, "participants": "g"} == series[-1]
+
+
+def test_concurrent_reads(report_server):
+    def read(i):
+        params = {"meetings": "1,2"[:1 + 2 * (i % 2)], "format": ["json", "csv"][i % 3 % 2]}
+        with requests.get(f"{report_server.url}/{['report', 'participants'][i % 2]}", params=params) as response:
+            return response.status_code, response.headers["ETag"]
+
+    with ThreadPoolExecutor(max_workers=100) as executor:
+        results = list(executor.map(read, range(300)))
+
+    assert all(status == 200 for status, _ in results)
+    # Each distinct query got one cached response
+    assert len(set(etag for _, etag in results)) == len(report_server.snapshot.responses)
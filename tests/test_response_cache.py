@@ -0,0 +1,148 @@
+import datetime
+import os
+
+import pytest
+import responses
+from requests import Response
+
+from processor.data_fetcher import DataFetcher
+from processor.db_helper import DbHelper
+from processor.response_cache import ResponseCache, DAY, MINUTE
+from processor.zoom_helper import ZoomHelper, MEETING_DETAILS, RESPONSE_CACHE_TTLS, make_rate_limits
+from tests.fake_zoom import FakeZoomServer
+
+
+@pytest.fixture
+def now():
+    return [datetime.datetime(2020, 9, 1, tzinfo=datetime.timezone.utc).timestamp()]
+
+
+@pytest.fixture
+def response_cache(now, tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.db"), RESPONSE_CACHE_TTLS, clock=lambda: now[0])
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def zoom_helper(response_cache):
+    zoom = ZoomHelper('https://test.example.com/v2', 'test_key', 'test_secret', response_cache=response_cache)
+    zoom.rate_limits = make_rate_limits()
+    return zoom
+
+
+def make_response(body, headers=None):
+    r = Response()
+    r.status_code = 200
+    r._content = body
+    r.headers.update(headers or {})
+    return r
+
+
+def test_store_and_lookup(response_cache, now):
+    response_cache.store(MEETING_DETAILS, "url", {"a": 1}, make_response(b'{"topic": "t"}'))
+
+    assert response_cache.lookup(MEETING_DETAILS, "url", {"a": 2}) is None
+    entry = response_cache.lookup(MEETING_DETAILS, "url", {"a": 1})
+    assert entry.fresh(now[0])
+    assert {"topic": "t"} == entry.response("url").json()
+
+    now[0] += 31 * DAY
+    assert not response_cache.lookup(MEETING_DETAILS, "url", {"a": 1}).fresh(now[0])
+    assert {"hits": 1, "misses": 1, "stale": 1, "revalidated": 0, "stored": 1, "evicted": 0} == response_cache.stats
+
+
+def test_only_caches_endpoints_with_a_ttl(response_cache):
+    assert response_cache.cacheable(MEETING_DETAILS)
+    assert not response_cache.cacheable("participants")
+
+
+def test_evicts_least_recently_used(response_cache, now):
+    body = os.urandom(1000)
+    response_cache.max_bytes = 2500
+    for key in ["a", "b", "c"]:
+        response_cache.store(MEETING_DETAILS, key, None, make_response(body))
+        now[0] += 1
+        response_cache.lookup(MEETING_DETAILS, "a")
+
+    assert response_cache.lookup(MEETING_DETAILS, "b") is None
+    assert response_cache.lookup(MEETING_DETAILS, "a") is not None
+    assert response_cache.size() <= 2500
+    assert 1 == response_cache.stats["evicted"]
+
+
+@responses.activate
+def test_fresh_responses_skip_zoom(zoom_helper):
+    responses.add(responses.GET, f"{zoom_helper.base_url}/report/meetings/1", json={"topic": "topic 1"})
+
+    first = zoom_helper.get_meeting_details('1')
+    second = zoom_helper.get_meeting_details('1')
+
+    assert 1 == len(responses.calls)
+    assert first.json() == second.json()
+    assert second.from_cache
+
+
+@responses.activate
+def test_revalidates_stale_responses_with_etag(zoom_helper, now):
+    url = f"{zoom_helper.base_url}/report/meetings/2"
+    responses.add(responses.GET, url, json={"topic": "topic 2"}, headers={"ETag": '"v1"'})
+    responses.add(responses.GET, url, status=304)
+    zoom_helper.get_meeting_details('2')
+
+    now[0] += 31 * DAY
+    r = zoom_helper.get_meeting_details('2')
+
+    assert '"v1"' == responses.calls[1].request.headers["If-None-Match"]
+    assert {"topic": "topic 2"} == r.json()
+    assert 1 == zoom_helper.response_cache.stats["revalidated"]
+    zoom_helper.get_meeting_details('2')
+    assert 2 == len(responses.calls)
+
+
+@responses.activate
+def test_instance_lists_expire_within_minutes(zoom_helper, now):
+    url = f"{zoom_helper.past_meetings_url}/3/instances"
+    # The meeting last ran a year ago, but can run again any time
+    responses.add(responses.GET, url, json={"meetings": [{"uuid": "a", "start_time": "2019-09-01T00:00:00Z"}]})
+    responses.add(responses.GET, url, json={"meetings": [{"uuid": "a", "start_time": "2019-09-01T00:00:00Z"},
+                                                         {"uuid": "b", "start_time": "2020-09-01T00:03:00Z"}]})
+    zoom_helper.get_past_meeting_instances('3')
+
+    now[0] += 4 * MINUTE
+    assert 1 == len(zoom_helper.get_past_meeting_instances('3').json()["meetings"])
+    now[0] += 2 * MINUTE
+    assert 2 == len(zoom_helper.get_past_meeting_instances('3').json()["meetings"])
+    assert 2 == len(responses.calls)
+
+
+def test_runs_within_the_ttl_reuse_instance_lists(response_cache, now, tmp_path):
+    fake_zoom = FakeZoomServer().start()
+    try:
+        for meeting_id in range(5):
+            fake_zoom.add_meeting(meeting_id, f"topic {meeting_id}",
+                                  [(f"uuid-{meeting_id}", "2019-08-01T18:06:45Z", [])])
+
+        def run():
+            # Each run opens the same DB, like report_generator.py does
+            zoom = ZoomHelper(fake_zoom.base_url, 'test_key', 'test_secret', response_cache=response_cache)
+            zoom.rate_limits = make_rate_limits()
+            data_fetcher = DataFetcher(DbHelper(str(tmp_path / "zoom.db")), zoom)
+            for meeting_id in range(5):
+                data_fetcher.sync_meeting(str(meeting_id))
+            data_fetcher.db.db.close()
+
+        run()
+        now[0] += MINUTE
+        run()
+        instances_within_the_ttl = len(fake_zoom.calls_to("instances"))
+        now[0] += DAY
+        run()
+    finally:
+        fake_zoom.stop()
+
+    # The DB already keeps meeting details and participants, the response cache only saves the instance lists
+    assert 5 == len(fake_zoom.calls_to("details"))
+    assert 5 == len(fake_zoom.calls_to("participants"))
+    assert 5 == instances_within_the_ttl
+    assert 10 == len(fake_zoom.calls_to("instances"))
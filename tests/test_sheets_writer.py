@@ -0,0 +1,103 @@
+import pytest
+from googleapiclient.errors import HttpError
+
+from processor.db_helper import DbHelper
+from processor.model import SheetSnapshot
+from processor.sheets_writer import SheetsWriter, changed_blocks, column_letter
+from tests.fake_sheets import FakeSheetsServer
+
+
+@pytest.fixture
+def fake_sheets():
+    DbHelper(':memory:')
+    server = FakeSheetsServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def writer(fake_sheets, mocker):
+    # Don't wait between retries
+    mocker.patch("googleapiclient.http.time.sleep")
+    return SheetsWriter(fake_sheets.client())
+
+
+def make_report(meetings, dates):
+    header = ['Meeting ID', 'Name'] + [f"2020-01-{d:02d}" for d in range(1, dates + 1)] + ['Average']
+    rows = [[str(m), f"topic {m}"] + [m + d for d in range(dates)] + [m + dates / 2] for m in range(meetings)]
+    return [header] + rows
+
+
+def test_column_letter():
+    assert ["A", "Z", "AA", "AZ", "ZZ", "AAA"] == [column_letter(i) for i in [0, 25, 26, 51, 701, 702]]
+
+
+def test_changed_blocks_merges_a_new_column_into_one_block():
+    before = make_report(5, 3)
+    after = make_report(5, 4)
+
+    assert [(0, 5, 5, 6)] == changed_blocks(before, after)
+    assert [] == changed_blocks(after, after)
+
+
+def test_writes_the_whole_report_first(fake_sheets, writer):
+    report = make_report(20, 30)
+    result = writer.write("sheet", report)
+
+    assert report == fake_sheets.grid("sheet")
+    assert 1 == result["requests"]
+    assert 21 * 33 == result["updatedCells"]
+
+
+def test_only_sends_what_changed(fake_sheets, writer):
+    writer.write("sheet", make_report(20, 30))
+
+    assert 0 == writer.write("sheet", make_report(20, 30))["requests"]
+
+    result = writer.write("sheet", make_report(20, 31))
+    assert make_report(20, 31) == fake_sheets.grid("sheet")
+    assert 1 == result["updatedRanges"]
+    assert 21 * 2 == result["updatedCells"]
+
+
+def test_clears_cells_that_are_gone(fake_sheets, writer):
+    writer.write("sheet", make_report(20, 30))
+    writer.write("sheet", make_report(10, 5))
+
+    assert make_report(10, 5) == fake_sheets.grid("sheet")
+
+
+def test_splits_large_uploads_into_chunks(fake_sheets, mocker):
+    writer = SheetsWriter(fake_sheets.client(), max_chunk_bytes=2000)
+    report = make_report(50, 40)
+    result = writer.write("sheet", report)
+
+    assert report == fake_sheets.grid("sheet")
+    assert result["requests"] > 1
+    assert all(size < 2000 * 2 for size in fake_sheets.requests)
+
+
+def test_retries_failed_chunks(fake_sheets, writer):
+    fake_sheets.fail_next(503, 429)
+    report = make_report(3, 3)
+    writer.write("sheet", report)
+
+    assert report == fake_sheets.grid("sheet")
+    assert 3 == len(fake_sheets.requests)
+
+
+def test_keeps_the_snapshot_when_a_chunk_fails(fake_sheets, writer):
+    writer.max_retries = 1
+    fake_sheets.fail_next(503, 503)
+    with pytest.raises(HttpError):
+        writer.write("sheet", make_report(3, 3))
+
+    writer.write("sheet", make_report(3, 3))
+    assert make_report(3, 3) == fake_sheets.grid("sheet")
+
+
+def test_does_not_keep_a_snapshot_of_a_sheet_written_once(fake_sheets, writer):
+    writer.write("sheet", make_report(3, 3), keep_snapshot=False)
+
+    assert make_report(3, 3) == fake_sheets.grid("sheet")
+    assert 0 == SheetSnapshot.select().count()
@@ -0,0 +1,141 @@
+import pytest
+
+from processor.data_fetcher import DataFetcher
+from processor.db_helper import DbHelper
+from processor.model import Attendance, Meeting, MeetingInstance, Participant
+from processor.report_generator import ReportGenerator, make_data_fetcher
+from processor.threaded_data_fetcher import OrderedIngest, ThreadedDataFetcher
+from processor.zoom_helper import ZoomHelper, make_rate_limits
+from tests.conftest import load_participants, make_meeting_instance
+
+
+def new_data_fetcher(fake_zoom, cls=ThreadedDataFetcher, **kwargs):
+    db = DbHelper(':memory:')
+    zoom = ZoomHelper(fake_zoom.base_url, 'test_key', 'test_secret')
+    zoom.rate_limits = make_rate_limits()
+    return cls(db, zoom, **kwargs)
+
+
+def add_renaming_meetings(fake_zoom, meetings=4, instances=3, people=30):
+    """
+    The same people join every meeting under a different name each time, so the stored names and the
+    participant ids depend on the order the instances are ingested in.
+    """
+    meeting_ids = []
+    for m in range(meetings):
+        meeting_id = str(100 + m)
+        meeting_ids.append(meeting_id)
+        fake_zoom.add_meeting(meeting_id, f"topic {m}", [
+            (f"uuid-{m}-{i}", f"2020-08-{1 + 7 * i:02d}T18:06:45Z",
+             [{"id": f"user{p}", "name": f"Person {p} ({m})",
+               "user_email": f"person{p}@example.com" if p % 2 else ""}
+              for p in range(people)[::-1 if (m + i) % 2 else 1]])
+            for i in range(instances)])
+    return meeting_ids
+
+
+def db_state():
+    return (list(Participant.select(Participant.id, Participant.user_id, Participant.name, Participant.email)
+                            .order_by(Participant.id).tuples()),
+            list(Attendance.select(Attendance.meeting_instance, Attendance.participant)
+                           .order_by(Attendance.id).tuples()))
+
+
+def test_prefetch_meetings(fake_zoom):
+    data_fetcher = new_data_fetcher(fake_zoom)
+    participants = load_participants()
+    fake_zoom.add_meeting(1, "topic 1", [("uuid-1", "2020-08-01T18:06:45Z", participants),
+                                         ("uuid/2", "2020-08-08T18:06:45Z", participants[:3])])
+    fake_zoom.add_meeting(2, "topic 2", [("uuid-3", "2020-08-01T19:06:45Z", [])])
+
+    data_fetcher.prefetch(["1", "2"])
+
+    assert 3 == MeetingInstance.select().where(MeetingInstance.cached == True).count()
+    assert 20 + 3 == Attendance.select().count()
+    assert 3 == len(fake_zoom.calls_to("participants"))
+
+
+def test_prefetch_skips_cached_instances(fake_zoom):
+    data_fetcher = new_data_fetcher(fake_zoom)
+    participants = load_participants()
+    fake_zoom.add_meeting(1, "topic 1", [("uuid-1", "2020-08-01T18:06:45Z", participants)])
+    data_fetcher.prefetch(["1"])
+    fake_zoom.add_meeting(1, "topic 1", [("uuid-1", "2020-08-01T18:06:45Z", participants),
+                                         ("uuid-2", "2020-08-08T18:06:45Z", participants[:3])])
+
+    data_fetcher.prefetch(["1"])
+
+    assert 2 == len(fake_zoom.calls_to("participants"))
+    assert 1 == len(fake_zoom.calls_to("details"))
+    assert 20 + 3 == Attendance.select().count()
+
+
+@pytest.mark.parametrize("max_workers", [1, 3, 16])
+def test_prefetch_stores_like_a_sequential_run(fake_zoom, max_workers):
+    fake_zoom.page_size = 4
+    meeting_ids = add_renaming_meetings(fake_zoom)
+    sequential = new_data_fetcher(fake_zoom, DataFetcher)
+    ReportGenerator(sequential, None).generate_report(meeting_ids)
+    expected = db_state()
+
+    data_fetcher = new_data_fetcher(fake_zoom, max_workers=max_workers)
+    data_fetcher.prefetch(meeting_ids)
+
+    assert expected == db_state()
+    # People with an email keep the name they first joined with
+    assert all(name.endswith("(0)") for _, _, name, email in expected[0] if email)
+
+
+def test_ordered_ingest_only_starts_a_few_instances_ahead(data_fetcher):
+    meetings = [Meeting.create(meeting_id=str(m), topic=f"topic {m}") for m in range(2)]
+    instances = [[make_meeting_instance(meeting, f"uuid-{meeting.meeting_id}-{i}") for i in range(3)]
+                 for meeting in meetings]
+    ordered = OrderedIngest(data_fetcher.db, len(meetings))
+
+    ordered.expect(1, instances[1])
+    assert ["uuid-1-0", "uuid-1-1"] == ordered.start(2)
+    # The first meeting's instances are stored first, so the next of them can start over the limit
+    ordered.expect(0, instances[0])
+    assert ["uuid-0-0"] == ordered.start(2)
+    assert [] == ordered.start(2)
+
+    ordered.add_page("uuid-0-0", [])
+    ordered.finish("uuid-0-0")
+    ordered.drain()
+    assert ["uuid-0-1"] == ordered.start(2)
+
+
+def test_report_after_prefetch_uses_cache(fake_zoom):
+    data_fetcher = new_data_fetcher(fake_zoom, max_workers=4)
+    meeting_ids = add_renaming_meetings(fake_zoom)
+    data_fetcher.prefetch(meeting_ids)
+    calls = len(fake_zoom.calls)
+
+    df = ReportGenerator(data_fetcher, None).generate_report(meeting_ids)
+
+    assert calls == len(fake_zoom.calls)
+    assert list(df.index) == meeting_ids
+    assert 30 == df.at["100", "2020-08-01"]
+
+
+def test_prefetch_missing_meeting(fake_zoom):
+    data_fetcher = new_data_fetcher(fake_zoom, max_workers=2)
+    participants = load_participants()
+    fake_zoom.add_meeting(1, "topic 1", [("uuid-1", "2020-08-01T18:06:45Z", participants)])
+
+    with pytest.raises(RuntimeError):
+        data_fetcher.prefetch(["1", "404"])
+
+
+def test_make_data_fetcher_threads(fake_zoom, monkeypatch):
+    monkeypatch.setenv("ZOOM_FETCH_MODE", "threads")
+    monkeypatch.setenv("ZOOM_FETCH_WORKERS", "3")
+    fake_zoom.add_meeting(1, "topic 1", [("uuid-1", "2020-08-01T18:06:45Z", [])])
+    db = DbHelper(':memory:')
+    zoom = ZoomHelper(fake_zoom.base_url, 'test_key', 'test_secret')
+
+    data_fetcher = make_data_fetcher(db, zoom, ["1"])
+
+    assert isinstance(data_fetcher, ThreadedDataFetcher)
+    assert 3 == data_fetcher.max_workers
+    assert 1 == MeetingInstance.select().where(MeetingInstance.cached == True).count()
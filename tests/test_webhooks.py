@@ -0,0 +1,122 @@
+import hashlib
+import hmac
+import json
+
+import pytest
+import requests
+
+from processor.data_fetcher import DataFetcher
+from processor.model import Attendance, AttendanceInterval, MeetingInstance
+from processor.webhooks import WebhookReceiver, replay, sign, verify_signature
+from processor.zoom_helper import ZoomHelper, make_rate_limits
+from tests.fake_zoom import FakeZoomServer
+
+SECRET = "test_secret_token"
+COVERED = "4444AAAiAAAAAiAiAiiAii=="
+MISSED_START = "5555BBBjBBBBBjBjBjjBjj=="
+
+
+@pytest.fixture
+def events():
+    with open('tests/test_data/webhook_events.json') as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def receiver(data_fetcher):
+    receiver = WebhookReceiver(data_fetcher.db, SECRET, batch_size=4)
+    server = receiver.start_server(port=0)
+    receiver.url = f"http://127.0.0.1:{server.server_address[1]}/"
+    yield receiver
+    receiver.close()
+
+
+def intervals(uuid):
+    return [(i.participant.name, i.join_offset, i.leave_offset)
+            for i in AttendanceInterval.select().where(AttendanceInterval.meeting_instance == uuid)
+                                       .order_by(AttendanceInterval.participant, AttendanceInterval.join_offset)]
+
+
+def test_verify_signature():
+    body = b'{"event": "meeting.started"}'
+    signature = sign(SECRET, "1596837300", body)
+
+    assert verify_signature(SECRET, "1596837300", body, signature, now=1596837400)
+    assert not verify_signature(SECRET, "1596837300", body + b" ", signature, now=1596837400)
+    assert not verify_signature("another secret", "1596837300", body, signature, now=1596837400)
+    # Too old to be anything but a replay
+    assert not verify_signature(SECRET, "1596837300", body, signature, now=1596837300 + 301)
+    assert not verify_signature(SECRET, None, body, signature)
+
+
+def test_replayed_events_are_stored(receiver, events):
+    assert [200] * len(events) == replay(events, receiver.url, SECRET)
+
+    assert len(events) == receiver.drain()
+
+    covered = MeetingInstance.get_by_id(COVERED)
+    assert covered.cached and covered.ingested_at is not None
+    assert ["Alice Example", "Bob"] == [a.participant.name for a in Attendance.select()
+                                        .where(Attendance.meeting_instance == COVERED).order_by(Attendance.id)]
+    # Alice rejoined and was still there at the end, the redelivered join isn't counted twice
+    assert [("Alice Example", 10, 2100), ("Alice Example", 2400, 3600), ("Bob", 60, 3300)] == intervals(COVERED)
+
+    missed_start = MeetingInstance.get_by_id(MISSED_START)
+    assert not missed_start.cached
+    assert 1 == Attendance.select().where(Attendance.meeting_instance == MISSED_START).count()
+
+
+def test_covered_instances_are_not_polled(receiver, events, data_fetcher):
+    replay(events, receiver.url, SECRET)
+    receiver.drain()
+    fake_zoom = FakeZoomServer().start()
+    try:
+        fake_zoom.add_meeting("85746065432", "Evening Circle", [
+            (COVERED, "2020-08-07T21:55:00Z", []),
+            (MISSED_START, "2020-08-14T21:55:00Z", [{"id": "", "name": "Carol", "user_email": "",
+                                                     "join_time": "2020-08-14T21:55:10Z",
+                                                     "leave_time": "2020-08-14T22:10:00Z"}])])
+        zoom = ZoomHelper(fake_zoom.base_url, 'test_key', 'test_secret')
+        zoom.rate_limits = make_rate_limits()
+
+        DataFetcher(data_fetcher.db, zoom).sync_meeting("85746065432")
+
+        assert 1 == len(fake_zoom.calls_to("participants"))
+    finally:
+        fake_zoom.stop()
+    assert MeetingInstance.get_by_id(MISSED_START).cached
+    assert 2 == Attendance.select().where(Attendance.meeting_instance == COVERED).count()
+
+
+def test_requests_are_verified(receiver, events):
+    body = json.dumps(events[0]).encode()
+    response = requests.post(receiver.url, data=body, headers={"x-zm-request-timestamp": "1596837300",
+                                                               "x-zm-signature": sign(SECRET, "1596837300", body)})
+
+    assert 401 == response.status_code
+    assert 0 == receiver.drain()
+
+
+def test_url_validation(data_fetcher):
+    receiver = WebhookReceiver(data_fetcher.db, SECRET, clock=lambda: 1654503849)
+    body = json.dumps({"event": "endpoint.url_validation", "event_ts": 1654503849680,
+                       "payload": {"plainToken": "qgg8vlvZRS6UYooatFL8Aw"}}).encode()
+    headers = {"x-zm-request-timestamp": "1654503849", "x-zm-signature": sign(SECRET, "1654503849", body)}
+
+    status, response = receiver.handle(headers, body)
+
+    assert 200 == status
+    assert {"plainToken": "qgg8vlvZRS6UYooatFL8Aw",
+            "encryptedToken": hmac.new(SECRET.encode(), b"qgg8vlvZRS6UYooatFL8Aw", hashlib.sha256).hexdigest()} \
+        == response
+    assert 0 == receiver.drain()
+
+
+def test_full_queue_asks_zoom_to_retry(data_fetcher, events):
+    receiver = WebhookReceiver(data_fetcher.db, SECRET, queue_size=1, clock=lambda: 1596837300)
+    body = json.dumps(events[0]).encode()
+    headers = {"x-zm-request-timestamp": "1596837300", "x-zm-signature": sign(SECRET, "1596837300", body)}
+
+    assert 200 == receiver.handle(headers, body)[0]
+    assert 503 == receiver.handle(headers, body)[0]
+    assert 1 == receiver.drain()
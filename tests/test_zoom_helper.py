@@ -1,4 +1,14 @@
+import datetime
+import email.utils
+import math
+
+import pytest
 import responses
+from requests import Response
+
+from processor.zoom_helper import ZoomHelper, TokenBucket, JwtTokenProvider, HEAVY, MEDIUM, HEAVY_CALLS, \
+    MEDIUM_CALLS, IN_FLIGHT_POLL, make_rate_limits
+from tests.fake_zoom import FakeZoomServer
 
 
 @responses.activate
@@ -31,3 +41,229 @@ def test_get_meeting_participants_401(zoom_helper):
                   json={'error': 'unauthorized'}, status=401)
     r = zoom_helper.get_meeting_details('1', b'1')
     assert 401 == r.status_code
+
+
+@responses.activate
+def test_retries_throttled_request_after_retry_after(zoom_helper, mocker):
+    sleep = mocker.patch("processor.zoom_helper.time.sleep")
+    url = f"{zoom_helper.base_url}/report/meetings/{3}"
+    responses.add(responses.GET, url, json={}, status=429, headers={"Retry-After": "2"})
+    responses.add(responses.GET, url, json={"topic": "3"}, status=200)
+
+    r = zoom_helper.get_meeting_details('3', b'3')
+    assert 200 == r.status_code
+    assert 2 == len(responses.calls)
+    sleep.assert_any_call(2.0)
+
+
+@responses.activate
+def test_retries_server_errors_with_backoff(zoom_helper, mocker):
+    mocker.patch("processor.zoom_helper.time.sleep")
+    url = f"{zoom_helper.base_url}/past_meetings/{4}/instances"
+    responses.add(responses.GET, url, json={}, status=502)
+    responses.add(responses.GET, url, json={}, status=503)
+    responses.add(responses.GET, url, json={"meetings": []}, status=200)
+
+    r = zoom_helper.get_past_meeting_instances('4', b'4')
+    assert 200 == r.status_code
+    assert 3 == len(responses.calls)
+
+
+@responses.activate
+def test_gives_up_after_max_retries(zoom_helper, mocker):
+    mocker.patch("processor.zoom_helper.time.sleep")
+    zoom_helper.max_retries = 2
+    responses.add(responses.GET, f"{zoom_helper.base_url}/report/meetings/{5}", json={}, status=500)
+
+    r = zoom_helper.get_meeting_details('5', b'5')
+    assert 500 == r.status_code
+    assert 3 == len(responses.calls)
+
+
+def test_parse_retry_after(zoom_helper):
+    assert zoom_helper.parse_retry_after(None) is None
+    assert 3.0 == zoom_helper.parse_retry_after("3")
+    assert 0.0 == zoom_helper.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT")
+    assert 0.0 == zoom_helper.parse_retry_after("Wed, 21 Oct 2015 07:28:00 -0000")
+    in_a_minute = email.utils.format_datetime(datetime.datetime.utcnow() + datetime.timedelta(minutes=1))
+    assert in_a_minute.endswith("-0000")
+    assert 50 < zoom_helper.parse_retry_after(in_a_minute) <= 60
+    assert zoom_helper.parse_retry_after("soon") is None
+
+
+def test_token_bucket_spaces_out_callers():
+    now = [0.0]
+    bucket = TokenBucket(rate=10, capacity=2, clock=lambda: now[0])
+
+    assert 0 == bucket.reserve()
+    assert 0 == bucket.reserve()
+    assert math.isclose(0.1, bucket.reserve())
+    assert math.isclose(0.2, bucket.reserve())
+
+    now[0] = 1.0
+    assert 0 == bucket.reserve()
+
+
+def test_token_bucket_limits_requests_per_window():
+    now = [0.0]
+    bucket = TokenBucket(rate=9, clock=lambda: now[0])
+    for i in range(9):
+        now[0] = i / 9
+        assert bucket.claim() is None
+        bucket.release()
+
+    # The tenth token is due a second after the first, but that request's response only came back at 0.0
+    now[0] = 9 / 9 - 0.01
+    assert math.isclose(0.01, bucket.claim())
+    now[0] = 1.0
+    assert bucket.claim() is None
+
+
+def test_token_bucket_holds_slots_in_flight():
+    now = [0.0]
+    bucket = TokenBucket(rate=2, clock=lambda: now[0])
+    assert bucket.claim() is None
+    assert bucket.claim() is None
+
+    now[0] = 5.0
+    # Both requests were sent long ago, but could still reach Zoom at any time
+    assert IN_FLIGHT_POLL == bucket.claim()
+    bucket.release()
+    now[0] = 5.5
+    assert math.isclose(0.5, bucket.claim())
+    now[0] = 6.0
+    assert bucket.claim() is None
+
+
+def test_rate_limits_are_shared_between_processes():
+    limits = make_rate_limits(processes=2)
+
+    assert HEAVY_CALLS // 2 == limits[HEAVY].limit
+    assert MEDIUM_CALLS // 2 == limits[MEDIUM].limit
+
+
+def test_token_bucket_pause():
+    now = [0.0]
+    bucket = TokenBucket(rate=10, capacity=10, clock=lambda: now[0])
+    bucket.pause(5)
+
+    assert 5 == bucket.reserve()
+    now[0] = 5.0
+    assert 0 == bucket.reserve()
+
+
+@responses.activate
+def test_rate_limit_metrics(zoom_helper):
+    responses.add(responses.GET, f"{zoom_helper.base_url}/report/meetings/{6}", json={}, status=200)
+
+    zoom_helper.get_meeting_details('6', b'6')
+    zoom_helper.get_meeting_details('6', b'6')
+
+    metrics = zoom_helper.rate_limit_metrics()
+    assert 2 == metrics[HEAVY]["requests"]
+    assert 0 == metrics[MEDIUM]["requests"]
+    assert metrics[HEAVY]["wait_time"] > 0
+
+
+def test_session_reuses_connections_and_records_timings():
+    fake_zoom = FakeZoomServer().start()
+    try:
+        fake_zoom.add_meeting(7, "topic 7", [])
+        zoom = ZoomHelper(fake_zoom.base_url, 'test_key', 'test_secret', pool_size=2)
+
+        first = zoom.get_meeting_details('7', b'7')
+        second = zoom.get_meeting_details('7', b'7')
+        zoom.close()
+    finally:
+        fake_zoom.stop()
+
+    assert 200 == first.status_code
+    assert first.timings["connect"] > 0
+    assert 0 == second.timings["connect"]
+    assert 0 == second.timings["dns"]
+    assert second.timings["total"] >= second.timings["first_byte"]
+    metrics = zoom.connection_metrics.summary()
+    assert 2 == metrics["requests"]
+    assert 1 == metrics["new_connections"]
+
+
+@responses.activate
+def test_iter_meeting_participants_follows_pages(zoom_helper, mocker):
+    url = f"{zoom_helper.base_url}/report/meetings/8/participants"
+    responses.add(responses.GET, url, json={"next_page_token": "a", "participants": [{"id": "1"}, {"id": "2"}]})
+    responses.add(responses.GET, url, json={"next_page_token": "", "participants": [{"id": "3"}]})
+    json_calls = mocker.spy(Response, "json")
+
+    records = zoom_helper.iter_meeting_participants('8', b'8')
+    assert {"id": "1"} == next(records)
+    assert 1 == len(responses.calls)
+
+    assert [{"id": "2"}, {"id": "3"}] == list(records)
+    assert 2 == len(responses.calls)
+    assert "next_page_token=a" in responses.calls[1].request.url
+    # Each page is parsed once
+    assert 2 == json_calls.call_count
+
+
+@responses.activate
+def test_iter_meeting_participants_raises_on_failed_page(zoom_helper):
+    url = f"{zoom_helper.base_url}/report/meetings/9/participants"
+    responses.add(responses.GET, url, json={"next_page_token": "a", "participants": [{"id": "1"}]})
+    responses.add(responses.GET, url, json={"error": "unauthorized"}, status=401)
+
+    records = zoom_helper.iter_meeting_participants('9', b'9')
+    assert {"id": "1"} == next(records)
+    with pytest.raises(RuntimeError):
+        next(records)
+
+
+def test_token_provider_caches_and_refreshes_ahead_of_expiry():
+    now = [0.0]
+    signed = []
+    tokens = JwtTokenProvider(lambda: signed.append(1) or str(len(signed)).encode(), lifetime=1800,
+                              refresh_margin=300, clock=lambda: now[0])
+
+    assert b"1" == tokens.token()
+    now[0] = 1499
+    assert b"1" == tokens.token()
+    now[0] = 1500
+    assert b"2" == tokens.token()
+    assert 2 == tokens.refreshes
+
+
+def test_token_provider_refreshes_once_for_concurrent_401s():
+    signed = []
+    tokens = JwtTokenProvider(lambda: signed.append(1) or str(len(signed)).encode(), lifetime=1800)
+    stale = tokens.token()
+
+    tokens.invalidate(stale)
+    fresh = tokens.token()
+    tokens.invalidate(stale)
+
+    assert fresh == tokens.token()
+    assert 2 == tokens.refreshes
+
+
+@responses.activate
+def test_refreshes_token_and_replays_after_401(zoom_helper):
+    url = f"{zoom_helper.base_url}/report/meetings/10"
+    responses.add(responses.GET, url, json={"code": 124, "message": "Access token is expired."}, status=401)
+    responses.add(responses.GET, url, json={"topic": "topic 10"}, status=200)
+    zoom_helper.tokens.generate = iter([b"stale", b"fresh"]).__next__
+
+    r = zoom_helper.get_meeting_details('10')
+
+    assert 200 == r.status_code
+    assert "Bearer stale" == responses.calls[0].request.headers["Authorization"]
+    assert "Bearer fresh" == responses.calls[1].request.headers["Authorization"]
+
+
+@responses.activate
+def test_gives_up_after_one_token_refresh(zoom_helper):
+    url = f"{zoom_helper.base_url}/report/meetings/11"
+    responses.add(responses.GET, url, json={"error": "unauthorized"}, status=401)
+
+    assert 401 == zoom_helper.get_meeting_details('11').status_code
+    assert 2 == len(responses.calls)
+    assert 401 == zoom_helper.get_meeting_details('11', b'explicit').status_code
+    assert 3 == len(responses.calls)